@@ -0,0 +1,76 @@
+import logging
+import sqlite3
+import zlib
+
+
+class CategoryBitmaps:
+    ## Item-id sets of categories as bitmaps: Python ints with bit n set for item n, so intersections, unions
+    ## and differences of many categories are single bitwise operations. Bitmaps are built from a category's
+    ## relations on first use and stored zlib-compressed in term_bitmaps; triggers on term_relationships
+    ## delete the stored bitmap of a category whose relations change, so it is rebuilt on its next use.
+    ## Decoded bitmaps are kept in memory for the current data generation.
+
+    def __init__(self, db):
+        self.db = db
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.bitmaps, self.generation = dict(), None
+
+    @staticmethod
+    def encode(bitmap):
+        return zlib.compress(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'))
+
+    @staticmethod
+    def decode(blob):
+        return int.from_bytes(zlib.decompress(blob), 'little')
+
+    @staticmethod
+    def fromIdens(idens):
+        bits = bytearray()
+        for iden in idens:
+            if iden >> 3 >= len(bits): bits.extend(bytes((iden >> 3) - len(bits) + 1))
+            bits[iden >> 3] |= 1 << (iden & 7)
+        return int.from_bytes(bits, 'little')
+
+    @staticmethod
+    def idens(bitmap):
+        ## The item ids of a bitmap, ascending.
+        for index, byte in enumerate(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')):
+            if not byte: continue
+            for bit in range(8):
+                if byte >> bit & 1: yield index * 8 + bit
+
+    def bitmap(self, termID):
+        generation = self.db.currentDataGeneration()
+        if generation != self.generation: self.bitmaps, self.generation = dict(), generation
+        if termID in self.bitmaps: return self.bitmaps[termID]
+        blob = self.db.selectTermBitmap(termID)
+        if blob is not None: bitmap = self.decode(blob)
+        else:
+            bitmap = self.fromIdens(self.db.selectCategoryItemIdens(termID))
+            try:
+                self.db.insertTermBitmap(termID, self.encode(bitmap))
+                self.db.commit()
+            except sqlite3.OperationalError as e:
+                self.logger.debug("Category bitmap not stored: {}".format(e))
+        self.bitmaps[termID] = bitmap
+        return bitmap
+
+    def union(self, termIdens):
+        bitmap = 0
+        for termID in termIdens: bitmap |= self.bitmap(termID)
+        return bitmap
+
+    def evaluate(self, withAll=(), withAny=(), without=()):
+        ## Combines category bitmaps: every group of withAll (a group is one category, or a category and its
+        ## descendants) intersected, with any of withAny, minus the categories of without. Returns the
+        ## bitmap and whether it is a negative one, the items to exclude, when nothing positive was given.
+        positive = None
+        for group in withAll:
+            bitmap = self.union(group)
+            positive = bitmap if positive is None else positive & bitmap
+        if withAny:
+            bitmap = self.union(termID for group in withAny for termID in group)
+            positive = bitmap if positive is None else positive & bitmap
+        negative = self.union(termID for group in without for termID in group)
+        if positive is None: return negative, True
+        return positive & ~negative, False
@@ -1,8 +1,11 @@
 import os
 import logging
 import sqlite3
-from urllib.parse import quote, unquote
+import datetime
+from contextlib import contextmanager
+from urllib.parse import unquote
 from filecatman.core.functions import getPythonFileDir
+from filecatman.core.migrations import Migrator
 
 class Database:
     con, cur, lastInsertId, error, appConfig = None, None, None, None, None
@@ -11,16 +14,46 @@ class Database:
     )
     conSuccess = False
     debug = True
+    ## Size of the per-connection prepared statement cache. Statements are keyed by their SQL text,
+    ## so every query below binds its values as parameters to keep that text constant.
+    cachedStatements = 256
+    ## Connection pragmas applied on every connect, selected by the `performance_profile` option.
+    performanceProfiles = dict(
+        safe=dict(journal_mode="DELETE", synchronous="FULL", mmap_size=0, cache_size=-2000,
+                  temp_store="DEFAULT", busy_timeout=5000),
+        balanced=dict(journal_mode="WAL", synchronous="NORMAL", mmap_size=268435456, cache_size=-65536,
+                      temp_store="MEMORY", busy_timeout=5000),
+        bulk=dict(journal_mode="WAL", synchronous="OFF", mmap_size=268435456, cache_size=-262144,
+                  temp_store="MEMORY", busy_timeout=30000)
+    )
+    defaultPerformanceProfile = "balanced"
+    performanceProfile, connected = None, False
+    dataGeneration, generationStamp = None, None
+    ## Set when the items_fts full-text index exists; item searches fall back to LIKE scans without it.
+    fullTextSearch = False
+    ## Items store their type as an item_types id and their times as unix epochs. Item reads select these
+    ## columns so rows keep the FCM.ItemCol layout, with the type noun and "%Y-%m-%d %H:%M:%S" local times.
+    itemDateTime = "COALESCE(datetime({}, 'unixepoch', 'localtime'), '0000-00-00 00:00:00')"
+    itemColumns = "i.item_id, i.item_name, ty.noun_name AS type_id, i.item_ext, i.item_source, " \
+                  + itemDateTime.format("i.item_time") + " AS item_time, " \
+                  + itemDateTime.format("i.item_creation_time") + " AS item_creation_time, " \
+                  "i.item_description, i.item_primary_category, i.item_md5"
+    itemTables = "items AS i LEFT JOIN item_types AS ty ON (ty.type_id = i.type_id)"
 
     def __init__(self, config):
         super().__init__()
+        ## One entry per open session: 'begin', a savepoint name, or None for a session without a transaction.
+        self.sessions = list()
+        ## File actions of each open session, as (on commit, on rollback) lists; see onCommit and onRollback.
+        self.sessionActions = list()
         self.logger = logging.getLogger(self.__class__.__name__)
         self.appConfig = config
         if config['type'] == 'sqlite':
             self.config = {
                 'db': config['db'],
                 'charset': 'utf8',
-                'type': 'sqlite'
+                'type': 'sqlite',
+                'migrate': config.get('migrate', True)
             }
         else:
             raise Exception('Unknown database driver in configuration file: '+config['type'])
@@ -34,22 +67,20 @@ class Database:
         if os.path.exists(self.config['db']):
             self.logger.debug("Using existing database: '{}'".format(self.config['db']))
 
-        self.con = sqlite3.connect(self.config['db'])
-        if self.con:
-            self.cur = self.con.cursor()
+        self.connect()
 
         if self.cur:
-            self.cur.execute("PRAGMA foreign_keys = ON;")
-            self.commit()
-
+            freshDatabase = not self.tableExists('items')
             for table in self.defaultTables:
-                self.cur.execute(
-                    ''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='{0}' '''.format(table))
-                if not self.cur.fetchone()[0] == 1:
+                if not self.tableExists(table):
                     self.logger.debug("Table '{}' was missing from the database.".format(table))
                     self.createTables()
                     break
-
+            self.setPerformanceProfile(self.selectOption('performance_profile'))
+            migrator = Migrator(self)
+            if freshDatabase: migrator.markCurrent()
+            elif self.config['migrate']: migrator.run()
+            self.fullTextSearch = self.tableExists('items_fts')
             self.close()
             self.logger.debug("Successfully opened database `{}`.".format(self.config['db']))
             self.conSuccess = True
@@ -68,11 +99,13 @@ class Database:
         if os.path.exists(self.config['db']):
             self.logger.debug("Using existing database: '{}'".format(self.config['db']))
 
-        self.con = sqlite3.connect(databaseName)
+        self.con = sqlite3.connect(databaseName, cached_statements=self.cachedStatements)
         if self.con:
             self.cur = self.con.cursor()
+            self.registerFunctions()
         if self.cur:
             if self.createTables():
+                Migrator(self).markCurrent()
                 self.logger.debug("Database successfully created.")
                 self.conSuccess = True
                 self.close()
@@ -91,10 +124,15 @@ class Database:
             self.commit()
 
             for table in self.defaultTables:
-                self.cur.execute(
-                    ''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='{0}' '''.format(table))
-                if not self.cur.fetchone()[0] == 1:
+                if not self.tableExists(table):
                     raise Exception("Unable to create database tables.")
+            self.createTermClosure()
+            self.createSearchCache()
+            self.createResultSets()
+            self.createTermBitmaps()
+            self.createFileState()
+            self.createHashCache()
+            self.createFullTextIndex()
 
             self.logger.debug("Tables created")
             return True
@@ -113,38 +151,250 @@ class Database:
             self.logger.error("Error: "+str(e))
             self.error = str(e)
 
+    def connect(self):
+        self.con = sqlite3.connect(self.config['db'], cached_statements=self.cachedStatements)
+        if self.con:
+            self.cur = self.con.cursor()
+            self.cur.execute("PRAGMA foreign_keys = ON;")
+            self.registerFunctions()
+            self.connected = True
+            if self.performanceProfile: self.applyPerformanceProfile()
+        return self.con
+
+    def registerFunctions(self):
+        ## Databases before schema version 4 stored URL-quoted text, their migrations unquote it with fcm_unquote.
+        self.con.create_function("fcm_unquote", 1, lambda value: unquote(value) if value else value,
+                                 deterministic=True)
+
+    @staticmethod
+    def fullTextAvailable():
+        try:
+            sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE probe USING fts5(text)")
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    def createFullTextIndex(self):
+        if not self.fullTextAvailable():
+            self.logger.warning("SQLite was built without FTS5, item searches will use LIKE scans.")
+            return False
+        file = open(os.path.join(getPythonFileDir(),'queries','itemsfts.sql'), 'r')
+        with file:
+            SQL = file.read()
+        self.cur.executescript(SQL)
+        self.logger.debug("Full-text index created")
+        return True
+
+    def createTermClosure(self):
+        ## term_closure holds a row for every (ancestor, descendant) pair of categories, including each category
+        ## with itself at depth 0, kept in step with term_parent by triggers.
+        file = open(os.path.join(getPythonFileDir(),'queries','termclosure.sql'), 'r')
+        with file:
+            SQL = file.read()
+        self.cur.executescript(SQL)
+        self.logger.debug("Category closure table created")
+        return True
+
+    def createSearchCache(self):
+        ## search_cache keeps the ids item searches matched, valid while data_generation, bumped by triggers on
+        ## item, category and relation writes, is unchanged.
+        file = open(os.path.join(getPythonFileDir(),'queries','searchcache.sql'), 'r')
+        with file:
+            SQL = file.read()
+        self.cur.executescript(SQL)
+        self.logger.debug("Search cache created")
+        return True
+
+    def createResultSets(self):
+        ## result_sets names saved search results, result_set_items holds the ids of each one.
+        file = open(os.path.join(getPythonFileDir(),'queries','resultsets.sql'), 'r')
+        with file:
+            SQL = file.read()
+        self.cur.executescript(SQL)
+        self.logger.debug("Result set tables created")
+        return True
+
+    def createTermBitmaps(self):
+        ## term_bitmaps stores each category's item ids as a compressed bitmap, dropped when its relations change.
+        file = open(os.path.join(getPythonFileDir(),'queries','termbitmaps.sql'), 'r')
+        with file:
+            SQL = file.read()
+        self.cur.executescript(SQL)
+        self.logger.debug("Category bitmap table created")
+        return True
+
+    def createFileState(self):
+        ## file_state records the size, modification time and inode of each item's file when it was last
+        ## stored or checked, so size and file date searches don't stat the data directory.
+        file = open(os.path.join(getPythonFileDir(),'queries','filestate.sql'), 'r')
+        with file:
+            SQL = file.read()
+        self.cur.executescript(SQL)
+        self.logger.debug("File state table created")
+        return True
+
+    def createHashCache(self):
+        file = open(os.path.join(getPythonFileDir(),'queries','hashcache.sql'), 'r')
+        with file:
+            SQL = file.read()
+        self.cur.executescript(SQL)
+        self.logger.debug("Hash cache table created")
+        return True
+
+    def fullTextQuery(self, words, phrase=False):
+        ## Builds an FTS5 MATCH expression from search words. Each word is quoted so FTS5 operators are taken
+        ## literally, and searched as a prefix so "breed" still finds "Breeds" as the LIKE search did; a trailing
+        ## * is accepted and ignored. Words must all match, or match in order as a phrase.
+        terms = list()
+        for word in words:
+            word = word.rstrip('*')
+            if word: terms.append('"{}"*'.format(word.replace('"', '""')))
+        return (" + " if phrase else " ").join(terms)
+
+    def setPerformanceProfile(self, profileName):
+        if profileName not in self.performanceProfiles:
+            if profileName: self.logger.warning("Unknown performance profile: "+str(profileName))
+            profileName = self.defaultPerformanceProfile
+        self.performanceProfile = profileName
+        if self.connected: self.applyPerformanceProfile()
+        return profileName
+
+    def applyPerformanceProfile(self):
+        profile = self.performanceProfiles[self.performanceProfile]
+        ## The journal mode cannot change while a transaction is open; it is persistent in the file anyway.
+        if not self.con.in_transaction:
+            self.cur.execute("PRAGMA journal_mode = {}".format(profile['journal_mode']))
+        for pragma in ('synchronous', 'mmap_size', 'cache_size', 'temp_store', 'busy_timeout'):
+            self.cur.execute("PRAGMA {} = {}".format(pragma, profile[pragma]))
+        self.logger.debug("Applied performance profile `{}`.".format(self.performanceProfile))
+
+    @contextmanager
+    def usingPerformanceProfile(self, profileName):
+        previousProfile = self.performanceProfile
+        self.setPerformanceProfile(profileName)
+        try:
+            yield self
+        finally:
+            self.setPerformanceProfile(previousProfile)
+
     def open(self):
+        if self.sessions: return
         if self.con:
             try:
                 self.cur = self.con.cursor()
             except sqlite3.ProgrammingError as e:
-                self.con = sqlite3.connect(self.config['db'])
-                self.cur = self.con.cursor()
-            self.cur.execute("PRAGMA foreign_keys = ON;")
-            self.commit()
+                self.connect()
         else:
             self.logger.error("Error: No connection to open.")
 
     def close(self):
+        if self.sessions: return
         if self.con:
             self.con.close()
+            self.connected = False
         else:
             self.logger.error("Error: No connection to close.")
 
     def commit(self):
+        if self.inTransaction(): return
         return self.con.commit()
 
     def rollback(self):
+        ## Inside a session the rollback happens when the error propagates out of it.
+        if self.inTransaction(): return
         return self.con.rollback()
 
+    def inTransaction(self):
+        return any(self.sessions)
+
+    def onCommit(self, action):
+        ## Runs action once the changes made so far are committed: at once outside a transaction, else when the
+        ## outermost session commits. A session that rolls back drops it, so files are only deleted along with
+        ## their rows.
+        if not self.inTransaction(): return action()
+        self.sessionActions[-1][0].append(action)
+
+    def onRollback(self, action):
+        ## Runs action if the current session rolls back, to undo a file written alongside its rows.
+        if self.inTransaction(): self.sessionActions[-1][1].append(action)
+
+    def runActions(self, actions):
+        for action in actions:
+            try: action()
+            except OSError as e: self.logger.error("File action failed: {}".format(e))
+
+    @contextmanager
+    def session(self, transaction=True):
+        ## Keeps one connection open until the outermost session exits. open(), commit() and close() are
+        ## no-ops inside it. The first transactional session issues BEGIN and commits once on exit,
+        ## nested ones run inside a SAVEPOINT so their work can be rolled back on its own.
+        if not self.sessions: self.open()
+        if self.inTransaction():
+            marker = "fcm_session_{}".format(len(self.sessions))
+            self.cur.execute("SAVEPOINT "+marker)
+        elif transaction:
+            marker = "begin"
+            self.con.commit()
+            self.cur.execute("BEGIN")
+        else:
+            marker = None
+        self.sessions.append(marker)
+        self.sessionActions.append((list(), list()))
+        try:
+            yield self
+        except BaseException:
+            self.sessions.pop()
+            commitActions, rollbackActions = self.sessionActions.pop()
+            if marker == "begin":
+                self.con.rollback()
+            elif marker:
+                self.cur.execute("ROLLBACK TO "+marker)
+                self.cur.execute("RELEASE "+marker)
+            self.runActions(reversed(rollbackActions))
+            if not self.sessions: self.close()
+            raise
+        else:
+            self.sessions.pop()
+            commitActions, rollbackActions = self.sessionActions.pop()
+            if marker == "begin":
+                self.con.commit()
+                self.runActions(commitActions)
+            elif marker:
+                self.cur.execute("RELEASE "+marker)
+                ## A released savepoint's changes are committed or rolled back with the session around it.
+                self.sessionActions[-1][0].extend(commitActions)
+                self.sessionActions[-1][1].extend(rollbackActions)
+            if not self.sessions:
+                self.con.commit()
+                self.close()
+
     def versionInfo(self):
         return self.cur.execute("SELECT SQLITE_VERSION()").fetchone()
 
     def tables(self):
         return self.cur.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
 
+    def tableExists(self, table):
+        return self.cur.execute(
+            "SELECT count(name) FROM sqlite_master WHERE type='table' AND name = ?", (table,)).fetchone()[0] == 1
+
+    def columnExists(self, table, column):
+        return any(row[1] == column for row in self.cur.execute("PRAGMA table_info(`{}`)".format(table)))
+
     def getLastInsertId(self):
-        return self.cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+        return self.cur.lastrowid
+
+    @staticmethod
+    def toEpoch(dateTime):
+        ## Takes a datetime or a local "%Y-%m-%d %H:%M:%S" string. Unset dates like 0000-00-00 become None.
+        if not dateTime: return None
+        if isinstance(dateTime, str):
+            try: dateTime = datetime.datetime.fromisoformat(dateTime)
+            except ValueError: return None
+        return int(dateTime.timestamp())
+
+    def selectItemTypeIdens(self):
+        return dict(self.cur.execute("SELECT noun_name, type_id FROM item_types").fetchall())
 
     def newItem(self, data):
         self.lastInsertId = None
@@ -163,20 +413,23 @@ class Database:
                     data['time'] = "00:00:00"
                 data['datetime'] = data['date']+" "+data['time']
             if data.get('creationtime') is None:
-                import datetime
                 data['creationtime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            if data.get('description'): data['description'] = quote(data['description'])
-            if data.get('source'): data['source'] = quote(data['source'])
 
             for colabb, value in data.items():
                 if value is not None and value != "":
                     if colabb in colnames:
                         queryData[colnames[colabb]] = value
+            queryData['type_id'] = self.selectItemTypeIdens().get(data['type'])
+            if queryData['type_id'] is None:
+                self.logger.error("Error creating new item: unknown item type '{}'.".format(data['type']))
+                return
+            for column in ('item_time', 'item_creation_time'):
+                if column in queryData: queryData[column] = self.toEpoch(queryData[column])
 
             sql = "INSERT INTO items (" + ", ".join(queryData.keys())\
-                  + ") VALUES('" + "', '".join(queryData.values()) + "')"
+                  + ") VALUES(" + ", ".join("?" * len(queryData)) + ")"
             self.logger.debug(sql)
-            self.cur.execute(sql)
+            self.cur.execute(sql, tuple(queryData.values()))
             self.lastInsertId = self.getLastInsertId()
             if self.lastInsertId: self.logger.debug("Item successfully inserted.")
             else: self.logger.warning("Item already exists.")
@@ -202,8 +455,7 @@ class Database:
             self.logger.error("Error creating new category: name or taxonomy field is missing.")
             return
         else:
-            if data.get('description'): data['description'] = quote(data['description'])
-            else: data['description'] = ""
+            if not data.get('description'): data['description'] = ""
 
             # if data.get('parent') in ("", None): data.pop('parent')
 
@@ -213,37 +465,25 @@ class Database:
                         queryData[colnames[colabb]] = value
 
             for key, value in queryData.items():
-                self.logger.debug(key+": "+value)
+                self.logger.debug(key+": "+str(value))
 
-            # queryTerm.setForwardOnly(True)
             if args['replace'] is True:
-                if self.config['type'] == 'sqlite':
-                    termSQL = "INSERT INTO terms ("+", ".join(queryData.keys())\
-                              + ") VALUES('"+"', '".join(queryData.values())+"')"
-                    self.logger.debug('\n'+termSQL)
-                    self.cur.execute(termSQL)
-                    self.lastInsertId = self.getLastInsertId()
-                    if self.lastInsertId is None:
-                        termSelectSQL = "SELECT term_id from terms WHERE term_slug = '{}' AND term_taxonomy = '{}'"\
-                                        .format(data['slug'], data['taxonomy'])
-                        self.logger.debug('\n'+termSelectSQL)
-                        results = self.cur.execute(termSelectSQL)
-                        if len(results.fetchall()) > 0:
-                            termIden = results.fetchall()[0]
-                            termUpdateSQL = "UPDATE terms SET term_name='{}', term_slug='{}', term_parent={}, term_taxonomy='{}', " \
-                                            "term_description='{}' WHERE term_id = {}"\
-                                            .format(data['name'], data['slug'], data['parent'], data['taxonomy'],
-                                                    data['description'], termIden)
-                            self.logger.debug('\n'+termUpdateSQL)
-                            self.cur.execute(termUpdateSQL)
-                            self.lastInsertId = str(termIden)
-                            self.logger.warning("Category successfully replaced.")
-            else:
-                termSQL = "INSERT INTO terms ("+", ".join(queryData.keys())\
-                          + ") VALUES('"+"', '".join(queryData.values())+"')"
-                self.logger.debug('\n'+termSQL)
-                self.cur.execute(termSQL)
-                self.lastInsertId = self.getLastInsertId()
+                termIden = self.cur.execute("SELECT term_id FROM terms WHERE term_name = ? AND term_taxonomy = ?",
+                                            (data['name'], data['taxonomy'])).fetchone()
+                if termIden:
+                    termUpdateSQL = "UPDATE terms SET term_name = ?, term_parent = ?, term_taxonomy = ?, " \
+                                    "term_description = ? WHERE term_id = ?"
+                    self.logger.debug('\n'+termUpdateSQL)
+                    self.cur.execute(termUpdateSQL, (data['name'], data.get('parent') or None, data['taxonomy'],
+                                                     data['description'], termIden[0]))
+                    self.lastInsertId = termIden[0]
+                    self.logger.warning("Category successfully replaced.")
+                    return True
+            termSQL = "INSERT INTO terms ("+", ".join(queryData.keys())\
+                      + ") VALUES("+", ".join("?" * len(queryData))+")"
+            self.logger.debug('\n'+termSQL)
+            self.cur.execute(termSQL, tuple(queryData.values()))
+            self.lastInsertId = self.getLastInsertId()
             return True
 
     def newRelation(self, data):
@@ -252,14 +492,64 @@ class Database:
             self.logger.error("Error creating new relation: ID field is missing.")
             return
         else:
-            queryData = data
-            sql = "INSERT INTO term_relationships (item_id, term_id) VALUES('{}', '{}')"\
-                .format(queryData['item'], queryData['term'])
-            if self.cur.execute(sql): self.incrementTermCount(queryData['term'])
-            else: self.logger.warning("Relation already exists.")
+            self.cur.execute("INSERT INTO term_relationships (item_id, term_id) VALUES (?, ?)",
+                             (data['item'], data['term']))
             self.lastInsertId = self.getLastInsertId()
             return True
 
+    def newItems(self, items):
+        ## Batch variant of newItem. Every row is written by one executemany call and the new item ids
+        ## are returned in input order.
+        columns = ("item_name", "type_id", "item_ext", "item_source", "item_time", "item_creation_time",
+                   "item_description", "item_primary_category", "item_md5")
+        now = self.toEpoch(datetime.datetime.now())
+        typeIdens = self.selectItemTypeIdens()
+        rows = list()
+        for data in items:
+            ## Raised rather than returning None, as callers pair the returned ids with their rows.
+            if data.get('name') is None or data.get('type') is None:
+                raise Exception("Error creating new items: name or typeID field is missing.")
+            if typeIdens.get(data['type']) is None:
+                raise Exception("Error creating new items: unknown item type '{}'.".format(data['type']))
+            if data.get('datetime') is None:
+                data['datetime'] = (data.get('date') or "0000-00-00")+" "+(data.get('time') or "00:00:00")
+            rows.append((data['name'], typeIdens[data['type']], data.get('ext') or "",
+                         data.get('source') or "", self.toEpoch(data['datetime']),
+                         self.toEpoch(data.get('creationtime')) or now,
+                         data.get('description') or "",
+                         data.get('primarycategory') or None, data.get('md5') or ""))
+        return self.insertMany("items", columns, rows)
+
+    def newCategories(self, categories):
+        ## Batch variant of newCategory, returns the new term ids in input order.
+        columns = ("term_name", "term_taxonomy", "term_parent", "term_description")
+        rows = list()
+        for data in categories:
+            ## Raised rather than returning None, as callers pair the returned ids with their rows.
+            if data.get('name') is None or data.get('taxonomy') is None:
+                raise Exception("Error creating new categories: name or taxonomy field is missing.")
+            rows.append((data['name'], data['taxonomy'], data.get('parent') or None,
+                         data.get('description') or None))
+        return self.insertMany("terms", columns, rows)
+
+    def newRelations(self, relations):
+        ## Takes (item id, term id) pairs. Relations that already exist are skipped. Returns the number
+        ## of relations inserted.
+        relations = list(relations)
+        if not relations: return 0
+        self.cur.executemany("INSERT OR IGNORE INTO term_relationships (item_id, term_id) VALUES (?, ?)", relations)
+        return self.cur.rowcount
+
+    def insertMany(self, table, columns, rows):
+        if not rows: return list()
+        sql = "INSERT INTO {} ({}) VALUES({})".format(table, ", ".join(columns), ", ".join("?" * len(columns)))
+        self.logger.debug(sql)
+        self.cur.executemany(sql, rows)
+        ## Ids from AUTOINCREMENT are contiguous within a single statement on one connection.
+        lastIden = self.cur.execute("SELECT last_insert_rowid()").fetchone()[0]
+        self.lastInsertId = lastIden
+        return list(range(lastIden - len(rows) + 1, lastIden + 1))
+
     def updateItem(self, data):
         self.lastInsertId = None
         colnames = dict(name="item_name",
@@ -272,121 +562,113 @@ class Database:
                         md5="item_md5")
         queryData = dict()
         if not data.get('id'): return False
-        if data.get('description'): data['description'] = quote(data['description'])
-        if data.get('source'): data['source'] = quote(data['source'])
-        if data.get('name'): data['name'] = quote(data['name'])
         for colabb, value in data.items():
             if value is not None:
                 if colabb in colnames:
                     queryData[colnames[colabb]] = value
-
-        SQL = "UPDATE items Set "
-        i = 0
-        for key, value in queryData.items():
-            line = key+"='"+value+"'"
-            if i < len(queryData)-1:
-                line += ", "
-            i += 1
-            SQL += line
-        SQL += " WHERE item_id='{}'".format(data.get('id'))
+        if 'type_id' in queryData:
+            queryData['type_id'] = self.selectItemTypeIdens().get(queryData['type_id'])
+            if queryData['type_id'] is None:
+                self.logger.error("Error updating item: unknown item type '{}'.".format(data['type']))
+                return False
+        if 'item_time' in queryData: queryData['item_time'] = self.toEpoch(queryData['item_time'])
+
+        SQL = "UPDATE items Set " + ", ".join(key + " = ?" for key in queryData.keys()) + " WHERE item_id = ?"
         self.logger.debug('\n'+SQL)
-        query = self.cur.execute(SQL)
+        query = self.cur.execute(SQL, (*queryData.values(), data.get('id')))
         if query:
             self.lastInsertId = self.getLastInsertId()
             return True
 
     def updatePrimaryCategory(self, itemID, newPrimaryCategory):
-        return self.cur.execute(
-            "UPDATE items Set item_primary_category='{}' WHERE item_id='{}'".format(newPrimaryCategory, itemID))
+        return self.cur.execute("UPDATE items Set item_primary_category = ? WHERE item_id = ?",
+                                (newPrimaryCategory, itemID))
 
     def updateMD5(self, itemID, newMD5):
-        return self.cur.execute( "UPDATE items Set item_md5='{}' WHERE item_id='{}'".format(newMD5, itemID))
+        return self.cur.execute("UPDATE items Set item_md5 = ? WHERE item_id = ?", (newMD5, itemID))
+
+    def updateMD5s(self, rows):
+        ## rows are (item_md5, item_id) pairs.
+        return self.cur.executemany("UPDATE items Set item_md5 = ? WHERE item_id = ?", rows)
 
     def updateItemDate(self, itemID, newDate):
-        return self.cur.execute( "UPDATE items Set item_time='{}' WHERE item_id='{}'".format(newDate, itemID))
+        return self.cur.execute("UPDATE items Set item_time = ? WHERE item_id = ?", (self.toEpoch(newDate), itemID))
 
     def updateItemSource(self, itemID, newSource):
-        return self.cur.execute( "UPDATE items Set item_source='{}' WHERE item_id='{}'".format(newSource, itemID))
+        return self.cur.execute("UPDATE items Set item_source = ? WHERE item_id = ?", (newSource, itemID))
 
     def updateItemDescription(self, itemID, newDesc):
-        return self.cur.execute( "UPDATE items Set item_description='{}' WHERE item_id='{}'".format(newDesc, itemID))
+        return self.cur.execute("UPDATE items Set item_description = ? WHERE item_id = ?", (newDesc, itemID))
 
     def renameItem(self, itemID, newName):
-        return self.cur.execute("UPDATE items Set item_name='{}' WHERE item_id='{}'".format(newName, itemID))
+        return self.cur.execute("UPDATE items Set item_name = ? WHERE item_id = ?", (newName, itemID))
 
     def renameCategory(self, catID, newName):
-        return self.cur.execute("UPDATE terms Set term_name='{}' WHERE term_id='{}'".format(newName, catID))
+        return self.cur.execute("UPDATE terms Set term_name = ? WHERE term_id = ?", (newName, catID))
 
     def updateItemType(self, oldItemType, newItemType):
-        SQL = "UPDATE items Set type_id='{}' WHERE type_id='{}'".format(newItemType, oldItemType)
+        SQL = "UPDATE items Set type_id = (SELECT type_id FROM item_types WHERE noun_name = ?) " \
+              "WHERE type_id = (SELECT type_id FROM item_types WHERE noun_name = ?)"
         self.logger.debug('\n'+SQL)
-        query = QSqlQuery(SQL, self.con)
-        self.lastInsertId = query.lastInsertId()
+        self.cur.execute(SQL, (newItemType, oldItemType))
+        self.lastInsertId = self.getLastInsertId()
         self.logger.debug("Item Type `{}` successfully updated to `{}`.".format(oldItemType, newItemType))
 
     def updateTaxonomy(self, oldTaxonomy, newTaxonomy):
-        SQL = "UPDATE terms Set term_taxonomy='{}' WHERE term_taxonomy='{}'"\
-              .format(newTaxonomy, oldTaxonomy)
+        SQL = "UPDATE terms Set term_taxonomy = ? WHERE term_taxonomy = ?"
         self.logger.debug('\n'+SQL)
-        query = QSqlQuery(SQL, self.con)
-        self.lastInsertId = query.lastInsertId()
+        self.cur.execute(SQL, (newTaxonomy, oldTaxonomy))
+        self.lastInsertId = self.getLastInsertId()
         self.logger.debug("Taxonomy `{}` successfully updated to `{}`.".format(oldTaxonomy, newTaxonomy))
 
     def updateCategory(self, data):
         if data.get('termid') is None or data.get('name') is None:
             return
 
-        if data.get('description'):
-                data['description'] = quote(data['description'])
-        else:
+        if not data.get('description'):
             data['description'] = ""
 
-        if data.get('parent') in ("", None):
-            data['parent'] = '0'
+        if data.get('parent') in ("", None, '0', 0):
+            data['parent'] = None
 
-        termSQL = "UPDATE terms SET term_name='{}', term_slug='{}', term_parent={}, term_taxonomy='{}', " \
-                  "term_description='{}' WHERE term_id = '{}'"\
-            .format(data['name'], data['slug'], data['parent'], data['taxonomy'], data['description'], data['termid'])
+        termSQL = "UPDATE terms SET term_name = ?, term_parent = ?, term_taxonomy = ?, " \
+                  "term_description = ? WHERE term_id = ?"
         self.logger.debug('\n'+termSQL)
-        queryTerm = QSqlQuery(termSQL, self.con)
-        self.lastInsertId = queryTerm.lastInsertId()
+        self.cur.execute(termSQL, (data['name'], data['parent'], data['taxonomy'], data['description'], data['termid']))
+        self.lastInsertId = self.getLastInsertId()
         self.logger.debug("Category successfully updated.")
 
     def deleteItem(self, itemid):
-        sql = "SELECT term_id FROM term_relationships as tr " \
-              "WHERE (tr.item_id = {})".format(itemid)
+        sql = "DELETE FROM items WHERE item_id = ?"
         self.logger.debug("\n"+sql)
-        query = self.cur.execute(sql)
-        if query:
-            for term in query.fetchall():
-                self.decrementTermCount(term[0])
-        sql = "DELETE FROM items WHERE item_id = '{}'".format(itemid)
-        self.logger.debug("\n"+sql)
-        self.cur.execute(sql)
+        self.cur.execute(sql, (itemid,))
         self.logger.debug("Item successfully deleted.")
         return True
 
     def deleteCategory(self, catIden):
-        return self.cur.execute("DELETE FROM terms WHERE term_id = '{}'".format(catIden))
+        return self.cur.execute("DELETE FROM terms WHERE term_id = ?", (catIden,))
 
     def deleteRelation(self, itemid, termid):
-        self.cur.execute(
-            "DELETE FROM term_relationships WHERE (item_id = '{}') AND (term_id = '{}')".format(itemid, termid))
-        self.decrementTermCount(termid)
+        self.cur.execute("DELETE FROM term_relationships WHERE (item_id = ?) AND (term_id = ?)", (itemid, termid))
         return True
 
     def deleteRelations(self, iden, col='item_id'):
-        relations = self.cur.execute(
-            "SELECT item_id, term_id FROM term_relationships WHERE {} = {}".format(col, iden)).fetchall()
-        for rel in relations:
-            self.cur.execute(
-                "DELETE FROM term_relationships WHERE (item_id = '{}') AND (term_id = '{}')".format(rel[0], rel[1]))
-            self.decrementTermCount(rel[1])
+        if col not in ('item_id', 'term_id'): raise Exception("Unknown relation column: "+col)
+        self.cur.execute("DELETE FROM term_relationships WHERE {} = ?".format(col), (iden,))
         return True
 
-    def deleteItemTypes(self):
-        self.cur.execute("DELETE FROM item_types")
-        self.cur.execute("UPDATE SQLITE_SEQUENCE SET seq = 0 WHERE name = 'item_types';")
+    def deleteRelationsBulk(self, relations):
+        ## Takes (item id, term id) pairs, returns the number of relations deleted.
+        relations = list(relations)
+        if not relations: return 0
+        self.cur.executemany("DELETE FROM term_relationships WHERE (item_id = ?) AND (term_id = ?)", relations)
+        return self.cur.rowcount
+
+    def deleteItemTypes(self, keep=()):
+        ## Items reference item_types by id, so types still in use are kept along with those named in `keep`.
+        placeholders = ", ".join("?" * len(keep))
+        self.cur.execute("DELETE FROM item_types WHERE noun_name NOT IN ({}) "
+                         "AND type_id NOT IN (SELECT DISTINCT type_id FROM items)".format(placeholders), tuple(keep))
         # self.logger.debug("Item Types successfully deleted.")
         return True
 
@@ -397,206 +679,166 @@ class Database:
         return True
 
     def bulkDeleteItems(self, itemIdens):
-        sql = "SELECT term_id FROM term_relationships as tr " \
-              "WHERE item_id IN ({})".format(", ".join(itemIdens))
-        self.logger.debug('\n'+sql)
-        relations = QSqlQuery(sql, self.con)
-        while relations.next():
-            self.decrementTermCount(relations.value(0))
-        sql = "DELETE FROM items WHERE (item_id) IN ({})".format(", ".join(itemIdens))
+        placeholders = ", ".join("?" * len(itemIdens))
+        sql = "DELETE FROM items WHERE (item_id) IN ({})".format(placeholders)
         self.logger.debug('\n'+sql)
-        QSqlQuery(sql, self.con)
+        self.cur.execute(sql, tuple(itemIdens))
         self.commit()
         self.logger.debug("Items successfully deleted.")
         return True
 
     def selectLastItem(self):
-        return self.cur.execute("SELECT * FROM items ORDER BY item_id DESC LIMIT 1").fetchone()
+        return self.cur.execute("SELECT {} FROM {} ORDER BY i.item_id DESC LIMIT 1"
+                                .format(self.itemColumns, self.itemTables)).fetchone()
 
-    def selectItem(self, itemID, col="*"):
-        return self.cur.execute("SELECT {} FROM items AS i "
-                          "WHERE (item_id= '{}')".format(col, itemID)).fetchone()
+    def selectItem(self, itemID, col=None):
+        return self.cur.execute("SELECT {} FROM {} "
+                                "WHERE (i.item_id = ?)".format(col or self.itemColumns, self.itemTables),
+                                (itemID,)).fetchone()
 
     def selectTaxonomy(self, tableName):
         return self.cur.execute("SELECT * FROM taxonomies AS t "
-                                "WHERE (table_name= '{}')".format(tableName))
+                                "WHERE (table_name = ?)", (tableName,))
 
     def selectItems(self, args=None):
         where = ["( i.item_id is not null )", ]
-        startLimit = 0
-        col = "*"
+        params = list()
+        col = self.itemColumns
         limit = ""
         if args:
-            if args.get('item_id'): where.append("( i.item_id = '{}' )".format(args['item_id']))
-            if args.get('type_id'): where.append("( i.type_id = '{}' )".format(args['type_id']))
-            if args.get('item_name'): where.append("( i.item_name = '{}' )".format(args['item_name']))
-            if args.get('item_md5'): where.append("( i.item_md5 = '{}' )".format(args['item_md5']))
+            for column in ('item_id', 'type_id', 'item_name', 'item_md5'):
+                if args.get(column):
+                    if column == 'type_id': where.append("( ty.noun_name = ? )")
+                    else: where.append("( i.{} = ? )".format(column))
+                    params.append(args[column])
             if args.get('col'): col = args['col']
             if args.get('limit'):
-                if args.get('start'):
-                    startLimit = args['start']
-                limit = "LIMIT {}, {}".format(startLimit, args['limit'])
+                limit = "LIMIT ?, ?"
+                params.extend((args.get('start') or 0, args['limit']))
         whereJoined = " AND ".join(where)
-        sql = "SELECT {} FROM items AS i " \
+        sql = "SELECT {} FROM {} " \
               "WHERE {} " \
-              "{}".format(col, whereJoined, limit)
+              "{}".format(col, self.itemTables, whereJoined, limit)
         self.logger.debug('\n'+sql)
-        return self.cur.execute(sql).fetchall()
+        return self.cur.execute(sql, params).fetchall()
 
     def selectCategory(self, catID, col="*"):
         return self.cur.execute("SELECT {} FROM terms AS t " \
-              "WHERE (t.term_id = '{}')".format(col, catID)).fetchone()
+              "WHERE (t.term_id = ?)".format(col), (catID,)).fetchone()
 
     def selectCategories(self, args=None):
         where = ["( t.term_id is not null )", ]
+        params = list()
         col = "*"
         if args:
-            if args.get('term_id'):
-                where.append("( t.term_id = '{}' )".format(args['term_id']))
-            if args.get('term_name'):
-                where.append("( t.term_name = '{}' )".format(args['term_name']))
-            if args.get('term_parent'):
-                where.append("( t.term_parent = '{}' )".format(args['term_parent']))
-            if args.get('term_taxonomy'):
-                where.append("( t.term_taxonomy = '{}' )".format(args['term_taxonomy']))
-            if args.get('term_count'):
-                where.append("( t.term_count = '{}' )".format(args['term_count']))
+            for column in ('term_id', 'term_name', 'term_parent', 'term_taxonomy', 'term_count'):
+                if args.get(column):
+                    where.append("( t.{} = ? )".format(column))
+                    params.append(args[column])
             if args.get('col'):
                 col = args['col']
         whereJoined = " AND ".join(where)
-        # query.setForwardOnly(True)
         sql = "SELECT {} FROM terms AS t " \
               "WHERE {}".format(col, whereJoined)
-        results = self.cur.execute(sql)
+        results = self.cur.execute(sql, params)
         return results
 
     def selectCategoriesAsTree(self, args=None):
-        queryArgs = dict()
+        ## Walks down from the root categories with a recursive CTE. Rows come out depth first, siblings ordered
+        ## by name, as dicts with id, name, level and parent (plus count and tax when complete is set).
         if args is None:
             args = dict()
-        if args.get('taxonomy') is not None:
-            queryArgs['tax'] = args['taxonomy']
-        if args.get('complete') is not None:
-            selectComplete = args['complete']
-        else:
-            selectComplete = False
+        params = list()
         if args.get('extra') is not None:
-            queryArgs['extra'] = args['extra']
-        else:
-            queryArgs['extra'] = None
-        catLvls = self.appConfig['options']['cat_lvls']
-        if selectComplete:
-            sql = "SELECT root.term_id AS root_id, " \
-                  "root.term_taxonomy AS root_tax, root.term_name AS root_name, " \
-                  "root.term_slug AS root_slug, root.term_count AS root_count"
-        else:
-            sql = """SELECT root.term_id AS root_id, root.term_name AS root_name"""
-        if catLvls > 0:
-            sql += ","
-        i = 1
-        while i <= catLvls:
-            curLevel = str(i)
-            if selectComplete:
-                sql += "\ndown{0}.term_id AS down{0}_id, " \
-                       "down{0}.term_taxonomy AS down{0}_tax, down{0}.term_name as down{0}_name, " \
-                       "down{0}.term_slug AS down{0}_slug, down{0}.term_count AS down{0}_count".format(curLevel)
-            else:
-                sql += "\ndown{0}.term_id AS down{0}_id, down{0}.term_name as down{0}_name"\
-                    .format(curLevel)
-            if i < catLvls:
-                sql += ","
-            i += 1
-        sql += "\nFROM terms AS root"
-        i = 1
-        while i <= catLvls:
-            curLevel = str(i)
-            if i == 1:
-                lastLevel = "root"
-            else:
-                lastLevel = "down"+str(i-1)
-            sql += "\nLEFT JOIN terms AS down{0} ON down{0}.term_parent = {1}.term_id "\
-                .format(curLevel, lastLevel)
-            i += 1
-        if queryArgs['extra']:
-            sql += "\nWHERE (root.term_parent is NULL) AND ({})".format(queryArgs['extra'])
+            rootWhere = "({})".format(args['extra'])
         else:
-            sql += "\nWHERE (root.term_parent is NULL) AND (root.term_taxonomy = '{}')".format(queryArgs['tax'])
-        sql += "\nORDER BY root_name"
-        i = 1
-        while i <= catLvls:
-            curLevel = str(i)
-            sql += ", down{}_name".format(curLevel)
-
-            i += 1
-        query = QSqlQuery(self.con)
-        query.setForwardOnly(True)
-        query.exec_(sql)
+            rootWhere = "(t.term_taxonomy = ?)"
+            params.append(args.get('taxonomy'))
+        levels = args.get('levels')
+        if levels is None: levels = -1
+        params.extend((levels, levels))
+        sql = "WITH RECURSIVE tree (term_id, level, path) AS (" \
+              "SELECT t.term_id, 0, t.term_name || char(30) || printf('%010d', t.term_id) FROM terms AS t " \
+              "WHERE (t.term_parent IS NULL) AND {} " \
+              "UNION ALL " \
+              "SELECT t.term_id, tree.level + 1, " \
+              "tree.path || char(31) || t.term_name || char(30) || printf('%010d', t.term_id) " \
+              "FROM terms AS t INNER JOIN tree ON (t.term_parent = tree.term_id) " \
+              "WHERE (? < 0 OR tree.level < ?)) " \
+              "SELECT t.term_id, t.term_name, tree.level, t.term_parent, t.term_count, t.term_taxonomy " \
+              "FROM tree INNER JOIN terms AS t ON (t.term_id = tree.term_id) " \
+              "ORDER BY tree.path".format(rootWhere)
         self.logger.debug(sql)
-        pool = []
         categories = []
-        while query.next():
-            rootIdIndex = query.record().indexOf("root_id")
-            rootNameIndex = query.record().indexOf("root_name")
-            if query.value(rootIdIndex) not in pool and query.value(rootNameIndex) != '':
-                c = {'id': query.value(rootIdIndex),
-                     'name': query.value(rootNameIndex),
-                     'level': 0}
-                if selectComplete:
-                    c['slug'] = query.value(query.record().indexOf("root_slug"))
-                    c['count'] = query.value(query.record().indexOf("root_count"))
-                    c['tax'] = query.value(query.record().indexOf("root_tax"))
-                categories.append(c)
-            pool.append(query.value(rootIdIndex))
-            i = 1
-            while i <= catLvls:
-                curLevel = str(i)
-                downIdIndex = query.record().indexOf("down{}_id".format(curLevel))
-                downNameIndex = query.record().indexOf("down{}_name".format(curLevel))
-                if query.value(downIdIndex) not in pool and query.value(downNameIndex) != '':
-                    c = {'id': query.value(downIdIndex),
-                         'name': query.value(downNameIndex),
-                         'level': i}
-                    if selectComplete:
-                        c['slug'] = query.value(query.record().indexOf("down{}_slug".format(curLevel)))
-                        c['count'] = query.value(query.record().indexOf("down{}_count".format(curLevel)))
-                        c['tax'] = query.value(query.record().indexOf("down{}_tax".format(curLevel)))
-                    categories.append(c)
-                pool.append(query.value(downIdIndex))
-                i += 1
+        for termID, name, level, parent, count, taxonomy in self.cur.execute(sql, params).fetchall():
+            c = {'id': termID,
+                 'name': name,
+                 'level': level,
+                 'parent': parent}
+            if args.get('complete'):
+                c['count'] = count
+                c['tax'] = taxonomy
+            categories.append(c)
         return categories
 
+    def selectCategoryPath(self, catID):
+        ## Names of the categories from the root down to catID.
+        return [row[0] for row in self.cur.execute(
+            "SELECT t.term_name FROM term_closure AS c INNER JOIN terms AS t ON (t.term_id = c.ancestor_id) "
+            "WHERE (c.descendant_id = ?) ORDER BY c.depth DESC", (catID,)).fetchall()]
+
+    def selectCategoryDescendants(self, catID):
+        ## Idens of catID and every category below it.
+        return [row[0] for row in self.cur.execute(
+            "SELECT descendant_id FROM term_closure WHERE (ancestor_id = ?)", (catID,)).fetchall()]
+
+    def updateCategoryParent(self, catID, parentID):
+        ## Returns False when the move is refused, e.g. a category moved under its own subcategory.
+        try:
+            self.cur.execute("UPDATE terms SET term_parent = ? WHERE term_id = ?", (parentID, catID))
+        except sqlite3.IntegrityError as e:
+            self.printQueryError(e)
+            return False
+        self.logger.debug("Category parent successfully updated.")
+        return True
+
     def selectRelations(self, itemID):
         return self.cur.execute("SELECT term_id FROM term_relationships AS tr "
-                          "WHERE (tr.item_id= '{}')".format(itemID)).fetchall()
+                                "WHERE (tr.item_id = ?)", (itemID,)).fetchall()
 
     def selectCategoryRelations(self, termID):
         return self.cur.execute("SELECT item_id FROM term_relationships AS tr "
-                          "WHERE (tr.term_id= '{}')".format(termID)).fetchall()
+                                "WHERE (tr.term_id = ?)", (termID,)).fetchall()
+
+    def selectRelatedCategories(self, itemID):
+        return self.cur.execute("SELECT t.term_name, t.term_parent, t.term_taxonomy "
+                                "FROM term_relationships AS tr "
+                                "INNER JOIN terms AS t ON (t.term_id = tr.term_id) "
+                                "WHERE (tr.item_id = ?)", (itemID,)).fetchall()
 
     def selectRelatedTags(self, itemID, taxonomy="tag"):
-        query = QSqlQuery("SELECT t.term_name from terms AS t "
-                          "INNER JOIN term_relationships AS tr ON (tr.term_id = t.term_id) "
-                          "WHERE (tr.item_id = {}) AND (t.term_taxonomy = '{}')".format(itemID, taxonomy),
-                          self.con)
-        return query
+        return self.cur.execute("SELECT t.term_name from terms AS t "
+                                "INNER JOIN term_relationships AS tr ON (tr.term_id = t.term_id) "
+                                "WHERE (tr.item_id = ?) AND (t.term_taxonomy = ?)", (itemID, taxonomy))
 
     def selectCount(self, table="items"):
+        if table not in self.defaultTables: raise Exception("Unknown table: "+table)
         return self.cur.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()
 
     def selectCountCategoriesWithTaxonomy(self, taxonomy):
-        return self.cur.execute('SELECT COUNT(*) FROM terms WHERE term_taxonomy = "{}"'.format(taxonomy)).fetchone()[0]
+        return self.cur.execute('SELECT COUNT(*) FROM terms WHERE term_taxonomy = ?', (taxonomy,)).fetchone()[0]
 
     def selectCountRelations(self, iden, col="item_id"):
+        if col not in ('item_id', 'term_id'): raise Exception("Unknown relation column: "+col)
         query = self.cur.execute('SELECT COUNT(*) FROM term_relationships '
-                          'WHERE {} = "{}"'.format(col, iden)).fetchone()[0]
+                                 'WHERE {} = ?'.format(col), (iden,)).fetchone()[0]
         if query: return query
         return False
 
     def selectOption(self, option):
-        query = QSqlQuery('SELECT option_value FROM options WHERE option_name = "{}"'.format(option),
-                          self.con)
-        if query.first():
-            optionValue = query.value(0)
+        query = self.cur.execute('SELECT option_value FROM options WHERE option_name = ?', (option,)).fetchone()
+        if query:
+            optionValue = query[0]
             self.logger.debug("Option {}: {}".format(option, optionValue))
             return unquote(optionValue)
 
@@ -611,30 +853,155 @@ class Database:
         return self.cur.execute('SELECT * FROM taxonomies')
 
     def selectAllItems(self):
-        return self.cur.execute('SELECT * FROM items').fetchall()
+        return self.cur.execute('SELECT {} FROM {}'.format(self.itemColumns, self.itemTables)).fetchall()
 
     def selectAllCategories(self):
         return self.cur.execute('SELECT * FROM terms').fetchall()
 
     def selectDistinctItemTypes(self):
-        return QSqlQuery('SElECT DISTINCT type_id from items', self.con)
+        return self.cur.execute('SELECT DISTINCT ty.noun_name FROM {}'.format(self.itemTables))
 
     def selectDistinctTaxonomies(self):
-        return QSqlQuery('SElECT DISTINCT term_taxonomy from terms', self.con)
-
-    def incrementTermCount(self, catid):
-        self.cur.execute("UPDATE terms SET term_count = term_count + 1 "
-                  "WHERE term_id = '{}'".format(catid))
+        return self.cur.execute('SELECT DISTINCT term_taxonomy from terms')
+
+    def dataVersion(self):
+        return self.cur.execute("PRAGMA data_version").fetchone()[0]
+
+    def selectDataGeneration(self):
+        try:
+            row = self.cur.execute("SELECT generation FROM data_generation WHERE generation_id = 1").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def currentDataGeneration(self):
+        ## data_generation is only read again once PRAGMA data_version (a commit by another connection) or this
+        ## connection's change count moved.
+        stamp = (self.con, self.dataVersion(), self.con.total_changes)
+        if stamp != self.generationStamp:
+            self.dataGeneration, self.generationStamp = self.selectDataGeneration(), stamp
+        return self.dataGeneration
+
+    def selectCachedSearch(self, cacheKey, generation):
+        row = self.cur.execute("SELECT item_ids FROM search_cache WHERE cache_key = ? AND generation = ?",
+                               (cacheKey, generation)).fetchone()
+        return row[0] if row else None
+
+    def insertCachedSearch(self, cacheKey, generation, itemIds, keep=64):
+        ## Entries from older generations can never be read again, the rest are trimmed to the `keep` newest.
+        self.cur.execute("DELETE FROM search_cache WHERE generation <> ?", (generation,))
+        self.cur.execute("INSERT OR REPLACE INTO search_cache (cache_key, generation, item_ids, cached_time) "
+                         "VALUES (?, ?, ?, strftime('%s', 'now'))", (cacheKey, generation, itemIds))
+        self.cur.execute("DELETE FROM search_cache WHERE cache_key NOT IN "
+                         "(SELECT cache_key FROM search_cache ORDER BY cached_time DESC LIMIT ?)", (keep,))
+
+    def clearSearchCache(self):
+        self.cur.execute("DELETE FROM search_cache")
+
+    def newResultSet(self, name):
+        ## A name saved again gets a new set_id; deleteResultSet(name, keep=...) then drops the older sets of that
+        ## name. Search cache keys hold the set_id, so results cached from the old contents are never read.
+        self.cur.execute("INSERT INTO result_sets (set_name, set_time) VALUES (?, strftime('%s', 'now'))", (name,))
+        self.lastInsertId = self.cur.lastrowid
+        return self.lastInsertId
+
+    def insertResultSetItems(self, setID, sql, params=()):
+        ## Fills a set from a statement selecting item ids, without reading them into Python.
+        self.cur.execute("INSERT OR IGNORE INTO result_set_items (set_id, item_id) SELECT ?, item_id FROM (\n{}\n)"
+                         .format(sql), (setID, *params))
+
+    def insertResultSetIdens(self, setID, idens):
+        self.cur.executemany("INSERT OR IGNORE INTO result_set_items (set_id, item_id) VALUES (?, ?)",
+                             ((setID, iden) for iden in idens))
+
+    def selectResultSet(self, name):
+        return self.cur.execute("SELECT set_id, set_name, set_time FROM result_sets WHERE set_name = ? "
+                                "ORDER BY set_id DESC LIMIT 1", (name,)).fetchone()
+
+    def selectResultSets(self):
+        return self.cur.execute("SELECT s.set_id, s.set_name, COALESCE(datetime(s.set_time, 'unixepoch', 'localtime'), ''), "
+                                "(SELECT COUNT(*) FROM result_set_items AS rs WHERE rs.set_id = s.set_id) "
+                                "FROM result_sets AS s ORDER BY s.set_name").fetchall()
+
+    def selectCountResultSet(self, setID):
+        return self.cur.execute("SELECT COUNT(*) FROM result_set_items WHERE set_id = ?", (setID,)).fetchone()[0]
+
+    def deleteResultSet(self, name, keep=None):
+        self.cur.execute("DELETE FROM result_sets WHERE set_name = ? AND set_id IS NOT ?", (name, keep))
+        return self.cur.rowcount
+
+    def selectTermBitmap(self, termID):
+        row = self.cur.execute("SELECT bitmap FROM term_bitmaps WHERE term_id = ?", (termID,)).fetchone()
+        return row[0] if row else None
+
+    def insertTermBitmap(self, termID, bitmap):
+        self.cur.execute("INSERT OR REPLACE INTO term_bitmaps (term_id, bitmap) VALUES (?, ?)", (termID, bitmap))
+
+    def selectCategoryItemIdens(self, termID):
+        return (row[0] for row in self.cur.execute("SELECT item_id FROM term_relationships WHERE term_id = ?", (termID,)))
+
+    def upsertFileStates(self, states):
+        ## states are (item_id, file_size, file_mtime_ns, file_inode) rows, with NULLs for a missing file.
+        self.cur.executemany("INSERT INTO file_state (item_id, file_size, file_mtime_ns, file_inode, checked_at) "
+                             "VALUES (?, ?, ?, ?, strftime('%s', 'now')) ON CONFLICT (item_id) DO UPDATE SET "
+                             "file_size = excluded.file_size, file_mtime_ns = excluded.file_mtime_ns, "
+                             "file_inode = excluded.file_inode, checked_at = excluded.checked_at", states)
+
+    def selectItemsWithoutFileState(self):
+        return self.cur.execute("SELECT i.item_id, ty.noun_name, i.item_ext FROM {} "
+                                "WHERE i.item_id NOT IN (SELECT item_id FROM file_state)".format(self.itemTables)).fetchall()
+
+    def selectTotalFileSize(self):
+        return self.cur.execute("SELECT COALESCE(SUM(file_size), 0) FROM file_state").fetchone()[0]
+
+    def selectCachedHash(self, device, inode, algorithm):
+        ## (file_size, file_mtime_ns, file_digest) recorded for a file, or None.
+        return self.cur.execute("SELECT file_size, file_mtime_ns, file_digest FROM hash_cache "
+                                "WHERE file_device = ? AND file_inode = ? AND hash_algorithm = ?",
+                                (device, inode, algorithm)).fetchone()
+
+    def upsertCachedHashes(self, hashes):
+        ## hashes are (device, inode, algorithm, size, mtime_ns, digest) rows.
+        self.cur.executemany("INSERT INTO hash_cache (file_device, file_inode, hash_algorithm, file_size, file_mtime_ns, "
+                             "file_digest, checked_at) VALUES (?, ?, ?, ?, ?, ?, strftime('%s', 'now')) "
+                             "ON CONFLICT (file_device, file_inode, hash_algorithm) DO UPDATE "
+                             "SET file_size = excluded.file_size, file_mtime_ns = excluded.file_mtime_ns, "
+                             "file_digest = excluded.file_digest, checked_at = excluded.checked_at", hashes)
+
+    def selectDigestAlgorithms(self):
+        ## The algorithms of the item digests, from the "algorithm:" tag, md5 for untagged ones.
+        return [row[0] for row in self.cur.execute(
+            "SELECT DISTINCT CASE WHEN instr(item_md5, ':') THEN substr(item_md5, 1, instr(item_md5, ':') - 1) "
+            "ELSE 'md5' END FROM items WHERE item_md5 IS NOT NULL")]
+
+    def deleteStaleHashes(self):
+        ## Drops the hashes of files that are no longer item files, such as import sources.
+        self.cur.execute("DELETE FROM hash_cache WHERE file_inode NOT IN "
+                         "(SELECT file_inode FROM file_state WHERE file_inode IS NOT NULL)")
+
+    def recountTerms(self):
+        ## term_count is kept current by triggers on term_relationships; this rebuilds every count at once.
+        counts = "SELECT term_id, COUNT(*) AS term_count FROM term_relationships GROUP BY term_id"
+        if sqlite3.sqlite_version_info >= (3, 33, 0):
+            self.cur.execute("UPDATE terms SET term_count = 0 "
+                             "WHERE term_count != 0 AND term_id NOT IN (SELECT term_id FROM term_relationships)")
+            self.cur.execute("UPDATE terms SET term_count = counts.term_count FROM ({}) AS counts "
+                             "WHERE terms.term_id = counts.term_id "
+                             "AND terms.term_count != counts.term_count".format(counts))
+        else:
+            self.cur.execute("UPDATE terms SET term_count = COALESCE((SELECT counts.term_count FROM ({}) AS counts "
+                             "WHERE counts.term_id = terms.term_id), 0)".format(counts))
         return True
 
-    def decrementTermCount(self, catid):
-        self.cur.execute("UPDATE terms SET term_count = term_count - 1 "
-                  "WHERE term_id = '{}'".format(catid))
+    def recountItemRelations(self):
+        ## item_relation_count is kept current by triggers on term_relationships; this rebuilds every count at once.
+        self.cur.execute("UPDATE items SET item_relation_count = (SELECT COUNT(*) FROM term_relationships AS tr "
+                         "WHERE tr.item_id = items.item_id)")
         return True
 
     def checkRelation(self, itemID, termID):
         query = self.cur.execute("SELECT * FROM term_relationships AS tr "
-                          "WHERE (tr.item_id = '{}') AND (tr.term_id = '{}')".format(itemID, termID))
+                                 "WHERE (tr.item_id = ?) AND (tr.term_id = ?)", (itemID, termID))
         return query
 
     def insertOption(self, option, value):
@@ -642,10 +1009,10 @@ class Database:
         if self.config['type'] == 'sqlite':
             SQL = "INSERT OR REPLACE INTO options (option_id, option_name, option_value) \n" \
                   "SELECT old.option_id, new.option_name, new.option_value \n" \
-                  "FROM ( SELECT '{}' AS option_name, '{}' AS option_value ) AS new \n" \
+                  "FROM ( SELECT ? AS option_name, ? AS option_value ) AS new \n" \
                   "LEFT JOIN ( SELECT option_id, option_name, option_value FROM options ) AS old \n" \
-                  "ON new.option_name = old.option_name;".format(option, value)
-            self.cur.execute(SQL)
+                  "ON new.option_name = old.option_name;"
+            self.cur.execute(SQL, (option, value))
         # self.logger.debug('\n'+SQL)
         return True
 
@@ -658,10 +1025,11 @@ class Database:
             if self.config['type'] == 'sqlite':
                 SQL = "INSERT INTO item_types (noun_name, plural_name, dir_name, " \
                       "table_name, enabled, extensions) \n" \
-                      "VALUES('{0}', '{1}', '{2}', '{3}', '{4}', '{5}')" \
-                    .format(data['noun_name'], data['plural_name'], data['dir_name'], data['table_name'],
-                            data['enabled'], data['extensions'])
-                self.cur.execute(SQL)
+                      "VALUES(?, ?, ?, ?, ?, ?) \n" \
+                      "ON CONFLICT (table_name, noun_name) DO UPDATE SET plural_name = excluded.plural_name, " \
+                      "dir_name = excluded.dir_name, enabled = excluded.enabled, extensions = excluded.extensions"
+                self.cur.execute(SQL, (data['noun_name'], data['plural_name'], data['dir_name'], data['table_name'],
+                                       data['enabled'], data['extensions']))
             # self.logger.debug('\n'+SQL)
             return True
 
@@ -674,21 +1042,19 @@ class Database:
             if self.config['type'] == 'sqlite':
                 SQL = "INSERT INTO taxonomies (noun_name, plural_name, dir_name, " \
                       "table_name, enabled, has_children, is_tags, colour) \n" \
-                      "VALUES('{0}', '{1}', '{2}', '{3}', '{4}', '{5}', '{6}', '{7}')" \
-                    .format(data['noun_name'], data['plural_name'], data['dir_name'], data['table_name'],
-                            data['enabled'], data['has_children'], data['is_tags'], data['colour'])
-                self.cur.execute(SQL)
+                      "VALUES(?, ?, ?, ?, ?, ?, ?, ?)"
+                self.cur.execute(SQL, (data['noun_name'], data['plural_name'], data['dir_name'], data['table_name'],
+                                       data['enabled'], data['has_children'], data['is_tags'], data['colour']))
             # self.logger.debug('\n'+SQL)
             return True
 
     def deleteAllData(self):
-        query = QSqlQuery(self.con)
-        query.exec_("DELETE FROM items;")
-        query.exec_("DELETE FROM terms;")
-        query.exec_("DELETE FROM term_relationships;")
+        self.cur.execute("DELETE FROM items;")
+        self.cur.execute("DELETE FROM terms;")
+        self.cur.execute("DELETE FROM term_relationships;")
 
-        query.exec_("UPDATE SQLITE_SEQUENCE SET seq = 0 WHERE name = 'terms';")
-        query.exec_("UPDATE SQLITE_SEQUENCE SET seq = 0 WHERE name = 'items';")
+        self.cur.execute("UPDATE SQLITE_SEQUENCE SET seq = 0 WHERE name = 'terms';")
+        self.cur.execute("UPDATE SQLITE_SEQUENCE SET seq = 0 WHERE name = 'items';")
         self.logger.debug("Data successfully deleted.")
         return True
 
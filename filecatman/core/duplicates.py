@@ -0,0 +1,42 @@
+import os
+from filecatman.core.hashing import FileHasher
+
+
+class DuplicateFinder:
+    ## Finds files with the same content in stages, each one reading only the files the one before couldn't
+    ## tell apart: sizes from a stat, then a digest of samples from the head, middle and tail of larger files
+    ## of the same size, then full digests, through the hash cache, of the files still colliding. Each file is
+    ## stat'ed once and read at most once in full, instead of compared byte for byte with every other.
+    ## Files smaller than `sampleMinSize` are hashed whole straight away, which costs about as much as sampling.
+    sampleMinSize = 1024 * 1024
+
+    def __init__(self, hashCache, jobs=None):
+        self.hashCache = hashCache
+        self.jobs = jobs
+
+    def clusters(self, files):
+        ## files are (key, file path) pairs; missing files are skipped. Returns (digest, keys) for each set of
+        ## two or more files with the same content, with the keys and the sets in the order the files came.
+        sizeGroups = dict()
+        for position, (key, filePath) in enumerate(files):
+            try: fileSize = os.stat(filePath).st_size
+            except OSError: continue
+            sizeGroups.setdefault(fileSize, list()).append((position, key, filePath, fileSize))
+
+        candidates, sampleTasks = list(), list()
+        for group in sizeGroups.values():
+            if len(group) < 2: continue
+            if group[0][3] < self.sampleMinSize: candidates.extend(group)
+            else: sampleTasks.extend((entry, entry[2], 3 * FileHasher.sampleSize, "blake2b", None) for entry in group)
+        sampleGroups = dict()
+        for entry, sample in FileHasher(self.jobs).hashFiles(sampleTasks, FileHasher.sampleFile):
+            sampleGroups.setdefault(sample, list()).append(entry)
+        for group in sampleGroups.values():
+            if len(group) > 1: candidates.extend(group)
+        candidates.sort()
+
+        digestGroups = dict()
+        for entry, digest in self.hashCache.digestFiles(((entry, entry[2]) for entry in candidates), jobs=self.jobs):
+            digestGroups.setdefault((entry[3], digest), list()).append(entry)
+        return [(digest, [entry[1] for entry in group]) for (fileSize, digest), group in
+                sorted(digestGroups.items(), key=lambda item: item[1][0][0]) if len(group) > 1]
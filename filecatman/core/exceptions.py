@@ -3,4 +3,6 @@ class FCM_NoDatabaseFile(Exception):
     #No Database File Inputted
     pass
 
-
+class FCM_QuerySyntaxError(Exception):
+    #Search Query Could Not Be Parsed
+    pass
@@ -18,6 +18,18 @@ def chunks(lst, n):
         chunkList.append(lst[i:i + n])
     return chunkList
 
+def reservoirSample(iterable, size, rng):
+    """Return up to size random elements of iterable in random order, holding only size of them in memory."""
+    sample = list()
+    for index, element in enumerate(iterable):
+        if index < size:
+            sample.append(element)
+        else:
+            slot = rng.randrange(index + 1)
+            if slot < size: sample[slot] = element
+    rng.shuffle(sample)
+    return sample
+
 def createLink(filePath, linkPath, overwriteLinks=False):
     linkDir = os.path.dirname(linkPath)
     if not os.path.exists(linkDir): os.makedirs(linkDir)
@@ -204,12 +216,8 @@ def printProgressBar(progress, barLength=40, progressMessage="Progress", status=
     elif progress == 1: print(progressMessage+": Done")
 
 def getMD5FromFile(filePath):
-    import hashlib
-    md5_hash = hashlib.md5()
-    with open(filePath, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            md5_hash.update(byte_block)
-        return md5_hash.hexdigest()
+    from filecatman.core.hashing import FileHasher
+    return FileHasher.hashFile(filePath, "md5")
 
 def uploadFile(config, fileSource, fileDestination, fileType=None):
     baseFilename = os.path.basename(fileSource)
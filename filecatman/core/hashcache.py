@@ -0,0 +1,91 @@
+import logging
+import os
+import sqlite3
+import time
+from filecatman.core.hashing import FileHasher, hashAlgorithms, defaultHashAlgorithm
+
+
+class HashCache:
+    ## Digests of files, stored in hash_cache against the file's device, inode and the algorithm, along with the
+    ## size and modification time the file had when it was read. A file whose stat still matches isn't read
+    ## again, so a rename, a category change or a synch over unchanged files costs one stat per file.
+    ## Files modified within the last `racyWindow` seconds aren't cached: a write in the same timestamp tick
+    ## after the read would leave the stat unchanged.
+    racyWindow = 2
+    batchSize = 500
+
+    def __init__(self, db):
+        self.db = db
+        self.logger = logging.getLogger(self.__class__.__name__)
+        ## The algorithm new digests are made with, from the hash_algorithm option.
+        self.algorithm = defaultHashAlgorithm
+
+    def setAlgorithm(self, algorithm):
+        if algorithm not in hashAlgorithms:
+            if algorithm: self.logger.warning("Unknown hash algorithm: "+str(algorithm))
+            algorithm = defaultHashAlgorithm
+        self.algorithm = algorithm
+        return algorithm
+
+    def digest(self, filepath, algorithm=None):
+        [(key, digest)] = self.digestFiles(((filepath, filepath),), algorithm, jobs=1)
+        return digest
+
+    def digests(self, filepath, algorithms):
+        ## The digests of one file in each of the algorithms, in order. Those not cached are made together
+        ## from a single read of the file.
+        fileStats, digests = os.stat(filepath), dict()
+        if fileStats.st_ino:
+            for algorithm in algorithms:
+                cached = self.db.selectCachedHash(fileStats.st_dev, fileStats.st_ino, algorithm)
+                if cached and cached[0] == fileStats.st_size and cached[1] == fileStats.st_mtime_ns:
+                    digests[algorithm] = cached[2]
+        missing = [algorithm for algorithm in dict.fromkeys(algorithms) if algorithm not in digests]
+        if missing:
+            digests.update(zip(missing, FileHasher.hashFileMulti(filepath, missing)))
+            if self.cacheable(fileStats):
+                self.store([(fileStats.st_dev, fileStats.st_ino, algorithm, fileStats.st_size, fileStats.st_mtime_ns,
+                             digests[algorithm]) for algorithm in missing])
+        return [digests[algorithm] for algorithm in algorithms]
+
+    def cacheable(self, fileStats):
+        return fileStats.st_ino and time.time_ns() - fileStats.st_mtime_ns >= self.racyWindow * 1000000000
+
+    def digestFiles(self, files, algorithm=None, jobs=None):
+        ## files are (key, file path) pairs, and algorithm a name, or a function of the key to check each file
+        ## with its own; by default the configured one. Yields (key, digest) pairs in the same order. Files
+        ## whose stat changed are read on a FileHasher's threads, while the stats, lookups and hash_cache
+        ## writes stay on this thread, the writes batched.
+        algorithmOf = algorithm if callable(algorithm) else lambda key: algorithm or self.algorithm
+
+        def tasks():
+            for key, filepath in files:
+                fileStats, fileAlgorithm = os.stat(filepath), algorithmOf(key)
+                digest = None
+                ## Some filesystems have no inode numbers; their files are always read.
+                if fileStats.st_ino:
+                    cached = self.db.selectCachedHash(fileStats.st_dev, fileStats.st_ino, fileAlgorithm)
+                    if cached and cached[0] == fileStats.st_size and cached[1] == fileStats.st_mtime_ns:
+                        digest = cached[2]
+                yield (key, fileStats, fileAlgorithm, digest is None), filepath, fileStats.st_size, fileAlgorithm, digest
+
+        newHashes = list()
+        try:
+            for (key, fileStats, fileAlgorithm, read), digest in FileHasher(jobs).hashFiles(tasks()):
+                if read and self.cacheable(fileStats):
+                    newHashes.append((fileStats.st_dev, fileStats.st_ino, fileAlgorithm, fileStats.st_size,
+                                      fileStats.st_mtime_ns, digest))
+                    if len(newHashes) >= self.batchSize:
+                        self.store(newHashes)
+                        newHashes = list()
+                yield key, digest
+        finally:
+            self.store(newHashes)
+
+    def store(self, newHashes):
+        if not newHashes: return
+        try:
+            self.db.upsertCachedHashes(newHashes)
+        except sqlite3.OperationalError as e:
+            ## A read-only or busy database still returns the digests.
+            self.logger.debug("Hashes not cached: {}".format(e))
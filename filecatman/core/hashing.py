@@ -0,0 +1,112 @@
+import hashlib
+import mmap
+import os
+from collections import deque
+
+## Digest algorithms by option name. An md5 digest is stored as plain hex as it always was; the others are tagged
+## "algorithm:hex", so items hashed before a change of algorithm keep validating against their own.
+hashAlgorithms = dict(md5=hashlib.md5, sha256=hashlib.sha256, blake2b=hashlib.blake2b)
+defaultHashAlgorithm = "md5"
+
+
+def taggedDigest(algorithm, hexDigest):
+    return hexDigest if algorithm == "md5" else algorithm + ":" + hexDigest
+
+
+def digestAlgorithm(digest):
+    ## The algorithm of a stored digest, md5 for an untagged one.
+    if digest and ":" in digest:
+        algorithm = digest.split(":", 1)[0]
+        if algorithm in hashAlgorithms: return algorithm
+    return "md5"
+
+
+class FileHasher:
+    ## Hashes many files on a pool of threads. hashlib releases the GIL while it digests a block, so reads and
+    ## digests of different files run in parallel. Results come back in the order the files were given, and
+    ## the files being read at once are limited to `maxInFlightBytes`, or one file if it is larger.
+    ## Files are read into one reused buffer of `blockSize`, or memory-mapped from `mmapMinSize`, with the
+    ## kernel told the reads are sequential.
+    blockSize = 4 * 1024 * 1024
+    sampleSize = 64 * 1024
+    mmapMinSize = 64 * 1024 * 1024
+    maxInFlightBytes = 256 * 1024 * 1024
+
+    def __init__(self, jobs=None):
+        self.jobs = jobs or os.cpu_count() or 1
+
+    @classmethod
+    def hashFile(cls, filePath, algorithm=defaultHashAlgorithm):
+        return cls.hashFileMulti(filePath, (algorithm,))[0]
+
+    @classmethod
+    def hashFileMulti(cls, filePath, algorithms):
+        ## The tagged digests of a file in each of the algorithms, in order, from one read of it.
+        fileHashes = [hashAlgorithms[algorithm]() for algorithm in algorithms]
+        with open(filePath, "rb", buffering=0) as f:
+            fileSize = os.fstat(f.fileno()).st_size
+            if hasattr(os, "posix_fadvise"):
+                try: os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                except OSError: pass
+            if fileSize >= cls.mmapMinSize:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    if hasattr(mapped, "madvise"): mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(mapped) as view:
+                        for start in range(0, len(view), cls.blockSize):
+                            with view[start:start + cls.blockSize] as block:
+                                for fileHash in fileHashes: fileHash.update(block)
+            else:
+                buffer = bytearray(min(cls.blockSize, max(fileSize, 1)))
+                with memoryview(buffer) as view:
+                    while True:
+                        length = f.readinto(buffer)
+                        if not length: break
+                        for fileHash in fileHashes: fileHash.update(view[:length])
+        return [taggedDigest(algorithm, fileHash.hexdigest()) for algorithm, fileHash in zip(algorithms, fileHashes)]
+
+    @classmethod
+    def sampleFile(cls, filePath, algorithm="blake2b"):
+        ## A digest of the size and of `sampleSize` bytes from the head, the middle and the tail of a file, which
+        ## tells most files of the same size apart without reading them whole.
+        fileHash = hashAlgorithms[algorithm]()
+        with open(filePath, "rb") as f:
+            fileSize = os.fstat(f.fileno()).st_size
+            fileHash.update(str(fileSize).encode())
+            for offset in sorted({0, max(fileSize // 2 - cls.sampleSize // 2, 0), max(fileSize - cls.sampleSize, 0)}):
+                f.seek(offset)
+                fileHash.update(f.read(cls.sampleSize))
+        return fileHash.hexdigest()
+
+    def hashFiles(self, tasks, hashFunction=None):
+        ## tasks are (key, file path, file size, algorithm, digest) tuples; a task with a digest, such as a cached
+        ## one, isn't read. Yields (key, digest) pairs in task order. A file that can't be read raises its OSError
+        ## when its turn comes. hashFunction(file path, algorithm) replaces hashFile, e.g. with sampleFile.
+        hashFunction = hashFunction or self.hashFile
+        if self.jobs < 2:
+            for key, filePath, fileSize, algorithm, digest in tasks:
+                yield key, digest or hashFunction(filePath, algorithm)
+            return
+        from concurrent.futures import ThreadPoolExecutor, Future
+        pool = ThreadPoolExecutor(max_workers=self.jobs)
+        pending, inFlight = deque(), 0
+        try:
+            for key, filePath, fileSize, algorithm, digest in tasks:
+                if digest is None:
+                    while pending and (inFlight + fileSize > self.maxInFlightBytes or len(pending) >= self.jobs * 4):
+                        key2, fileSize2, result = pending.popleft()
+                        inFlight -= fileSize2
+                        yield key2, result.result() if isinstance(result, Future) else result
+                    pending.append((key, fileSize, pool.submit(hashFunction, filePath, algorithm)))
+                    inFlight += fileSize
+                else: pending.append((key, 0, digest))
+                ## Finished results at the front are handed on without waiting for the window to fill.
+                while pending and not (isinstance(pending[0][2], Future) and not pending[0][2].done()):
+                    key2, fileSize2, result = pending.popleft()
+                    inFlight -= fileSize2
+                    yield key2, result.result() if isinstance(result, Future) else result
+            while pending:
+                key, fileSize, result = pending.popleft()
+                yield key, result.result() if isinstance(result, Future) else result
+        finally:
+            ## A consumer that stops early, like --first, leaves no files queued behind it.
+            pool.shutdown(wait=True, cancel_futures=True)
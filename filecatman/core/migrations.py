@@ -0,0 +1,332 @@
+import json
+import logging
+
+
+class Statements:
+    ## Schema changes applied together in one transaction.
+    ## `estimate` returns the rows the statements touch, e.g. those an index is built over.
+    def __init__(self, description, *sql, estimate=None, when=None):
+        self.description = description
+        self.sql = sql
+        self.estimateFunction = estimate
+        self.when = when
+
+    def estimate(self, db, key=None):
+        if self.estimateFunction: return self.estimateFunction(db)
+        return 0
+
+    def run(self, db, key=None, chunkSize=None):
+        ## Python's sqlite3 doesn't open a transaction for DDL, so one is begun here; the Migrator commits it
+        ## together with the step's progress.
+        began = not db.con.in_transaction
+        if began: db.cur.execute("BEGIN")
+        try:
+            for sql in self.sql:
+                db.cur.execute(sql)
+        except BaseException:
+            if began: db.con.rollback()
+            raise
+        yield from ()
+
+
+class Backfill:
+    ## A data change applied in chunks of `key` ranges. `sql` contains a {range} placeholder that is
+    ## replaced with a bounded key condition; after each chunk the last key is saved so an interrupted
+    ## backfill resumes where it stopped.
+    def __init__(self, description, table, sql, key="rowid", when=None):
+        self.description = description
+        self.table = table
+        self.sql = sql
+        self.key = key
+        self.when = when
+
+    def estimate(self, db, key=None):
+        return db.cur.execute("SELECT COUNT(*) FROM {} WHERE {} > ?".format(self.table, self.key),
+                              (key or 0,)).fetchone()[0]
+
+    def run(self, db, key=None, chunkSize=5000):
+        lastKey = key or 0
+        total = self.estimate(db, lastKey)
+        done = 0
+        while True:
+            upperKey = db.cur.execute("SELECT {1} FROM {0} WHERE {1} > ? ORDER BY {1} LIMIT 1 OFFSET ?"
+                                      .format(self.table, self.key), (lastKey, chunkSize - 1)).fetchone()
+            if upperKey: upperKey = upperKey[0]
+            else:
+                upperKey = db.cur.execute("SELECT MAX({1}) FROM {0} WHERE {1} > ?"
+                                          .format(self.table, self.key), (lastKey,)).fetchone()[0]
+                if upperKey is None: return
+            db.cur.execute(self.sql.format(range="{0} > ? AND {0} <= ?".format(self.key)), (lastKey, upperKey))
+            done += min(chunkSize, total - done)
+            db.logger.info("{}: {}/{} rows".format(self.description, done, total))
+            lastKey = upperKey
+            yield lastKey
+
+
+class Callback:
+    ## A step implemented in Python, called with the Database. `estimate` returns the rows it touches.
+    def __init__(self, description, function, estimate=None, when=None):
+        self.description = description
+        self.function = function
+        self.estimateFunction = estimate
+        self.when = when
+
+    def estimate(self, db, key=None):
+        if self.estimateFunction: return self.estimateFunction(db)
+        return 0
+
+    def run(self, db, key=None, chunkSize=None):
+        self.function(db)
+        yield from ()
+
+
+class Migration:
+    def __init__(self, version, description, *steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+
+def countRows(table):
+    return lambda db: db.cur.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+
+
+def swapTables(db, *tables):
+    ## Replaces each table with its `<table>_compact` rebuild. Foreign keys are off while the old tables are
+    ## dropped so their cascades don't fire. The full-text triggers are recreated here; the migration's next
+    ## step recreates the other indexes and triggers dropped with the tables.
+    db.commit()
+    db.cur.execute("PRAGMA foreign_keys = OFF")
+    db.cur.execute("BEGIN")
+    for table in tables:
+        if not db.tableExists(table+"_compact"): continue
+        sequence = db.cur.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+        db.cur.execute("DROP TABLE `{}`".format(table))
+        db.cur.execute("ALTER TABLE `{0}_compact` RENAME TO `{0}`".format(table))
+        if sequence:
+            db.cur.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence[0], table))
+    db.commit()
+    if db.tableExists('items_fts'): db.createFullTextIndex()
+    db.cur.execute("PRAGMA foreign_keys = ON")
+    for violation in db.cur.execute("PRAGMA foreign_key_check").fetchall():
+        db.logger.warning("Foreign key violation after rebuild: {}".format(violation))
+
+
+## Indexed item columns and the category item count triggers, created by migrations 1 and 2 and again after
+## migration 5 rebuilds the tables they belong to.
+itemIndexColumns = ('item_md5', 'item_time', 'item_creation_time', 'item_ext', 'item_primary_category')
+termCountTriggers = (
+    "CREATE TRIGGER IF NOT EXISTS `term_relationships_insert_count` "
+    "AFTER INSERT ON `term_relationships` BEGIN "
+    "UPDATE `terms` SET `term_count` = `term_count` + 1 WHERE `term_id` = NEW.`term_id`; END",
+    "CREATE TRIGGER IF NOT EXISTS `term_relationships_delete_count` "
+    "AFTER DELETE ON `term_relationships` BEGIN "
+    "UPDATE `terms` SET `term_count` = `term_count` - 1 WHERE `term_id` = OLD.`term_id`; END",
+    "CREATE TRIGGER IF NOT EXISTS `term_relationships_update_count` "
+    "AFTER UPDATE OF `term_id` ON `term_relationships` BEGIN "
+    "UPDATE `terms` SET `term_count` = `term_count` - 1 WHERE `term_id` = OLD.`term_id`; "
+    "UPDATE `terms` SET `term_count` = `term_count` + 1 WHERE `term_id` = NEW.`term_id`; END"
+)
+
+
+## Every schema change after the original six tables, oldest first. newsqlitedatabase.sql and the query files
+## createTables runs after it always hold the latest schema, so a new database starts at the last version here.
+migrations = (
+    Migration(1, "Maintain category item counts with triggers",
+              Statements("Create term_count triggers", *termCountTriggers),
+              Callback("Recount category items", lambda db: db.recountTerms(), countRows("terms"))),
+    Migration(2, "Index item md5, times, extension and primary category",
+              *(Statements("Create index `{}`".format(column),
+                           "CREATE INDEX IF NOT EXISTS `{0}` ON `items` (`{0}`)".format(column),
+                           estimate=countRows("items"))
+                for column in itemIndexColumns)),
+    Migration(3, "Full-text index of item name, source and description",
+              Callback("Create items_fts table and triggers", lambda db: db.createFullTextIndex()),
+              Backfill("Index item text", "items",
+                       "INSERT INTO items_fts (rowid, item_name, item_source, item_description) "
+                       "SELECT item_id, fcm_unquote(item_name), fcm_unquote(item_source), fcm_unquote(item_description) "
+                       "FROM items WHERE {range} AND item_id NOT IN (SELECT rowid FROM items_fts)",
+                       key="item_id", when=lambda db: db.fullTextAvailable())),
+    Migration(4, "Store item and category text unquoted, with case-insensitive name indexes",
+              Statements("Drop items_fts triggers that unquote",
+                         "DROP TRIGGER IF EXISTS `items_fts_insert`",
+                         "DROP TRIGGER IF EXISTS `items_fts_update`"),
+              Callback("Recreate items_fts triggers", lambda db: db.createFullTextIndex(),
+                       when=lambda db: db.tableExists('items_fts')),
+              Backfill("Unquote item name, source and description", "items",
+                       "UPDATE items SET item_name = fcm_unquote(item_name), item_source = fcm_unquote(item_source), "
+                       "item_description = fcm_unquote(item_description) WHERE {range}", key="item_id"),
+              Backfill("Unquote category name and description", "terms",
+                       "UPDATE terms SET term_name = fcm_unquote(term_name), "
+                       "term_description = fcm_unquote(term_description) WHERE {range}", key="term_id"),
+              Statements("Create case-insensitive name indexes",
+                         "CREATE INDEX IF NOT EXISTS `item_name_nocase` ON `items` (`item_name` COLLATE NOCASE)",
+                         "CREATE INDEX IF NOT EXISTS `term_name_nocase` ON `terms` (`term_name` COLLATE NOCASE)",
+                         estimate=lambda db: countRows("items")(db) + countRows("terms")(db))),
+    Migration(5, "Compact layout: item type ids, epoch item times and WITHOUT ROWID relations",
+              Statements("Register item types used by items",
+                         "INSERT INTO item_types (noun_name, plural_name, dir_name, table_name, enabled, extensions) "
+                         "SELECT DISTINCT type_id, type_id, type_id, lower(type_id), 1, '' FROM items "
+                         "WHERE type_id NOT IN (SELECT noun_name FROM item_types)"),
+              Statements("Create compact items table",
+                         "CREATE TABLE IF NOT EXISTS `items_compact` ("
+                         "`item_id` INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, `item_name` TEXT NOT NULL, "
+                         "`type_id` INTEGER NOT NULL, `item_ext` TEXT DEFAULT (''), `item_source` TEXT DEFAULT (''), "
+                         "`item_time` INTEGER NULL default NULL, `item_creation_time` INTEGER NULL default NULL, "
+                         "`item_description` TEXT DEFAULT (''), `item_primary_category` INTEGER NULL default NULL, "
+                         "`item_md5` TEXT DEFAULT (''), `item_relation_count` INTEGER NOT NULL default 0, "
+                         "FOREIGN KEY (`type_id`) REFERENCES item_types(`type_id`), "
+                         "FOREIGN KEY (`item_primary_category`) REFERENCES terms(`term_id`) ON DELETE SET NULL)"),
+              Backfill("Copy items with type ids and epoch times", "items",
+                       "INSERT INTO items_compact (item_id, item_name, type_id, item_ext, item_source, item_time, "
+                       "item_creation_time, item_description, item_primary_category, item_md5) SELECT item_id, item_name, "
+                       "(SELECT it.type_id FROM item_types AS it WHERE it.noun_name = items.type_id), item_ext, "
+                       "item_source, CAST(strftime('%s', item_time, 'utc') AS INTEGER), "
+                       "CAST(strftime('%s', item_creation_time, 'utc') AS INTEGER), item_description, "
+                       "item_primary_category, item_md5 FROM items WHERE {range}", key="item_id"),
+              Statements("Create WITHOUT ROWID relations table",
+                         "CREATE TABLE IF NOT EXISTS `term_relationships_compact` ("
+                         "`item_id` INTEGER NOT NULL, `term_id` INTEGER NOT NULL, PRIMARY KEY (`item_id`,`term_id`), "
+                         "FOREIGN KEY (`item_id`) REFERENCES items(`item_id`) ON DELETE CASCADE, "
+                         "FOREIGN KEY (`term_id`) REFERENCES terms(`term_id`) ON DELETE CASCADE) WITHOUT ROWID"),
+              Backfill("Copy relations", "term_relationships",
+                       "INSERT INTO term_relationships_compact SELECT item_id, term_id FROM term_relationships "
+                       "WHERE {range}"),
+              Callback("Swap in the compact tables",
+                       lambda db: swapTables(db, 'items', 'term_relationships')),
+              Statements("Recreate item and relation indexes and triggers",
+                         "CREATE INDEX IF NOT EXISTS `type_id` ON `items` (`type_id`)",
+                         *("CREATE INDEX IF NOT EXISTS `{0}` ON `items` (`{0}`)".format(column)
+                           for column in itemIndexColumns),
+                         "CREATE INDEX IF NOT EXISTS `item_name_nocase` ON `items` (`item_name` COLLATE NOCASE)",
+                         "CREATE INDEX IF NOT EXISTS `term_id_item_id` ON `term_relationships` (`term_id`, `item_id`)",
+                         *termCountTriggers,
+                         estimate=lambda db: countRows("items")(db) + countRows("term_relationships")(db)),
+              Callback("Recount category items", lambda db: db.recountTerms(), countRows("terms"))),
+    Migration(6, "Category closure table for subcategory queries",
+              Callback("Create term_closure table and triggers", lambda db: db.createTermClosure()),
+              Backfill("Link categories to their ancestors", "terms",
+                       "INSERT OR IGNORE INTO term_closure (ancestor_id, descendant_id, depth) "
+                       "WITH RECURSIVE chain (ancestor_id, descendant_id, depth) AS ("
+                       "SELECT term_id, term_id, 0 FROM terms WHERE {range} "
+                       "UNION ALL "
+                       "SELECT t.term_parent, chain.descendant_id, chain.depth + 1 FROM chain "
+                       "INNER JOIN terms AS t ON (t.term_id = chain.ancestor_id) "
+                       "WHERE t.term_parent IS NOT NULL AND chain.depth < 1000) "
+                       "SELECT ancestor_id, descendant_id, depth FROM chain", key="term_id")),
+    Migration(7, "Per-item relation counts",
+              ## Databases rebuilt by migration 5 after this version was added already have the column.
+              Statements("Add item_relation_count column",
+                         "ALTER TABLE `items` ADD COLUMN `item_relation_count` INTEGER NOT NULL default 0",
+                         when=lambda db: not db.columnExists('items', 'item_relation_count')),
+              Statements("Create item_relation_count index and triggers",
+                         "CREATE INDEX IF NOT EXISTS `item_relation_count` ON `items` (`item_relation_count`)",
+                         "CREATE TRIGGER IF NOT EXISTS `term_relationships_insert_item_count` "
+                         "AFTER INSERT ON `term_relationships` BEGIN "
+                         "UPDATE `items` SET `item_relation_count` = `item_relation_count` + 1 "
+                         "WHERE `item_id` = NEW.`item_id`; END",
+                         "CREATE TRIGGER IF NOT EXISTS `term_relationships_delete_item_count` "
+                         "AFTER DELETE ON `term_relationships` BEGIN "
+                         "UPDATE `items` SET `item_relation_count` = `item_relation_count` - 1 "
+                         "WHERE `item_id` = OLD.`item_id`; END",
+                         "CREATE TRIGGER IF NOT EXISTS `term_relationships_update_item_count` "
+                         "AFTER UPDATE OF `item_id` ON `term_relationships` BEGIN "
+                         "UPDATE `items` SET `item_relation_count` = `item_relation_count` - 1 "
+                         "WHERE `item_id` = OLD.`item_id`; "
+                         "UPDATE `items` SET `item_relation_count` = `item_relation_count` + 1 "
+                         "WHERE `item_id` = NEW.`item_id`; END",
+                         estimate=countRows("items")),
+              Backfill("Count item relations", "items",
+                       "UPDATE items SET item_relation_count = (SELECT COUNT(*) FROM term_relationships AS tr "
+                       "WHERE tr.item_id = items.item_id) WHERE {range}", key="item_id")),
+    Migration(8, "Search result cache",
+              Callback("Create search_cache table and data_generation triggers", lambda db: db.createSearchCache())),
+    Migration(9, "Saved search result sets",
+              Callback("Create result_sets and result_set_items tables", lambda db: db.createResultSets())),
+    Migration(10, "Category bitmap index",
+              Callback("Create term_bitmaps table and triggers", lambda db: db.createTermBitmaps())),
+    ## Items without a file_state row are stat'ed the first time a search needs their size or file date.
+    Migration(11, "File size and modification time table",
+              Callback("Create file_state table", lambda db: db.createFileState())),
+    Migration(12, "File hash cache",
+              Callback("Create hash_cache table", lambda db: db.createHashCache())),
+    ## The hash cache only holds digests that can be read again, so it is rebuilt rather than converted.
+    Migration(13, "Hash algorithm in the file hash cache",
+              Statements("Drop the MD5-only hash_cache table", "DROP TABLE IF EXISTS hash_cache"),
+              Callback("Create hash_cache table with hash_algorithm", lambda db: db.createHashCache())),
+)
+
+
+class Migrator:
+    chunkSize = 5000
+    versionOption = "schema_version"
+    stateOption = "migration_state"
+
+    def __init__(self, db):
+        self.db = db
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def currentVersion(self):
+        version = self.db.selectOption(self.versionOption)
+        return int(version) if version else 0
+
+    def latestVersion(self):
+        return migrations[-1].version if migrations else 0
+
+    def skipped(self, step):
+        ## Steps with a `when` condition only run where it holds, e.g. when an SQLite extension is available.
+        return step.when is not None and not step.when(self.db)
+
+    def pending(self):
+        currentVersion = self.currentVersion()
+        return [migration for migration in migrations if migration.version > currentVersion]
+
+    def markCurrent(self):
+        self.db.insertOption(self.versionOption, str(self.latestVersion()))
+        self.db.commit()
+
+    def readState(self, migration):
+        ## Returns the step index and backfill key an interrupted run of this migration stopped at.
+        state = self.db.selectOption(self.stateOption)
+        if state:
+            state = json.loads(state)
+            if state['version'] == migration.version: return state['step'], state['key']
+        return 0, None
+
+    def saveState(self, migration, step, key):
+        self.db.insertOption(self.stateOption, json.dumps({'version': migration.version, 'step': step, 'key': key}))
+        self.db.commit()
+
+    def run(self):
+        for migration in self.pending():
+            self.logger.info("Migrating database to schema version {}: {}".format(
+                migration.version, migration.description))
+            startStep, startKey = self.readState(migration)
+            for stepIndex, step in enumerate(migration.steps):
+                if stepIndex < startStep: continue
+                key = startKey if stepIndex == startStep else None
+                if self.skipped(step):
+                    self.logger.debug("Skipped: "+step.description)
+                    continue
+                self.logger.debug(step.description)
+                for key in step.run(self.db, key, self.chunkSize):
+                    self.saveState(migration, stepIndex, key)
+                self.saveState(migration, stepIndex + 1, None)
+            self.db.insertOption(self.versionOption, str(migration.version))
+            self.db.cur.execute("DELETE FROM options WHERE option_name = ?", (self.stateOption,))
+            self.db.commit()
+        return True
+
+    def dryRun(self):
+        ## Lists the pending migrations and the rows each step would touch, without changing anything.
+        report = list()
+        for migration in self.pending():
+            startStep, startKey = self.readState(migration)
+            steps = list()
+            for stepIndex, step in enumerate(migration.steps):
+                if stepIndex < startStep: continue
+                key = startKey if stepIndex == startStep else None
+                if self.skipped(step): continue
+                steps.append((step.description, step.estimate(self.db, key)))
+            report.append((migration.version, migration.description, steps))
+        return report
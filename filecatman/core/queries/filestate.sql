@@ -0,0 +1,19 @@
+CREATE TABLE IF NOT EXISTS `file_state` (
+	`item_id` INTEGER PRIMARY KEY NOT NULL,
+	`file_size` INTEGER NULL default NULL,
+	`file_mtime_ns` INTEGER NULL default NULL,
+	`file_inode` INTEGER NULL default NULL,
+	`checked_at` INTEGER NOT NULL,
+	FOREIGN KEY (`item_id`) REFERENCES items(`item_id`) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS `file_size` ON `file_state` (`file_size`);
+CREATE INDEX IF NOT EXISTS `file_mtime_ns` ON `file_state` (`file_mtime_ns`);
+CREATE TRIGGER IF NOT EXISTS `data_generation_file_state_insert` AFTER INSERT ON `file_state`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS `data_generation_file_state_update` AFTER UPDATE ON `file_state`
+WHEN OLD.`file_size` IS NOT NEW.`file_size` OR OLD.`file_mtime_ns` IS NOT NEW.`file_mtime_ns`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS `hash_cache` (
+	`file_device` INTEGER NOT NULL,
+	`file_inode` INTEGER NOT NULL,
+	`hash_algorithm` TEXT NOT NULL,
+	`file_size` INTEGER NOT NULL,
+	`file_mtime_ns` INTEGER NOT NULL,
+	`file_digest` TEXT NOT NULL,
+	`checked_at` INTEGER NOT NULL,
+	PRIMARY KEY (`file_device`, `file_inode`, `hash_algorithm`)
+) WITHOUT ROWID;
@@ -0,0 +1,21 @@
+CREATE VIRTUAL TABLE IF NOT EXISTS `items_fts` USING fts5(
+	`item_name`,
+	`item_source`,
+	`item_description`,
+	tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS `items_fts_insert` AFTER INSERT ON `items`
+BEGIN
+	INSERT INTO `items_fts` (`rowid`, `item_name`, `item_source`, `item_description`)
+	VALUES (NEW.`item_id`, NEW.`item_name`, NEW.`item_source`, NEW.`item_description`);
+END;
+CREATE TRIGGER IF NOT EXISTS `items_fts_delete` AFTER DELETE ON `items`
+BEGIN
+	DELETE FROM `items_fts` WHERE `rowid` = OLD.`item_id`;
+END;
+CREATE TRIGGER IF NOT EXISTS `items_fts_update` AFTER UPDATE OF `item_name`, `item_source`, `item_description` ON `items`
+BEGIN
+	UPDATE `items_fts` SET `item_name` = NEW.`item_name`, `item_source` = NEW.`item_source`,
+		`item_description` = NEW.`item_description`
+	WHERE `rowid` = NEW.`item_id`;
+END;
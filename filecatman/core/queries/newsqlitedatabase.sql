@@ -1,17 +1,26 @@
 CREATE TABLE IF NOT EXISTS `items` (
     `item_id` INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
     `item_name` TEXT NOT NULL,
-    `type_id` TEXT NOT NULL,
+    `type_id` INTEGER NOT NULL,
     `item_ext` TEXT DEFAULT (''),
     `item_source` TEXT DEFAULT (''),
-    `item_time` TEXT DEFAULT ('0000-00-00 00:00:00'),
-    `item_creation_time` TEXT DEFAULT ('0000-00-00 00:00:00'),
+    `item_time` INTEGER NULL default NULL,
+    `item_creation_time` INTEGER NULL default NULL,
     `item_description` TEXT DEFAULT (''),
     `item_primary_category` INTEGER NULL default NULL,
     `item_md5` TEXT DEFAULT (''),
+    `item_relation_count` INTEGER NOT NULL default 0,
+    FOREIGN KEY (`type_id`) REFERENCES item_types(`type_id`),
     FOREIGN KEY (`item_primary_category`) REFERENCES terms(`term_id`) ON DELETE SET NULL
 );
 CREATE INDEX IF NOT EXISTS `type_id` ON `items` (`type_id`);
+CREATE INDEX IF NOT EXISTS `item_md5` ON `items` (`item_md5`);
+CREATE INDEX IF NOT EXISTS `item_time` ON `items` (`item_time`);
+CREATE INDEX IF NOT EXISTS `item_creation_time` ON `items` (`item_creation_time`);
+CREATE INDEX IF NOT EXISTS `item_ext` ON `items` (`item_ext`);
+CREATE INDEX IF NOT EXISTS `item_primary_category` ON `items` (`item_primary_category`);
+CREATE INDEX IF NOT EXISTS `item_name_nocase` ON `items` (`item_name` COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS `item_relation_count` ON `items` (`item_relation_count`);
 
 CREATE TABLE IF NOT EXISTS `terms` (
 	`term_id` INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
@@ -24,6 +33,7 @@ CREATE TABLE IF NOT EXISTS `terms` (
 );
 CREATE UNIQUE INDEX IF NOT EXISTS `term_name_parent_taxonomy` ON `terms` (`term_name`, `term_parent`, `term_taxonomy`);
 CREATE INDEX IF NOT EXISTS `term_taxonomy` ON `terms` (`term_taxonomy`);
+CREATE INDEX IF NOT EXISTS `term_name_nocase` ON `terms` (`term_name` COLLATE NOCASE);
 
 CREATE TABLE IF NOT EXISTS `term_relationships` (
 	`item_id` INTEGER NOT NULL,
@@ -31,8 +41,34 @@ CREATE TABLE IF NOT EXISTS `term_relationships` (
 	PRIMARY KEY (`item_id`,`term_id`),
 	FOREIGN KEY (`item_id`) REFERENCES items(`item_id`) ON DELETE CASCADE,
 	FOREIGN KEY (`term_id`) REFERENCES terms(`term_id`) ON DELETE CASCADE
-);
-CREATE INDEX IF NOT EXISTS `term_id` ON `term_relationships` (`term_id`);
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS `term_id_item_id` ON `term_relationships` (`term_id`, `item_id`);
+CREATE TRIGGER IF NOT EXISTS `term_relationships_insert_count` AFTER INSERT ON `term_relationships`
+BEGIN
+	UPDATE `terms` SET `term_count` = `term_count` + 1 WHERE `term_id` = NEW.`term_id`;
+END;
+CREATE TRIGGER IF NOT EXISTS `term_relationships_delete_count` AFTER DELETE ON `term_relationships`
+BEGIN
+	UPDATE `terms` SET `term_count` = `term_count` - 1 WHERE `term_id` = OLD.`term_id`;
+END;
+CREATE TRIGGER IF NOT EXISTS `term_relationships_update_count` AFTER UPDATE OF `term_id` ON `term_relationships`
+BEGIN
+	UPDATE `terms` SET `term_count` = `term_count` - 1 WHERE `term_id` = OLD.`term_id`;
+	UPDATE `terms` SET `term_count` = `term_count` + 1 WHERE `term_id` = NEW.`term_id`;
+END;
+CREATE TRIGGER IF NOT EXISTS `term_relationships_insert_item_count` AFTER INSERT ON `term_relationships`
+BEGIN
+	UPDATE `items` SET `item_relation_count` = `item_relation_count` + 1 WHERE `item_id` = NEW.`item_id`;
+END;
+CREATE TRIGGER IF NOT EXISTS `term_relationships_delete_item_count` AFTER DELETE ON `term_relationships`
+BEGIN
+	UPDATE `items` SET `item_relation_count` = `item_relation_count` - 1 WHERE `item_id` = OLD.`item_id`;
+END;
+CREATE TRIGGER IF NOT EXISTS `term_relationships_update_item_count` AFTER UPDATE OF `item_id` ON `term_relationships`
+BEGIN
+	UPDATE `items` SET `item_relation_count` = `item_relation_count` - 1 WHERE `item_id` = OLD.`item_id`;
+	UPDATE `items` SET `item_relation_count` = `item_relation_count` + 1 WHERE `item_id` = NEW.`item_id`;
+END;
 
 CREATE TABLE IF NOT EXISTS `options` (
 	`option_id` INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
@@ -0,0 +1,14 @@
+CREATE TABLE IF NOT EXISTS `result_sets` (
+	`set_id` INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+	`set_name` TEXT NOT NULL,
+	`set_time` INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS `set_name` ON `result_sets` (`set_name`);
+CREATE TABLE IF NOT EXISTS `result_set_items` (
+	`set_id` INTEGER NOT NULL,
+	`item_id` INTEGER NOT NULL,
+	PRIMARY KEY (`set_id`, `item_id`),
+	FOREIGN KEY (`set_id`) REFERENCES result_sets(`set_id`) ON DELETE CASCADE,
+	FOREIGN KEY (`item_id`) REFERENCES items(`item_id`) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS `result_set_items_item_id` ON `result_set_items` (`item_id`);
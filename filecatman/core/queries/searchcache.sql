@@ -0,0 +1,44 @@
+CREATE TABLE IF NOT EXISTS `data_generation` (
+	`generation_id` INTEGER PRIMARY KEY NOT NULL CHECK (`generation_id` = 1),
+	`generation` INTEGER NOT NULL default 0
+);
+INSERT OR IGNORE INTO `data_generation` (`generation_id`, `generation`) VALUES (1, 0);
+CREATE TABLE IF NOT EXISTS `search_cache` (
+	`cache_key` TEXT PRIMARY KEY NOT NULL,
+	`generation` INTEGER NOT NULL,
+	`item_ids` TEXT NOT NULL,
+	`cached_time` INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS `data_generation_items_insert` AFTER INSERT ON `items`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS `data_generation_items_delete` AFTER DELETE ON `items`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS `data_generation_items_update` AFTER UPDATE OF `item_name`, `type_id`, `item_ext`,
+	`item_source`, `item_time`, `item_creation_time`, `item_description`, `item_primary_category`, `item_md5` ON `items`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS `data_generation_relations_insert` AFTER INSERT ON `term_relationships`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS `data_generation_relations_delete` AFTER DELETE ON `term_relationships`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS `data_generation_relations_update` AFTER UPDATE ON `term_relationships`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS `data_generation_terms_update` AFTER UPDATE OF `term_name`, `term_taxonomy`, `term_parent` ON `terms`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS `data_generation_terms_delete` AFTER DELETE ON `terms`
+BEGIN
+	UPDATE `data_generation` SET `generation` = `generation` + 1;
+END;
@@ -0,0 +1,17 @@
+CREATE TABLE IF NOT EXISTS `term_bitmaps` (
+	`term_id` INTEGER PRIMARY KEY NOT NULL,
+	`bitmap` BLOB NOT NULL,
+	FOREIGN KEY (`term_id`) REFERENCES terms(`term_id`) ON DELETE CASCADE
+);
+CREATE TRIGGER IF NOT EXISTS `term_bitmaps_relation_insert` AFTER INSERT ON `term_relationships`
+BEGIN
+	DELETE FROM `term_bitmaps` WHERE `term_id` = NEW.`term_id`;
+END;
+CREATE TRIGGER IF NOT EXISTS `term_bitmaps_relation_delete` AFTER DELETE ON `term_relationships`
+BEGIN
+	DELETE FROM `term_bitmaps` WHERE `term_id` = OLD.`term_id`;
+END;
+CREATE TRIGGER IF NOT EXISTS `term_bitmaps_relation_update` AFTER UPDATE ON `term_relationships`
+BEGIN
+	DELETE FROM `term_bitmaps` WHERE `term_id` IN (OLD.`term_id`, NEW.`term_id`);
+END;
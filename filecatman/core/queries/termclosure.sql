@@ -0,0 +1,34 @@
+CREATE TABLE IF NOT EXISTS `term_closure` (
+	`ancestor_id` INTEGER NOT NULL,
+	`descendant_id` INTEGER NOT NULL,
+	`depth` INTEGER NOT NULL,
+	PRIMARY KEY (`ancestor_id`, `descendant_id`)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS `term_closure_descendant` ON `term_closure` (`descendant_id`, `depth`);
+CREATE TRIGGER IF NOT EXISTS `term_closure_insert` AFTER INSERT ON `terms`
+BEGIN
+	INSERT INTO `term_closure` (`ancestor_id`, `descendant_id`, `depth`)
+	SELECT NEW.`term_id`, NEW.`term_id`, 0
+	UNION ALL
+	SELECT `ancestor_id`, NEW.`term_id`, `depth` + 1 FROM `term_closure` WHERE `descendant_id` = NEW.`term_parent`;
+END;
+CREATE TRIGGER IF NOT EXISTS `term_closure_delete` AFTER DELETE ON `terms`
+BEGIN
+	DELETE FROM `term_closure` WHERE `descendant_id` = OLD.`term_id` OR `ancestor_id` = OLD.`term_id`;
+END;
+CREATE TRIGGER IF NOT EXISTS `term_closure_cycle` BEFORE UPDATE OF `term_parent` ON `terms`
+WHEN EXISTS (SELECT 1 FROM `term_closure` WHERE `ancestor_id` = NEW.`term_id` AND `descendant_id` = NEW.`term_parent`)
+BEGIN
+	SELECT RAISE(ABORT, 'a category cannot be moved under itself or one of its subcategories');
+END;
+CREATE TRIGGER IF NOT EXISTS `term_closure_move` AFTER UPDATE OF `term_parent` ON `terms`
+WHEN OLD.`term_parent` IS NOT NEW.`term_parent`
+BEGIN
+	DELETE FROM `term_closure`
+	WHERE `descendant_id` IN (SELECT `descendant_id` FROM `term_closure` WHERE `ancestor_id` = NEW.`term_id`)
+	AND `ancestor_id` NOT IN (SELECT `descendant_id` FROM `term_closure` WHERE `ancestor_id` = NEW.`term_id`);
+	INSERT INTO `term_closure` (`ancestor_id`, `descendant_id`, `depth`)
+	SELECT above.`ancestor_id`, below.`descendant_id`, above.`depth` + below.`depth` + 1
+	FROM `term_closure` AS above, `term_closure` AS below
+	WHERE above.`descendant_id` = NEW.`term_parent` AND below.`ancestor_id` = NEW.`term_id`;
+END;
@@ -0,0 +1,245 @@
+import datetime
+import re
+from filecatman.core.exceptions import FCM_QuerySyntaxError
+from filecatman.core.functions import unformatBytes
+from filecatman.core.searchplan import SearchPlan
+
+
+class QueryCompiler:
+    ## Compiles boolean search expressions such as
+    ##     tag:cats AND (type:image OR ext:gif) AND NOT tag:nsfw AND size>1MB
+    ## into one SQL predicate over `items AS i` with bound parameters. NOT binds tighter than AND, AND tighter
+    ## than OR, and terms written side by side are ANDed. Bare words and "quoted phrases" search the item
+    ## text, `taxonomy:name` matches a category, `taxonomy:*` any category of the taxonomy and `set:name` the
+    ## items of a saved result set.
+    ## Size terms that are top-level AND conditions are returned as bounds, for the file_state index or for
+    ## the file check that runs on the rows the SQL returns. Elsewhere in a query they compare the size recorded
+    ## in file_state, so with fileState unset, as for --verify-stat, they are only allowed at the top level.
+    tokenPattern = re.compile(r'\s*(?:(?P<open>\()|(?P<close>\))'
+                              r'|(?P<field>[^\s()"<>=!:]+)(?P<op>:|>=|<=|!=|=|>|<)(?P<value>"(?:[^"\\]|\\.)*"|[^\s()]*)'
+                              r'|(?P<phrase>"(?:[^"\\]|\\.)*")|(?P<word>[^\s()]+))')
+    keywords = ("AND", "OR", "NOT")
+    textFields = dict(name="i.item_name", source="i.item_source", description="i.item_description")
+    numberFields = dict(id="i.item_id", cats="i.item_relation_count")
+    dateFields = dict(date="i.item_time", cdate="i.item_creation_time")
+    operators = {":": "=", "=": "=", "!=": "<>", ">": ">", ">=": ">=", "<": "<", "<=": "<="}
+
+    def __init__(self, db, taxonomies, itemTypes, includeDescendants=False, fileState=False):
+        self.db = db
+        self.taxonomies = taxonomies
+        self.itemTypes = itemTypes
+        self.includeDescendants = includeDescendants
+        ## usesFileState is set once a size term is compiled against file_state.
+        self.fileState, self.usesFileState = fileState, False
+        self.tokens, self.position = list(), 0
+        ## MATCH expressions of the text terms every result has to match, for ranking by relevance.
+        self.fullTextMatches = list()
+
+    def tokenize(self, expression):
+        tokens, position = list(), 0
+        while expression[position:].strip():
+            match = self.tokenPattern.match(expression, position)
+            if not match: raise FCM_QuerySyntaxError("Can't read the query from: "+expression[position:])
+            position = match.end()
+            if match.group('open'): tokens.append(("open",))
+            elif match.group('close'): tokens.append(("close",))
+            elif match.group('field'):
+                if not match.group('value'): raise FCM_QuerySyntaxError("Missing value after "+match.group(0).strip())
+                tokens.append(("term", match.group('field').lower(), match.group('op'), self.unquote(match.group('value'))))
+            elif match.group('phrase'): tokens.append(("text", self.unquote(match.group('phrase')), True))
+            elif match.group('word').upper() in self.keywords: tokens.append(("keyword", match.group('word').upper()))
+            elif '"' in match.group('word'): raise FCM_QuerySyntaxError("Unterminated quote: "+match.group('word'))
+            else: tokens.append(("text", match.group('word'), False))
+        return tokens
+
+    @staticmethod
+    def unquote(value):
+        if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+            return re.sub(r'\\(.)', r'\1', value[1:-1])
+        return value
+
+    def parse(self, expression):
+        ## Returns the expression tree: ("or", [nodes]), ("and", [nodes]), ("not", node), ("term", field, op,
+        ## value) or ("text", words, phrase).
+        self.tokens, self.position = self.tokenize(expression), 0
+        if not self.tokens: raise FCM_QuerySyntaxError("The query is empty")
+        node = self.parseOr()
+        if self.position < len(self.tokens): raise FCM_QuerySyntaxError("Unexpected ')'")
+        return node
+
+    def peek(self, *kind):
+        return self.position < len(self.tokens) and self.tokens[self.position][:len(kind)] == kind
+
+    def parseOr(self):
+        nodes = [self.parseAnd()]
+        while self.peek("keyword", "OR"):
+            self.position += 1
+            nodes.append(self.parseAnd())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parseAnd(self):
+        nodes = [self.parseNot()]
+        while self.position < len(self.tokens) and not (self.peek("keyword", "OR") or self.peek("close")):
+            if self.peek("keyword", "AND"): self.position += 1
+            nodes.append(self.parseNot())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parseNot(self):
+        if self.peek("keyword", "NOT"):
+            self.position += 1
+            return ("not", self.parseNot())
+        return self.parseAtom()
+
+    def parseAtom(self):
+        if self.position >= len(self.tokens): raise FCM_QuerySyntaxError("Unexpected end of query")
+        token = self.tokens[self.position]
+        self.position += 1
+        if token[0] == "open":
+            node = self.parseOr()
+            if not self.peek("close"): raise FCM_QuerySyntaxError("Missing ')'")
+            self.position += 1
+            return node
+        if token[0] in ("term", "text"): return token
+        raise FCM_QuerySyntaxError("Unexpected '{}'".format(token[1] if len(token) > 1 else ")"))
+
+    def compile(self, expression):
+        ## Returns the SQL predicate, its parameters and the (minimum, maximum) file size, either can be None.
+        node = self.parse(expression)
+        conditions = node[1] if node[0] == "and" else [node]
+        sizeBounds = [None, None]
+        others = list()
+        for condition in conditions:
+            if condition[0] == "term" and condition[1] == "size": self.sizeBound(condition, sizeBounds)
+            else: others.append(condition)
+            if condition[0] == "text" and self.db.fullTextSearch:
+                matchQuery = self.db.fullTextQuery(condition[1].split(), phrase=condition[2])
+                if matchQuery: self.fullTextMatches.append(matchQuery)
+        if not others: return None, [], sizeBounds
+        sql, params = self.compileNode(("and", others) if len(others) > 1 else others[0])
+        return sql, params, sizeBounds
+
+    @staticmethod
+    def size(op, value):
+        try: size = unformatBytes(value)
+        except (ValueError, KeyError): raise FCM_QuerySyntaxError("Invalid size: "+value)
+        if op == "!=": raise FCM_QuerySyntaxError("size only takes the comparisons > >= < <= =")
+        return size
+
+    def sizeBound(self, term, sizeBounds):
+        field, op, value = term[1:]
+        size = self.size(op, value)
+        if op in (">", ">="): sizeBounds[0] = max(sizeBounds[0] or 0, size + (op == ">"))
+        if op in ("<", "<="): sizeBounds[1] = min(sizeBounds[1] if sizeBounds[1] is not None else size, size - (op == "<"))
+        if op in ("=", ":"): sizeBounds[0], sizeBounds[1] = size, size
+
+    def compileNode(self, node):
+        if node[0] == "not":
+            sql, params = self.compileNode(node[1])
+            return "( NOT {} )".format(sql), params
+        if node[0] == "and":
+            compiled = [self.compileNode(child) for child in node[1]]
+            return "( " + " AND ".join(sql for sql, params in compiled) + " )", [p for sql, params in compiled for p in params]
+        if node[0] == "or":
+            compiled = [self.compileNode(child) for child in self.mergeAlternatives(node[1])]
+            return "( " + " OR ".join(sql for sql, params in compiled) + " )", [p for sql, params in compiled for p in params]
+        if node[0] == "text": return self.compileText(node[1], node[2])
+        if node[0] == "in": return self.compileIn(node[1], node[2])
+        return self.compileTerm(*node[1:])
+
+    def mergeAlternatives(self, nodes):
+        ## tag:a OR tag:b OR type:image OR type:video becomes one IN list per taxonomy and field.
+        merged, groups = list(), dict()
+        for node in nodes:
+            if node[0] == "term" and node[2] == ":" and node[3] != "*" \
+                    and (node[1] in ("type", "ext") or self.taxonomy(node[1])):
+                if node[1] not in groups:
+                    groups[node[1]] = ("in", node[1], list())
+                    merged.append(groups[node[1]])
+                groups[node[1]][2].append(node[3])
+            else: merged.append(node)
+        return merged
+
+    def taxonomy(self, field):
+        taxonomy = self.taxonomies.get(field.capitalize())
+        return taxonomy.tableName if taxonomy else None
+
+    def compileIn(self, field, values):
+        if len(values) == 1: return self.compileTerm(field, ":", values[0])
+        if field == "ext": return "( i.item_ext IN ({}) )".format(", ".join("?" * len(values))), values
+        if field == "type":
+            typeIdens = [iden for iden in (self.typeIden(value) for value in values) if iden is not None]
+            if not typeIdens: return "( 0 )", []
+            return "( i.type_id IN ({}) )".format(", ".join("?" * len(typeIdens))), typeIdens
+        return self.categoryCondition("t.term_name IN ({})".format(", ".join("?" * len(values)))), \
+            [self.taxonomy(field), *values]
+
+    def categoryCondition(self, nameCondition):
+        if self.includeDescendants:
+            return "( i.item_id IN (SELECT tr.item_id FROM terms AS t " \
+                   "INNER JOIN term_closure AS c ON (c.ancestor_id = t.term_id) " \
+                   "INNER JOIN term_relationships AS tr ON (tr.term_id = c.descendant_id) " \
+                   "WHERE t.term_taxonomy = ? AND {}) )".format(nameCondition.replace("t.term_name", "t.term_name COLLATE NOCASE"))
+        return "( i.item_id IN (SELECT tr.item_id FROM terms AS t " \
+               "INNER JOIN term_relationships AS tr ON (tr.term_id = t.term_id) " \
+               "WHERE t.term_taxonomy = ? AND {}) )".format(nameCondition.replace("t.term_name", "t.term_name COLLATE NOCASE"))
+
+    def typeIden(self, value):
+        itemType = self.itemTypes.get(value.capitalize())
+        if not itemType: return None
+        return self.db.selectItemTypeIdens().get(itemType.nounName)
+
+    def compileText(self, words, phrase):
+        if self.db.fullTextSearch:
+            matchQuery = self.db.fullTextQuery(words.split(), phrase=phrase)
+            if matchQuery: return "( i.item_id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ?) )", [matchQuery]
+        columns = self.textFields.values()
+        return "( " + " OR ".join("{} LIKE ?".format(column) for column in columns) + " )", \
+            ["%{}%".format(words.rstrip('*'))] * len(columns)
+
+    def compileTerm(self, field, op, value):
+        operator = self.operators[op]
+        if field in self.textFields:
+            if op == ":": return "( {} LIKE ? )".format(self.textFields[field]), ["%{}%".format(value)]
+            if op in ("=", "!="): return "( {} {} ? )".format(self.textFields[field], operator), [value]
+        elif field == "ext" and op in (":", "=", "!="):
+            return "( i.item_ext {} ? )".format(operator), [value]
+        elif field == "type" and op in (":", "=", "!="):
+            typeIden = self.typeIden(value)
+            if typeIden is None: return "( 0 )" if op != "!=" else "( 1 )", []
+            return "( i.type_id {} ? )".format(operator), [typeIden]
+        elif field == "md5" and op == ":":
+            return "( i.item_md5 GLOB ? )", [value+"*"]
+        elif field in self.numberFields:
+            try: number = int(value)
+            except ValueError: raise FCM_QuerySyntaxError("{} takes a number: {}".format(field, value))
+            return "( {} {} ? )".format(self.numberFields[field], operator), [number]
+        elif field in self.dateFields:
+            import dateutil.parser
+            try: date = dateutil.parser.parse(value)
+            except (ValueError, OverflowError): raise FCM_QuerySyntaxError("Invalid date: "+value)
+            if op == ":":
+                ## A date on its own matches that whole day.
+                day = date.replace(hour=0, minute=0, second=0, microsecond=0)
+                return "( {} >= ? AND {} < ? )".format(self.dateFields[field], self.dateFields[field]), \
+                    [self.db.toEpoch(day), self.db.toEpoch(day + datetime.timedelta(days=1))]
+            return "( {} {} ? )".format(self.dateFields[field], operator), [self.db.toEpoch(date)]
+        elif field == "set" and op in (":", "=", "!="):
+            resultSet = self.db.selectResultSet(value)
+            if not resultSet: return "( 0 )" if op != "!=" else "( 1 )", []
+            return "( i.item_id {} (SELECT rs.item_id FROM result_set_items AS rs WHERE rs.set_id = ?) )".format(
+                "NOT IN" if op == "!=" else "IN"), [resultSet[0]]
+        elif field == "size" and self.fileState:
+            ## An unrecorded size is NULL, so the item matches neither the term nor its NOT.
+            self.usesFileState = True
+            return "( {} {} ? )".format(SearchPlan.fileSize, operator), [self.size(op, value)]
+        elif field == "size":
+            raise FCM_QuerySyntaxError("With --verify-stat, size can only be combined with AND at the top level of a query")
+        elif self.taxonomy(field) and op in (":", "="):
+            if value == "*":
+                return "( i.item_id IN (SELECT tr.item_id FROM term_relationships AS tr " \
+                       "INNER JOIN terms AS t ON (t.term_id = tr.term_id) WHERE t.term_taxonomy = ?) )", \
+                    [self.taxonomy(field)]
+            return self.categoryCondition("t.term_name = ?"), [self.taxonomy(field), value]
+        elif not self.taxonomy(field):
+            raise FCM_QuerySyntaxError("Unknown field '{}', quote text that contains a colon".format(field))
+        raise FCM_QuerySyntaxError("{} doesn't take the comparison {}".format(field, op))
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import logging
+import sqlite3
+from collections import OrderedDict
+
+
+class SearchCache:
+    ## The ordered ids of the items a search matches, keyed by the search's statement and parameters, so
+    ## running the same search again for another page or output reads the ids instead of the query.
+    ## Entries are kept in memory and in the search_cache table, each tagged with the data generation: a
+    ## counter triggers bump on every item, category and relation write. An entry from another generation
+    ## is stale.
+    memoryEntries = 32
+    diskEntries = 64
+    ## Searches matching more items than this are not cached.
+    maxIdens = 100000
+
+    def __init__(self, db):
+        self.db = db
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(sql, params):
+        return hashlib.sha1(json.dumps([sql, params], default=str).encode()).hexdigest()
+
+    def lookup(self, sql, params):
+        key, generation = self.key(sql, params), self.db.currentDataGeneration()
+        if generation is None: return None
+        entry = self.entries.get(key)
+        if entry and entry[0] == generation:
+            self.entries.move_to_end(key)
+            self.logger.debug("Search ids from memory cache")
+            return entry[1]
+        itemIds = self.db.selectCachedSearch(key, generation)
+        if itemIds is None: return None
+        idens = [int(iden) for iden in itemIds.split(",")] if itemIds else []
+        self.remember(key, generation, idens)
+        self.logger.debug("Search ids from search_cache")
+        return idens
+
+    def store(self, sql, params, idens):
+        if len(idens) > self.maxIdens: return
+        key, generation = self.key(sql, params), self.db.currentDataGeneration()
+        if generation is None: return
+        self.remember(key, generation, idens)
+        try:
+            self.db.insertCachedSearch(key, generation, ",".join(str(iden) for iden in idens), self.diskEntries)
+            self.db.commit()
+        except sqlite3.OperationalError as e:
+            ## A read-only or busy database still gets the in-memory cache.
+            self.logger.debug("Search not cached on disk: {}".format(e))
+
+    def remember(self, key, generation, idens):
+        self.entries[key] = (generation, idens)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.memoryEntries: self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.db.clearSearchCache()
@@ -0,0 +1,227 @@
+import base64
+import json
+from filecatman.core.functions import chunks, reservoirSample
+
+
+class SearchPlan:
+    ## An item search compiled into one parameterized statement: the WHERE predicates and the joins they need,
+    ## each with its bound parameters, the ORDER BY and an optional LIMIT. The same plan can return the
+    ## matching rows, only their ids or only their count.
+    relationCount = "i.item_relation_count"
+    columnCount = 10
+    facetColumns = dict(type="ty.noun_name", ext="i.item_ext")
+    ## Recorded file size and modification time from file_state, NULL for an unrecorded or missing file.
+    fileSize = "(SELECT fs.file_size FROM file_state AS fs WHERE fs.item_id = i.item_id)"
+    fileModified = "(SELECT fs.file_mtime_ns / 1000000000.0 FROM file_state AS fs WHERE fs.item_id = i.item_id)"
+
+    def __init__(self, db):
+        self.db = db
+        self.where, self.params = list(), list()
+        self.joins, self.joinParams = list(), list()
+        self.orderBy = [("i.item_id", "ASC")]
+        self.limit, self.offset = None, None
+        self.reverse = False
+        ## File size bounds in bytes, a file_state predicate or else checked against the files of the rows.
+        self.minSize, self.maxSize = None, None
+        ## Set when file sizes and dates come from file_state instead of live stats; usesFileState once the plan
+        ## reads it. extraColumns follow the columnCount item columns of each row.
+        self.fileState, self.usesFileState = False, False
+        self.extraColumns = list()
+        ## A SearchCache, when set the matching ids are read from it and only the rows they select are fetched.
+        self.cache = None
+
+    def filter(self, predicate, *params):
+        self.where.append(predicate)
+        self.params.extend(params)
+
+    def filterNothing(self):
+        self.where.append("( 0 )")
+
+    def join(self, clause, *params):
+        self.joins.append(clause)
+        self.joinParams.extend(params)
+
+    def filterFileSize(self):
+        ## Turns the size bounds into a predicate on the file_size index.
+        bounds, params = list(), list()
+        if self.minSize is not None:
+            bounds.append("fs.file_size >= ?")
+            params.append(self.minSize)
+        if self.maxSize is not None:
+            bounds.append("fs.file_size <= ?")
+            params.append(self.maxSize)
+        if not bounds: return
+        self.filter("( i.item_id IN (SELECT fs.item_id FROM file_state AS fs WHERE {}) )".format(" AND ".join(bounds)),
+                    *params)
+        self.usesFileState = True
+
+    def addColumn(self, column, name):
+        self.extraColumns.append((column, name))
+        if column in (self.fileSize, self.fileModified): self.usesFileState = True
+
+    def sortBy(self, column, direction="ASC"):
+        ## Ties are broken on item_id so the order, and with it any LIMIT, is deterministic.
+        self.orderBy = [(column, direction)]
+        if column in (self.fileSize, self.fileModified): self.usesFileState = True
+        if column != "i.item_id": self.orderBy.append(("i.item_id", direction))
+
+    def columns(self):
+        return "i.item_id AS 'ID', i.item_name AS 'Name', ty.noun_name AS 'Type', {} AS 'Time', " \
+               "i.item_source AS 'Source', i.item_ext AS 'ext', {} AS 'Relations', {} AS 'CreationTime', " \
+               "i.item_description AS 'Description', i.item_md5 AS 'Md5'".format(
+                    self.db.itemDateTime.format("i.item_time"), self.relationCount,
+                    self.db.itemDateTime.format("i.item_creation_time")) + \
+            "".join(", {} AS '{}'".format(column, name) for column, name in self.extraColumns)
+
+    def fromSQL(self):
+        sql = "FROM " + self.db.itemTables
+        for join in self.joins: sql += "\n" + join
+        if self.where: sql += "\nWHERE " + " AND \n".join(self.where)
+        return sql
+
+    def orderSQL(self, reverse=None):
+        ## A reversed plan reads from the end of the order, for --last with a LIMIT.
+        if reverse is None: reverse = self.reverse
+        order = list()
+        for column, direction in self.orderBy:
+            if reverse: direction = "ASC" if direction == "DESC" else "DESC"
+            order.append("{} {}".format(column, direction))
+        return "\nORDER BY " + ", ".join(order)
+
+    def statement(self, columns=None):
+        sql = "SELECT {} \n{}{}".format(columns or self.columns(), self.fromSQL(), self.orderSQL())
+        params = [*self.joinParams, *self.params]
+        if self.limit is not None:
+            sql += "\nLIMIT ?"
+            params.append(self.limit)
+            if self.offset:
+                sql += " OFFSET ?"
+                params.append(self.offset)
+        return sql, params
+
+    def rows(self):
+        ## Returns a cursor over the matching rows. A reversed plan is read back into the requested order,
+        ## which only holds `limit` rows. The cursor is its own, so the rows can stream through work that
+        ## queries the database as they are read, like the hash cache lookups of --md5changed.
+        if self.cache: return self.rowsFor(self.window(self.matchingIdens()))
+        sql, params = self.statement()
+        self.db.logger.debug(sql)
+        cursor = self.db.con.execute(sql, params)
+        if self.reverse: return cursor.fetchall()[::-1]
+        return cursor
+
+    def idensStatement(self):
+        return "SELECT i.item_id \n" + self.fromSQL() + self.orderSQL(reverse=False), [*self.joinParams, *self.params]
+
+    def matchingIdens(self):
+        ## The ids of every matching row in order, from the cache while the data hasn't changed.
+        sql, params = self.idensStatement()
+        idens = self.cache.lookup(sql, params) if self.cache else None
+        if idens is None:
+            self.db.logger.debug(sql)
+            idens = [row[0] for row in self.db.cur.execute(sql, params)]
+            if self.cache: self.cache.store(sql, params, idens)
+        return idens
+
+    def window(self, idens):
+        ## The part of the ordered ids the LIMIT and OFFSET select, counted from the end for a reversed plan.
+        start = self.offset or 0
+        if self.limit is None: return idens[start:]
+        if self.reverse: return idens[max(len(idens) - start - self.limit, 0):max(len(idens) - start, 0)]
+        return idens[start:start + self.limit]
+
+    def sample(self, size, rng):
+        ## Reservoir-samples `size` matching ids from a cursor over the ids alone, then reads only those rows,
+        ## so a random pick holds `size` rows in memory whatever the result size.
+        ## The ids stream in the plan's order, so a seed picks the same items with or without the cache.
+        if self.cache: idens = self.matchingIdens()
+        else:
+            sql, params = self.idensStatement()
+            self.db.logger.debug(sql)
+            idens = (row[0] for row in self.db.cur.execute(sql, params))
+        return self.rowsFor(reservoirSample(idens, size, rng))
+
+    def rowsFor(self, idens):
+        ## The rows of these ids, in the order given.
+        rows = dict()
+        for chunk in chunks(idens, 500):
+            sql = "SELECT {} \nFROM {} \nWHERE i.item_id IN ({})".format(
+                self.columns(), self.db.itemTables, ", ".join("?" * len(chunk)))
+            rows.update((row[0], row) for row in self.db.cur.execute(sql, chunk))
+        return [rows[iden] for iden in idens]
+
+    def count(self):
+        if self.cache: return len(self.window(self.matchingIdens()))
+        if self.limit is None:
+            sql, params = "SELECT COUNT(*) \n" + self.fromSQL(), [*self.joinParams, *self.params]
+        else:
+            sql, params = self.statement(columns="i.item_id")
+            sql = "SELECT COUNT(*) FROM (\n{}\n)".format(sql)
+        self.db.logger.debug(sql)
+        return self.db.cur.execute(sql, params).fetchone()[0]
+
+    def facets(self, taxonomies=(), columns=(), limit=10):
+        ## The `limit` most common values of each facet among all matching items, as (facet, value, count) rows
+        ## from one statement: the matching ids are selected once and grouped per facet. Facets are taxonomy
+        ## table names, counting categories, and the item columns in facetColumns.
+        groups, groupParams = list(), list()
+        for taxonomy in taxonomies:
+            groups.append("SELECT ? AS facet, t.term_name AS value, COUNT(*) AS count FROM matched AS m "
+                          "INNER JOIN term_relationships AS tr ON (tr.item_id = m.item_id) "
+                          "INNER JOIN terms AS t ON (t.term_id = tr.term_id) "
+                          "WHERE t.term_taxonomy = ? GROUP BY t.term_id")
+            groupParams.extend((taxonomy, taxonomy))
+        for column in columns:
+            groups.append("SELECT ? AS facet, m.{0} AS value, COUNT(*) AS count FROM matched AS m GROUP BY m.{0}"
+                          .format(column))
+            groupParams.append(column)
+        if not groups: return list()
+        sql = "WITH matched (item_id, {}) AS (\nSELECT i.item_id, {} \n{}\n)\n".format(
+                  ", ".join(self.facetColumns), ", ".join(self.facetColumns.values()), self.fromSQL()) + \
+              "SELECT facet, value, count FROM (SELECT facet, value, count, " \
+              "ROW_NUMBER() OVER (PARTITION BY facet ORDER BY count DESC, value) AS position FROM (\n" + \
+              "\nUNION ALL\n".join(groups) + "\n)) \nWHERE position <= ? \nORDER BY facet, position"
+        self.db.logger.debug(sql)
+        return self.db.cur.execute(sql, [*self.joinParams, *self.params, *groupParams, limit]).fetchall()
+
+    def explain(self):
+        ## The statement with its parameters and SQLite's plan for it, as (id, parent, detail) rows.
+        sql, params = self.statement()
+        queryPlan = self.db.cur.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        return sql, params, [(row[0], row[1], row[3]) for row in queryPlan]
+
+    def sortKey(self, itemID):
+        ## The value of the leading sort column for one item.
+        column = self.orderBy[0][0]
+        sql = "SELECT {} FROM {}{} \nWHERE i.item_id = ?".format(
+            column, self.db.itemTables, "".join("\n" + join for join in self.joins))
+        row = self.db.cur.execute(sql, [*self.joinParams, itemID]).fetchone()
+        return row[0] if row else None
+
+    def cursorAfter(self, itemID):
+        ## An opaque token for the position after itemID in this plan's order, which seek() continues from.
+        column, direction = self.orderBy[0]
+        cursor = {"sort": [column, direction], "key": self.sortKey(itemID), "id": itemID}
+        return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+    def seek(self, token):
+        ## Keyset pagination: skips to the rows after a cursor with a predicate on the sort columns, so a
+        ## page costs the same however deep it is. NULLs sort first ascending and last descending.
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(token.encode()))
+            key, itemID = cursor['key'], int(cursor['id'])
+        except (ValueError, KeyError, TypeError):
+            raise Exception("Invalid cursor")
+        column, direction = self.orderBy[0]
+        if cursor['sort'] != [column, direction]: raise Exception("The cursor was made for a different sort order")
+        after = ">" if direction == "ASC" else "<"
+        if column == "i.item_id":
+            self.filter("( i.item_id {} ? )".format(after), itemID)
+        elif key is None and direction == "ASC":
+            self.filter("( ({0} IS NOT NULL) OR (i.item_id > ?) )".format(column), itemID)
+        elif key is None:
+            self.filter("( ({0} IS NULL) AND (i.item_id < ?) )".format(column), itemID)
+        else:
+            nulls = " OR ({} IS NULL)".format(column) if direction == "DESC" else ""
+            self.filter("( ({0} {1} ?) OR ({0} = ? AND i.item_id {1} ?){2} )".format(column, after, nulls),
+                        key, key, itemID)
@@ -16,28 +16,41 @@ import datetime
 import os
 import pprint
 import sys
+from functools import partial
 from urllib.parse import unquote, quote
 
 import filecatman.config as config
 from filecatman.core import const
 from filecatman.core.database import Database
+from filecatman.core.migrations import Migrator
+from filecatman.core.searchplan import SearchPlan
+from filecatman.core.searchcache import SearchCache
+from filecatman.core.bitmaps import CategoryBitmaps
+from filecatman.core.hashcache import HashCache
+from filecatman.core.hashing import FileHasher, digestAlgorithm, defaultHashAlgorithm, hashAlgorithms, \
+    taggedDigest
+from filecatman.core.duplicates import DuplicateFinder
+from filecatman.core.querylang import QueryCompiler
 from filecatman.core.functions import convToBool, getDataFilePath, uploadFile, pluralize, \
     escape, deleteFile, isURL, downloadFile, createLink, createDesktopFile, chunks, \
-    formatBytes, unformatBytes, timeStampToString, getMD5FromFile, getMD5FromPath, \
-    printProgressBar, getPrintColourFromName, deepCopy, getTmpPath, desktopFileExt
+    formatBytes, unformatBytes, timeStampToString, \
+    printProgressBar, getPrintColourFromName, deepCopy, getTmpPath, desktopFileExt, \
+    reservoirSample
 from filecatman.core.objects import ItemType, ItemTypeList, Taxonomy, TaxonomyList, FCM
 from filecatman.core.exceptions import FCM_NoDatabaseFile
 from filecatman.log import logger
 
-## TODO add category parents
-
 class Filecatman:
     main, config, db = None, None, None
     systemName, logger, portableMode = None, None, None
     organizationname,applicationname, applicationversion = None, None, None
     dataDirOverride = None
     needToPurgeShortcuts, needToCreateShortcuts = False, False
+    searchCursor, searchCache, categoryBitmaps, hashCache = None, None, None, None
+    ## Threads hashing files at once, None for one per CPU core.
+    hashJobs = None
     noIntegration, noShortcuts = False, False
+    noMigrate = False
     importedMode = True
     defaultExtensions = dict(
         webpage=('html', 'htm', 'xhtml', 'xht'),
@@ -61,6 +74,7 @@ class Filecatman:
     def __init__(self, args=None):
         if not args: args = {}
         if args.get('noImportedMode'): self.importedMode = False
+        if args.get('noMigrate'): self.noMigrate = True
         self.setOrganizationName(const.ORGNAME)
         self.setApplicationName(const.APPNAME)
         self.setApplicationVersion(const.VERSION)
@@ -105,6 +119,7 @@ class Filecatman:
     def executeActions(self, fcmConfig):
         if fcmConfig.get('nointegration'): self.noIntegration = True
         if fcmConfig.get('noshortcuts'): self.noShortcuts = True
+        if fcmConfig.get('jobs'): self.hashJobs = max(int(fcmConfig['jobs']), 1)
         for key in fcmConfig["changes"]:
             match key:
                 case "defaulttaxonomy":
@@ -132,6 +147,12 @@ class Filecatman:
                         match subkey:
                             case "vacuum":
                                 self.vacuumDatabase()
+                            case "recount":
+                                self.recountCategories()
+                            case "refreshstat":
+                                self.refreshFileStates()
+                            case "migrate":
+                                self.migrateDatabase(fcmConfig['actions']["database"][subkey])
                             case "listoptions":
                                 import json
                                 print(json.dumps(self.config['options'], indent=4))
@@ -157,6 +178,15 @@ class Filecatman:
                     self.exportProject(fcmConfig['actions'][key])
                 case "import":
                     self.importProject(fcmConfig['actions'][key])
+                case "resultset":
+                    for subkey in fcmConfig['actions']["resultset"]:
+                        match subkey:
+                            case "list":
+                                self.listResultSets(fcmConfig['actions']["resultset"][subkey])
+                            case "combine":
+                                self.combineResultSets(fcmConfig['actions']["resultset"][subkey])
+                            case "delete":
+                                self.deleteResultSets(fcmConfig['actions']["resultset"][subkey])
                 case "search":
                     if fcmConfig['actions'][key].get('searchterms'):
                         searchterms = fcmConfig['actions'][key]['searchterms']
@@ -184,18 +214,15 @@ class Filecatman:
                             case "clone":
                                 if not isinstance(fcmConfig['actions']["item"][subkey]['filepath'], list):
                                     fcmConfig['actions']["item"][subkey]['filepath'] = [fcmConfig['actions']["item"][subkey]['filepath'],]
-                                self.db.open()
-                                print(fcmConfig['actions']["item"][subkey]['filepath'])
-                                for filepath in fcmConfig['actions']["item"][subkey]['filepath']:
-                                    fileData = fcmConfig['actions']["item"][subkey]
-                                    if filepath == "lastitem":
-                                        item = self.db.selectLastItem()
-                                        if item: filepath = str(item[0])
-                                    fileData['filepath'] = filepath
-                                    fileData['keepDatabaseOpen'] = True
-                                    self.cloneItem(fileData)
-                                self.db.commit()
-                                self.db.close()
+                                with self.session():
+                                    print(fcmConfig['actions']["item"][subkey]['filepath'])
+                                    for filepath in fcmConfig['actions']["item"][subkey]['filepath']:
+                                        fileData = fcmConfig['actions']["item"][subkey]
+                                        if filepath == "lastitem":
+                                            item = self.db.selectLastItem()
+                                            if item: filepath = str(item[0])
+                                        fileData['filepath'] = filepath
+                                        self.cloneItem(fileData)
                                 self.needToCreateShortcuts = True
                             case  "download":
                                 if isinstance(fcmConfig['actions']["item"][subkey]['filepath'], list):
@@ -210,27 +237,25 @@ class Filecatman:
                             case "inspect":
                                 if not isinstance(fcmConfig['actions']["item"][subkey]['filepath'], list):
                                     fcmConfig['actions']["item"][subkey]['filepath'] = [fcmConfig['actions']["item"][subkey]['filepath'],]
-                                self.db.open()
-                                print('{')
-                                i = 1
-                                for filepath in fcmConfig['actions']["item"][subkey]['filepath']:
-                                    fileData = fcmConfig['actions']["item"][subkey]
-                                    if filepath == "lastitem":
-                                        item = self.db.selectLastItem()
-                                        if item: filepath = str(item[0])
-                                    fileData['filepath'] = filepath
-                                    fileData['keepDatabaseOpen'] = True
-                                    item = self.getItemFromPath(filepath)
-                                    if not item:
+                                with self.session(transaction=False):
+                                    print('{')
+                                    i = 1
+                                    for filepath in fcmConfig['actions']["item"][subkey]['filepath']:
+                                        fileData = fcmConfig['actions']["item"][subkey]
+                                        if filepath == "lastitem":
+                                            item = self.db.selectLastItem()
+                                            if item: filepath = str(item[0])
+                                        fileData['filepath'] = filepath
+                                        item = self.getItemFromPath(filepath)
+                                        if not item:
+                                            i += 1
+                                            continue
+                                        print('"' + str(item[FCM.ItemCol['Iden']]) + '": ')
+                                        self.inspectItem(fileData)
+                                        if i < len(fcmConfig['actions']["item"][subkey]['filepath']):
+                                            print(',')
                                         i += 1
-                                        continue
-                                    print('"' + str(item[FCM.ItemCol['Iden']]) + '": ')
-                                    self.inspectItem(fileData)
-                                    if i < len(fcmConfig['actions']["item"][subkey]['filepath']):
-                                        print(',')
-                                    i += 1
-                                print('}')
-                                self.db.close()
+                                    print('}')
                             case "path":
                                 if fcmConfig['actions']["item"][subkey]['filepath'] == "lastitem":
                                     self.db.open()
@@ -281,17 +306,14 @@ class Filecatman:
                             case "update":
                                 if not isinstance(fcmConfig['actions']["item"][subkey]['filepath'], list):
                                     fcmConfig['actions']["item"][subkey]['filepath'] = [fcmConfig['actions']["item"][subkey]['filepath'],]
-                                self.db.open()
-                                for filepath in fcmConfig['actions']["item"][subkey]['filepath']:
-                                    fileData = fcmConfig['actions']["item"][subkey]
-                                    if filepath == "lastitem":
-                                        item = self.db.selectLastItem()
-                                        if item: filepath = str(item[0])
-                                    fileData['filepath'] = filepath
-                                    fileData['keepDatabaseOpen'] = True
-                                    self.updateItem(fileData)
-                                self.db.commit()
-                                self.db.close()
+                                with self.session():
+                                    for filepath in fcmConfig['actions']["item"][subkey]['filepath']:
+                                        fileData = fcmConfig['actions']["item"][subkey]
+                                        if filepath == "lastitem":
+                                            item = self.db.selectLastItem()
+                                            if item: filepath = str(item[0])
+                                        fileData['filepath'] = filepath
+                                        self.updateItem(fileData)
                                 if fcmConfig['actions']["item"][subkey].get("removecategories") or \
                                         fcmConfig['actions']["item"][subkey].get("setname"):
                                     self.needToPurgeShortcuts = True
@@ -299,15 +321,11 @@ class Filecatman:
                             case "upload":
                                 if isinstance(fcmConfig['actions']["item"][subkey]['filepath'], list):
                                     bulkCommit = fcmConfig['actions']["item"][subkey].get('bulk')
-                                    if bulkCommit: self.db.open()
-                                    for filepath in fcmConfig['actions']["item"][subkey]['filepath']:
-                                        fileData = fcmConfig['actions']["item"][subkey]
-                                        fileData['filepath'] = filepath
-                                        if bulkCommit: fileData['keepDatabaseOpen'] = True
-                                        self.uploadItem(fileData)
-                                    if bulkCommit:
-                                        self.db.commit()
-                                        self.db.close()
+                                    with self.session(transaction=bool(bulkCommit)):
+                                        for filepath in fcmConfig['actions']["item"][subkey]['filepath']:
+                                            fileData = fcmConfig['actions']["item"][subkey]
+                                            fileData['filepath'] = filepath
+                                            self.uploadItem(fileData)
                                 else:
                                     self.uploadItem(fcmConfig['actions']["item"][subkey])
                                 self.needToCreateShortcuts = True
@@ -350,46 +368,39 @@ class Filecatman:
                                 self.searchItems(searchConf)
                             case "create":
                                 if isinstance(fcmConfig['actions']["category"][subkey]['category'], list):
-                                    self.db.open()
-                                    for category in fcmConfig['actions']["category"][subkey]['category']:
-                                        fileData = fcmConfig['actions']["category"][subkey]
-                                        fileData['category'] = category
-                                        fileData['keepDatabaseOpen'] = True
-                                        self.createCategory(fileData)
-                                    self.db.commit()
-                                    self.db.close()
+                                    with self.session():
+                                        for category in fcmConfig['actions']["category"][subkey]['category']:
+                                            fileData = fcmConfig['actions']["category"][subkey]
+                                            fileData['category'] = category
+                                            self.createCategory(fileData)
                                 else: self.createCategory(fcmConfig['actions']["category"][subkey])
                                 self.needToCreateShortcuts = True
                             case "inspect":
                                 self.inspectCategory(fcmConfig['actions']["category"][subkey])
+                            case "tree":
+                                self.printCategoryTree(fcmConfig['actions']["category"][subkey])
                             case "rename":
                                 self.renameCategory(fcmConfig['actions']["category"][subkey])
                                 self.needToPurgeShortcuts = True
                                 self.needToCreateShortcuts = True
                             case "delete":
                                 if isinstance(fcmConfig['actions']["category"][subkey]['category'], list):
-                                    self.db.open()
-                                    for category in fcmConfig['actions']["category"][subkey]['category']:
-                                        fileData = fcmConfig['actions']["category"][subkey]
-                                        fileData['category'] = category
-                                        fileData['keepDatabaseOpen'] = True
-                                        self.deleteCategory(fileData)
-                                    self.db.commit()
-                                    self.db.close()
+                                    with self.session():
+                                        for category in fcmConfig['actions']["category"][subkey]['category']:
+                                            fileData = fcmConfig['actions']["category"][subkey]
+                                            fileData['category'] = category
+                                            self.deleteCategory(fileData)
                                 else:
                                     self.deleteCategory(fcmConfig['actions']["category"][subkey])
                                 self.needToPurgeShortcuts = True
                                 self.needToCreateShortcuts = True
                             case "delrel":
                                 if isinstance(fcmConfig['actions']["category"][subkey]['category'], list):
-                                    self.db.open()
-                                    for category in fcmConfig['actions']["category"][subkey]['category']:
-                                        fileData = fcmConfig['actions']["category"][subkey]
-                                        fileData['category'] = category
-                                        fileData['keepDatabaseOpen'] = True
-                                        self.deleteCategoryRelations(fileData)
-                                    self.db.commit()
-                                    self.db.close()
+                                    with self.session():
+                                        for category in fcmConfig['actions']["category"][subkey]['category']:
+                                            fileData = fcmConfig['actions']["category"][subkey]
+                                            fileData['category'] = category
+                                            self.deleteCategoryRelations(fileData)
                                 else:
                                     self.deleteCategoryRelations(fcmConfig['actions']["category"][subkey])
                                 self.needToPurgeShortcuts = True
@@ -399,17 +410,15 @@ class Filecatman:
                                 self.needToCreateShortcuts = True
                             case "update":
                                 if isinstance(fcmConfig['actions']["category"][subkey]['category'], list):
-                                    self.db.open()
-                                    for category in fcmConfig['actions']["category"][subkey]['category']:
-                                        fileData = fcmConfig['actions']["category"][subkey]
-                                        fileData['category'] = category
-                                        fileData['keepDatabaseOpen'] = True
-                                        self.updateCategory(fileData)
-                                    self.db.commit()
-                                    self.db.close()
+                                    with self.session():
+                                        for category in fcmConfig['actions']["category"][subkey]['category']:
+                                            fileData = fcmConfig['actions']["category"][subkey]
+                                            fileData['category'] = category
+                                            self.updateCategory(fileData)
                                 else:
                                     self.updateCategory(fcmConfig['actions']["category"][subkey])
-                                if fcmConfig['actions']["category"][subkey].get("removeitems"):
+                                if fcmConfig['actions']["category"][subkey].get("removeitems") or \
+                                        fcmConfig['actions']["category"][subkey].get("parent") is not None:
                                     self.needToPurgeShortcuts = True
                                 self.needToCreateShortcuts = True
                             case "view":
@@ -445,6 +454,11 @@ class Filecatman:
         self.writeDatabaseOptions()
         self.config.writeConfig()
 
+    def session(self, transaction=True):
+        ## Use as `with fcm.session():` to run many calls on one connection. With transaction=True the
+        ## calls share a single transaction that is committed on exit and rolled back on error.
+        return self.db.session(transaction)
+
     def getItemFromPath(self, path):
         item = None
         if os.path.islink(path):
@@ -495,74 +509,115 @@ class Filecatman:
 
     def importProject(self, data):
         self.logger.debug("Importing project")
-        self.db.open()
-        if not os.path.exists(data['filepath']): raise Exception('No valid filepath')
-        if os.path.isdir(data['filepath']):
-            jsonPath = os.path.join(data['filepath'], os.path.basename(data['filepath'])+".json")
-            if os.path.exists(jsonPath):
-                data['filepath'] = jsonPath
-            else: raise Exception('No JSON file found')
-        import json
-        with open(data['filepath'], "r") as importFile:
-            try: importedData = json.load(importFile)
-            except json.decoder.JSONDecodeError:
-                self.logger.error('Invalid JSON file')
-                return
-            if not importedData.get("Filecatman Version"): raise Exception('Missing Version Info')
-            if importedData.get("Categories"):
-                for catIden, cat in importedData['Categories'].items():
-                    self.createCategory({ 'category': cat['Taxonomy']+":"+unquote(cat['Name']),
-                                          'keepDatabaseOpen': True })
-            if importedData.get("Items"):
-                for item in importedData['Items']:
-                    isWeblink = self.config['itemTypes'].get(item['Type']).isWeblinks
-                    if not isWeblink:
-                        filePath = os.path.join(os.path.dirname(data['filepath']), "Files", item['Type'], str(item['Iden'])+"."+item['Ext'])
-                    else:
-                        filePath = unquote(item['Source'])
-                        item['Ext'] = desktopFileExt()
-                    print(item)
-                    itemCategories = list()
-                    primaryCategory = None
-                    for rel in item['Relations']:
-                        if importedData['Categories'].get(str(rel)):
-                            itemCategories.append(importedData['Categories'][str(rel)]['Taxonomy']+":"+unquote(importedData['Categories'][str(rel)]['Name']))
-                    if item.get('PrimaryCategory'):
-                        if importedData['Categories'].get(str(item['PrimaryCategory'])):
-                            primaryCategory = importedData['Categories'][str(item['PrimaryCategory'])]['Taxonomy']+":"+unquote(importedData['Categories'][str(item['PrimaryCategory'])]['Name'])
-                    if data.get('updateifduplicate') and not isWeblink:
-                        existingItems = self.db.selectItems({'item_md5': getMD5FromFile(filePath)})
-                        if len(existingItems) > 0:
-                            updateData = {
-                                'keepDatabaseOpen': True,
-                                'filepath': filePath,
-                                'setname': unquote(item['Name']),
-                                'setext': item['Ext'],
-                                'setprimarycategory': primaryCategory,
-                                'addcategories': itemCategories
-                            }
-                            if item.get('Source'): updateData['setsource'] = unquote(item['Source'])
-                            if item.get('Description'): updateData['setdescription'] = unquote(item['Description'])
-                            if item.get('ModificationTime'): updateData['setdatetime'] = item['ModificationTime']
-                            self.updateItem(updateData)
+        with self.db.usingPerformanceProfile('bulk'), self.session():
+            if not os.path.exists(data['filepath']): raise Exception('No valid filepath')
+            if os.path.isdir(data['filepath']):
+                jsonPath = os.path.join(data['filepath'], os.path.basename(data['filepath'])+".json")
+                if os.path.exists(jsonPath):
+                    data['filepath'] = jsonPath
+                else: raise Exception('No JSON file found')
+            import json
+            with open(data['filepath'], "r") as importFile:
+                try: importedData = json.load(importFile)
+                except json.decoder.JSONDecodeError:
+                    self.logger.error('Invalid JSON file')
+                    return
+                if not importedData.get("Filecatman Version"): raise Exception('Missing Version Info')
+                categoryInputs, categoryIdens = dict(), dict()
+                if importedData.get("Categories"):
+                    for catIden, cat in importedData['Categories'].items():
+                        ## Exported projects keep names, sources and descriptions URL-quoted.
+                        categoryInputs[catIden] = cat['Taxonomy']+":"+unquote(cat['Name'])
+                    categoryIdens = dict(zip(categoryInputs.keys(),
+                                             self.getCategoryIdensFromInput(categoryInputs.values())))
+                    for catIden, cat in importedData['Categories'].items():
+                        if cat.get('Parent') and categoryIdens.get(str(cat['Parent'])) and categoryIdens.get(catIden):
+                            self.db.updateCategoryParent(categoryIdens[catIden], categoryIdens[str(cat['Parent'])])
+                newItems = list()
+                ## Rows in newItems by file digest, so a file imported twice updates the first row like an existing item.
+                pendingDigests = dict()
+                if importedData.get("Items"):
+                    import dateutil.parser
+                    for item in importedData['Items']:
+                        if not self.config['itemTypes'].get(item['Type']):
+                            raise Exception("Unknown item type: "+str(item['Type']))
+                    importFilePath = lambda item: os.path.join(os.path.dirname(data['filepath']), "Files", item['Type'],
+                                                               str(item['Iden'])+"."+item['Ext'])
+                    ## Every imported file is hashed up front, in parallel.
+                    importDigests = dict(self.hashCache.digestFiles(
+                        ((importFilePath(item), importFilePath(item)) for item in importedData['Items']
+                         if not self.config['itemTypes'].get(item['Type']).isWeblinks), jobs=self.hashJobs))
+                    for item in importedData['Items']:
+                        isWeblink = self.config['itemTypes'].get(item['Type']).isWeblinks
+                        if not isWeblink:
+                            filePath = importFilePath(item)
+                        else:
+                            filePath = unquote(item['Source'])
+                            item['Ext'] = desktopFileExt()
+                        print(item)
+                        itemCategories = [str(rel) for rel in item['Relations'] if categoryIdens.get(str(rel))]
+                        primaryCategory = None
+                        if item.get('PrimaryCategory') and categoryIdens.get(str(item['PrimaryCategory'])):
+                            primaryCategory = str(item['PrimaryCategory'])
+                        if data.get('updateifduplicate') and not isWeblink:
+                            existingItems = self.selectItemsWithFile(filePath)
+                            if len(existingItems) > 0:
+                                updateData = {
+                                    'filepath': filePath,
+                                    'setname': unquote(item['Name']),
+                                    'setext': item['Ext'],
+                                    'setprimarycategory': categoryInputs[primaryCategory] if primaryCategory else None,
+                                    'addcategories': [categoryInputs[rel] for rel in itemCategories]
+                                }
+                                if item.get('Source'): updateData['setsource'] = unquote(item['Source'])
+                                if item.get('Description'): updateData['setdescription'] = unquote(item['Description'])
+                                if item.get('ModificationTime'): updateData['setdatetime'] = item['ModificationTime']
+                                self.updateItem(updateData)
+                                continue
+                        if primaryCategory: itemCategories.insert(0, primaryCategory)
+                        itemCategories = [categoryIdens[rel] for rel in itemCategories]
+                        itemData = {
+                            'filepath': filePath,
+                            'name': unquote(item['Name']),
+                            'ext': item['Ext'],
+                            'type': item['Type'],
+                            'primarycategory': itemCategories[0] if itemCategories else None,
+                            'categories': itemCategories,
+                            'creationtime': item.get('CreationTime')
+                        }
+                        if item.get('Source'): itemData['source'] = unquote(item['Source'])
+                        if item.get('Description'): itemData['description'] = unquote(item['Description'])
+                        if item.get('ModificationTime'):
+                            try:
+                                itemData['datetime'] = dateutil.parser.parse(item['ModificationTime'])\
+                                    .strftime("%Y-%m-%d %H:%M:%S")
+                            except dateutil.parser.ParserError: pass
+                        if not itemData.get('datetime') and not isWeblink:
+                            itemData['datetime'] = datetime.datetime.fromtimestamp(os.path.getmtime(filePath))\
+                                .strftime("%Y-%m-%d %H:%M:%S")
+                        if not isWeblink: itemData['md5'] = importDigests[filePath]
+                        if data.get('updateifduplicate') and not isWeblink \
+                                and importDigests[filePath] in pendingDigests:
+                            pendingData = newItems[pendingDigests[importDigests[filePath]]][0]
+                            for key in ('name', 'ext', 'source', 'description'):
+                                if itemData.get(key): pendingData[key] = itemData[key]
+                            if item.get('ModificationTime') and itemData.get('datetime'):
+                                pendingData['datetime'] = itemData['datetime']
+                            if itemData['primarycategory']:
+                                pendingData['primarycategory'] = itemData['primarycategory']
+                                pendingData['categories'] = [*itemData['categories'], *pendingData['categories']]
+                            else: pendingData['categories'] = [*pendingData['categories'], *itemData['categories']]
+                            pendingData['categories'] = list(dict.fromkeys(pendingData['categories']))
                             continue
-                    uploadData = {
-                        'keepDatabaseOpen': True,
-                        'filepath': filePath,
-                        'name': unquote(item['Name']),
-                        'ext': item['Ext'],
-                        'type': item['Type'],
-                        'primarycategory': primaryCategory,
-                        'categories': itemCategories
-                    }
-                    if item.get('Source'): uploadData['source'] = unquote(item['Source'])
-                    if item.get('Description'): uploadData['description'] = unquote(item['Description'])
-                    if item.get('CreationTime'): uploadData['creationtime'] = item['CreationTime']
-                    if item.get('ModificationTime'): uploadData['datetime'] = item['ModificationTime']
-                    self.uploadItem(uploadData)
-            self.needToCreateShortcuts = True
-        self.db.commit()
-        self.db.close()
+                        newItems.append((itemData, isWeblink))
+                        if not isWeblink: pendingDigests.setdefault(importDigests[filePath], len(newItems) - 1)
+                if newItems:
+                    itemIdens = self.db.newItems(itemData for itemData, isWeblink in newItems)
+                    self.db.newRelations((itemIden, catID) for itemIden, (itemData, isWeblink) in zip(itemIdens, newItems)
+                                         for catID in itemData['categories'])
+                    for itemIden, (itemData, isWeblink) in zip(itemIdens, newItems):
+                        self.storeItemFile(itemIden, itemData, isWeblink)
+                self.needToCreateShortcuts = True
 
     def exportProject(self,data):
         self.logger.debug("Exporting project")
@@ -593,9 +648,9 @@ class Filecatman:
         for cat in categories:
             jsonData['Categories'][str(cat[FCM.CatCol["Iden"]])] = {
                 "Iden": cat[FCM.CatCol["Iden"]],
-                "Name": cat[FCM.CatCol["Name"]],
+                "Name": quote(cat[FCM.CatCol["Name"]]),
                 "Taxonomy": cat[FCM.CatCol["Taxonomy"]],
-                "Description": cat[FCM.CatCol["Description"]],
+                "Description": quote(cat[FCM.CatCol["Description"]]) if cat[FCM.CatCol["Description"]] else cat[FCM.CatCol["Description"]],
                 "Parent": cat[FCM.CatCol["Parent"]],
                 "Count": cat[FCM.CatCol["Count"]]
             }
@@ -610,13 +665,13 @@ class Filecatman:
         for item in items:
             itemDict = {
                 "Iden": item[FCM.ItemCol["Iden"]],
-                "Name": item[FCM.ItemCol["Name"]],
+                "Name": quote(item[FCM.ItemCol["Name"]]),
                 "Type": item[FCM.ItemCol["Type"]],
                 "Ext": item[FCM.ItemCol["Ext"]],
-                "Source": item[FCM.ItemCol["Source"]],
+                "Source": quote(item[FCM.ItemCol["Source"]]) if item[FCM.ItemCol["Source"]] else item[FCM.ItemCol["Source"]],
                 "ModificationTime": item[FCM.ItemCol["ModificationTime"]],
                 "CreationTime": item[FCM.ItemCol["CreationTime"]],
-                "Description": item[FCM.ItemCol["Description"]],
+                "Description": quote(item[FCM.ItemCol["Description"]]) if item[FCM.ItemCol["Description"]] else item[FCM.ItemCol["Description"]],
                 "PrimaryCategory": item[FCM.ItemCol["PrimaryCategory"]],
                 "Relations": [i[0] for i in self.db.selectRelations(itemID=item[FCM.ItemCol["Iden"]])]
             }
@@ -629,7 +684,7 @@ class Filecatman:
                                         item[FCM.ItemCol['Type']],
                                         str(item[FCM.ItemCol['Iden']]) + '.' + item[FCM.ItemCol['Ext']])
                 if os.path.exists(filepath):
-                    itemDict['Md5'] = getMD5FromFile(filepath)
+                    itemDict['Md5'] = self.hashCache.digest(filepath, self.itemDigestAlgorithm(item))
                     uploadFile(self.config, filepath, fileDestination, fileType=self.config['itemTypes'].dirFromNoun(item[FCM.ItemCol['Type']]))
             jsonData['Items'].append(itemDict)
             lenItemsCounter+=1
@@ -638,7 +693,8 @@ class Filecatman:
                 progressMessage="Exporting items",
                 enabled=self.config['options']['progress_bar']
             )
-
+        ## Keeps the hashes read for the export in hash_cache.
+        self.db.commit()
 
         import json
         jsonOutput = json.dumps(jsonData, indent=4)
@@ -658,13 +714,8 @@ class Filecatman:
             dbInfo['Relations Count']  = self.db.selectCount("term_relationships")[0]
             dbInfo['SQLite Version']  = self.db.versionInfo()[0]
             dbInfo['Filecatman Version']  = self.applicationVersion()
-            totalSize = 0
-            for item in self.db.selectAllItems():
-                filepath = os.path.join(self.config['options']['default_data_dir'],
-                                        self.config['itemTypes'].dirFromNoun(item[FCM.ItemCol['Type']]),
-                                        str(item[FCM.ItemCol['Iden']]) + '.' + item[FCM.ItemCol['Ext']])
-                totalSize+=os.stat(filepath).st_size
-            dbInfo['Size'] = formatBytes(totalSize)
+            self.fillFileStates()
+            dbInfo['Size'] = formatBytes(self.db.selectTotalFileSize())
             import shutil
             dbInfo['Free Space'] = formatBytes(shutil.disk_usage(self.config['options']['default_data_dir']).free)
             dbInfo['Tables'] =  [a[0] for a in self.db.tables()]
@@ -676,16 +727,12 @@ class Filecatman:
     def inspectItem(self, data):
         self.logger.debug("Inspecting item")
         itemData = dict()
-        if not data.get('keepDatabaseOpen'): self.db.open()
+        self.db.open()
         item = self.getItemFromPath(data['filepath'])
         if not item: raise Exception("Item not found")
         for colName in ('Iden','Name', 'Type', 'Ext', 'Source', 'ModificationTime', 'CreationTime', 'Description','PrimaryCategory','Md5'):
             itemData[colName] = item[FCM.ItemCol[colName]]
 
-        if itemData.get('Name'): itemData['Name'] = unquote(itemData['Name'])
-        if itemData.get('Description'): itemData['Description'] = unquote(itemData['Description'])
-        if itemData.get('Source'): itemData['Source'] = unquote(itemData['Source'])
-
         dataDir = self.config['options']['default_data_dir']
         relations = self.db.selectRelations(itemID=itemData['Iden'])
 
@@ -698,7 +745,7 @@ class Filecatman:
             relationsList.sort(key=lambda a: a[1], reverse=False)
             relationsList.sort(key=lambda a: a[2], reverse=False)
             for category in relationsList:
-                itemData['Relations'].append(str(category[0])+" = "+str(category[2])+" : "+unquote(category[1]))
+                itemData['Relations'].append(str(category[0])+" = "+str(category[2])+" : "+category[1])
 
 
         relationsCount = len(relations)
@@ -711,7 +758,7 @@ class Filecatman:
         itemData['Size'] = os.stat(filePath).st_size
         itemData['SizeNice'] = formatBytes(itemData['Size'])
 
-        if not data.get('keepDatabaseOpen'): self.db.close()
+        self.db.close()
 
         if self.importedMode or data.get('importedmode'): return itemData
 
@@ -752,7 +799,7 @@ class Filecatman:
             else:
                 subprocess.Popen(['xdg-open', linkPath], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
         else:
-            source = unquote(item[FCM.ItemCol['Source']])
+            source = item[FCM.ItemCol['Source']]
             if platform.system() == "Windows":
                 os.startfile(source)
             elif platform.system() == "Darwin":
@@ -771,34 +818,33 @@ class Filecatman:
             else:
                 raise Exception('Invalid integration directory path')
         if not os.path.exists(integrationDir): os.mkdir(integrationDir)
-        self.db.open()
-        directory = os.fsencode(integrationDir)
-        for file in os.listdir(directory):
-            filename = os.fsdecode(file)
-            filepath = os.path.join(integrationDir, filename)
-            if os.path.isfile(filepath):
-                self.uploadItem({"filepath": filepath})
-                os.remove(filepath)
-                self.needToCreateShortcuts = True
-            if os.path.isdir(filepath):
-                subDir = os.fsencode(filepath)
-                folderName = os.path.basename(filepath)
-                for subfile in os.listdir(subDir):
-                    subFilename = os.fsdecode(subfile)
-                    subFilepath = os.path.join(filepath, subFilename)
-                    if os.path.islink(subFilepath):
-                        linkDestPath = os.readlink(subFilepath)
-                        fileID = os.path.basename(linkDestPath).rsplit('.', 1)[0]
-                        item =  self.db.selectItem(fileID)
-                        if item:
-                            self.updateItem({"filepath": fileID, "addcategories":[folderName,]})
-                            os.unlink(subFilepath)
+        with self.db.usingPerformanceProfile('bulk'), self.session(transaction=False):
+            directory = os.fsencode(integrationDir)
+            for file in os.listdir(directory):
+                filename = os.fsdecode(file)
+                filepath = os.path.join(integrationDir, filename)
+                if os.path.isfile(filepath):
+                    self.uploadItem({"filepath": filepath})
+                    os.remove(filepath)
+                    self.needToCreateShortcuts = True
+                if os.path.isdir(filepath):
+                    subDir = os.fsencode(filepath)
+                    folderName = os.path.basename(filepath)
+                    for subfile in os.listdir(subDir):
+                        subFilename = os.fsdecode(subfile)
+                        subFilepath = os.path.join(filepath, subFilename)
+                        if os.path.islink(subFilepath):
+                            linkDestPath = os.readlink(subFilepath)
+                            fileID = os.path.basename(linkDestPath).rsplit('.', 1)[0]
+                            item =  self.db.selectItem(fileID)
+                            if item:
+                                self.updateItem({"filepath": fileID, "addcategories":[folderName,]})
+                                os.unlink(subFilepath)
+                                self.needToCreateShortcuts = True
+                        elif os.path.isfile(subFilepath):
+                            self.uploadItem({"filepath": subFilepath, "categories":[folderName,]})
+                            os.remove(subFilepath)
                             self.needToCreateShortcuts = True
-                    elif os.path.isfile(subFilepath):
-                        self.uploadItem({"filepath": subFilepath, "categories":[folderName,]})
-                        os.remove(subFilepath)
-                        self.needToCreateShortcuts = True
-        self.db.close()
         self.logger.debug("Integration folder scan complete")
 
 
@@ -814,13 +860,80 @@ class Filecatman:
         except FileNotFoundError:
             pass
 
+    def saveResultSet(self, name, sql=None, params=(), idens=None):
+        ## Stores the item ids a statement selects, or the given ids, as the result set `name`, replacing any
+        ## set saved under that name before.
+        with self.session():
+            setID = self.db.newResultSet(name)
+            if sql: self.db.insertResultSetItems(setID, sql, params)
+            else: self.db.insertResultSetIdens(setID, idens or ())
+            self.db.deleteResultSet(name, keep=setID)
+            count = self.db.selectCountResultSet(setID)
+        self.logger.info("Saved {} items to result set `{}`".format(count, name))
+        return count
+
+    def combineResultSets(self, data):
+        ## union, intersect or except of two or more result sets, saved as a new set by SQLite's compound SELECT.
+        operators = {"union": "UNION", "intersect": "INTERSECT", "except": "EXCEPT"}
+        with self.session():
+            setIdens = list()
+            for setName in data['sets']:
+                resultSet = self.db.selectResultSet(setName)
+                if not resultSet: raise Exception("Result set not found: "+setName)
+                setIdens.append(resultSet[0])
+            sql = "\n{}\n".format(operators[data['operator']]).join(
+                "SELECT item_id FROM result_set_items WHERE set_id = ?" for setID in setIdens)
+            count = self.saveResultSet(data['as'], sql, setIdens)
+        if self.importedMode or data.get('importedmode'): return count
+        print("{}: {} items".format(data['as'], count))
+
+    def listResultSets(self, data):
+        self.db.open()
+        resultSets = self.db.selectResultSets()
+        self.db.close()
+        if self.importedMode or data.get('importedmode'): return resultSets
+        for setID, setName, setTime, count in resultSets:
+            print("{}  {} items  {}".format(setName, count, setTime))
+
+    def deleteResultSets(self, data):
+        with self.session():
+            for setName in data['sets']:
+                if not self.db.deleteResultSet(setName): self.logger.warning("Result set not found: "+setName)
+
     def vacuumDatabase(self):
         self.db.close()
         self.db.open()
+        self.fillFileStates()
+        self.db.deleteStaleHashes()
+        self.db.commit()
         self.db.vacuumDatabase()
         self.db.commit()
         self.db.close()
 
+    def migrateDatabase(self, data):
+        self.db.open()
+        migrator = Migrator(self.db)
+        if data.get('dryrun'):
+            report = migrator.dryRun()
+            if self.importedMode: return report
+            print("Schema version: {} (latest {})".format(migrator.currentVersion(), migrator.latestVersion()))
+            for version, description, steps in report:
+                print("Version {}: {}".format(version, description))
+                for stepDescription, rows in steps:
+                    print("    {}: {} rows".format(stepDescription, rows))
+        else:
+            migrator.run()
+            self.logger.info("Database schema is at version {}".format(migrator.currentVersion()))
+        self.db.close()
+
+    def recountCategories(self):
+        self.db.open()
+        self.db.recountTerms()
+        self.db.recountItemRelations()
+        self.db.commit()
+        self.db.close()
+        self.logger.info("Category item counts and item relation counts rebuilt")
+
     def synchItemDateWithFiles(self):
         import time
         timerStart = time.perf_counter()
@@ -828,6 +941,7 @@ class Filecatman:
         allItems = self.db.selectAllItems()
         allItemsCount = len(allItems)
         allItemsCounter = 0
+        changedFiles, itemFiles = list(), list()
         for index, item in enumerate(allItems):
             filepath = os.path.join(self.config['options']['default_data_dir'],
                                     self.config['itemTypes'].dirFromNoun(item[FCM.ItemCol['Type']]),
@@ -836,8 +950,8 @@ class Filecatman:
                 dt = datetime.datetime.fromtimestamp(os.path.getmtime(filepath))
                 fileDate = dt.strftime("%Y-%m-%d %H:%M:%S")
                 if not fileDate == item[FCM.ItemCol['ModificationTime']]:
-                    self.db.updateMD5(str(item[FCM.ItemCol['Iden']]), getMD5FromFile(filepath))
-                    self.db.updateItemDate(str(item[FCM.ItemCol['Iden']]), fileDate)
+                    changedFiles.append(((item, fileDate), filepath))
+            itemFiles.append((item[FCM.ItemCol['Iden']], filepath))
             allItemsCounter += 1
             printProgressBar(
                 progress=allItemsCounter / allItemsCount,
@@ -846,6 +960,17 @@ class Filecatman:
                 status="",
                 enabled=self.config['options']['progress_bar']
             )
+        self.recordFileStates(itemFiles)
+        ## Items whose date changed are hashed in parallel and updated in batches.
+        changedMD5s = list()
+        for (item, fileDate), fileMd5 in self.hashCache.digestFiles(
+                changedFiles, lambda key: self.itemDigestAlgorithm(key[0]), jobs=self.hashJobs):
+            self.db.updateItemDate(str(item[FCM.ItemCol['Iden']]), fileDate)
+            changedMD5s.append((fileMd5, item[FCM.ItemCol['Iden']]))
+            if len(changedMD5s) >= 500:
+                self.db.updateMD5s(changedMD5s)
+                changedMD5s = list()
+        self.db.updateMD5s(changedMD5s)
         self.db.commit()
         self.db.close()
         timerEnd = time.perf_counter()
@@ -857,13 +982,22 @@ class Filecatman:
         self.db.open()
         allItems = self.db.selectAllItems()
         allItemsCount = len(allItems)
-        allItemsCounter = 0
-        for index, item in enumerate(allItems):
+        itemFiles = list()
+        for item in allItems:
             filepath = os.path.join(self.config['options']['default_data_dir'],
                                     self.config['itemTypes'].dirFromNoun(item[FCM.ItemCol['Type']]),
                                     str(item[FCM.ItemCol['Iden']]) + '.' + item[FCM.ItemCol['Ext']])
-            if os.path.exists(filepath):
-                self.db.updateMD5(str(item[FCM.ItemCol['Iden']]), getMD5FromFile(filepath))
+            itemFiles.append((item, filepath))
+        self.recordFileStates((item[FCM.ItemCol['Iden']], filepath) for item, filepath in itemFiles)
+        ## Files are hashed in parallel while their MD5s are written here in batches.
+        existingFiles = [(item, filepath) for item, filepath in itemFiles if os.path.exists(filepath)]
+        allItemsCounter = allItemsCount - len(existingFiles)
+        changedMD5s = list()
+        for item, fileMd5 in self.hashCache.digestFiles(existingFiles, jobs=self.hashJobs):
+            if fileMd5 != item[FCM.ItemCol['Md5']]: changedMD5s.append((fileMd5, item[FCM.ItemCol['Iden']]))
+            if len(changedMD5s) >= 500:
+                self.db.updateMD5s(changedMD5s)
+                changedMD5s = list()
             allItemsCounter += 1
             printProgressBar(
                 progress=allItemsCounter / allItemsCount,
@@ -871,6 +1005,66 @@ class Filecatman:
                 status="",
                 enabled=self.config['options']['progress_bar']
             )
+        self.db.updateMD5s(changedMD5s)
+        self.db.commit()
+        self.db.close()
+        timerEnd = time.perf_counter()
+        print("Time taken: "+str(round(timerEnd-timerStart,2))+" seconds")
+
+    def itemDigestAlgorithm(self, item):
+        ## Items keep the algorithm their digest was made with; one without a digest gets the configured one.
+        if item[FCM.ItemCol['Md5']]: return digestAlgorithm(item[FCM.ItemCol['Md5']])
+        return self.hashCache.algorithm
+
+    def selectItemsWithFile(self, filepath):
+        ## Items with the same content as a file, comparing its digest in each algorithm items were hashed with.
+        for digest in self.hashCache.digests(filepath, self.db.selectDigestAlgorithms() or [self.hashCache.algorithm]):
+            existingItems = self.db.selectItems({'item_md5': digest})
+            if existingItems: return existingItems
+        return list()
+
+    def recordFileStates(self, itemFiles):
+        ## Stats each (item id, file path) pair into file_state, with NULLs for a missing file.
+        states = list()
+        for itemID, filepath in itemFiles:
+            try:
+                fileStats = os.stat(filepath)
+                states.append((itemID, fileStats.st_size, fileStats.st_mtime_ns, fileStats.st_ino))
+            except OSError:
+                states.append((itemID, None, None, None))
+        self.db.upsertFileStates(states)
+
+    def itemFileStates(self, items):
+        ## (item id, file path) pairs of (item_id, noun_name, item_ext) rows.
+        dataDir = self.config['options']['default_data_dir']
+        for itemID, nounName, itemExt in items:
+            yield itemID, os.path.join(dataDir, self.config['itemTypes'].dirFromNoun(nounName), str(itemID)+'.'+itemExt)
+
+    def fillFileStates(self):
+        ## Stats the items file_state has no row for yet, such as those added before it existed.
+        items = self.db.selectItemsWithoutFileState()
+        if not items: return
+        self.logger.debug("Recording file state of {} items".format(len(items)))
+        self.recordFileStates(self.itemFileStates(items))
+        self.db.commit()
+
+    def refreshFileStates(self):
+        import time
+        timerStart = time.perf_counter()
+        self.db.open()
+        allItems = [(item[FCM.ItemCol['Iden']], item[FCM.ItemCol['Type']], item[FCM.ItemCol['Ext']])
+                    for item in self.db.selectAllItems()]
+        allItemsCount = len(allItems)
+        allItemsCounter = 0
+        for itemChunk in chunks(allItems, 500):
+            self.recordFileStates(self.itemFileStates(itemChunk))
+            allItemsCounter += len(itemChunk)
+            printProgressBar(
+                progress=allItemsCounter / allItemsCount,
+                progressMessage="Refreshing file sizes and dates ("+str(allItemsCounter)+"/"+str(allItemsCount)+")",
+                status="",
+                enabled=self.config['options']['progress_bar']
+            )
         self.db.commit()
         self.db.close()
         timerEnd = time.perf_counter()
@@ -941,6 +1135,15 @@ class Filecatman:
         self.db.commit()
         self.db.close()
 
+    def returnTermParents(self, termParent, termTaxonomy):
+        ## Splits the path down to a category's parent into the root category and the joined
+        ## subcategory directories between it and the category, for nesting shortcut dirs.
+        parents = self.db.selectCategoryPath(termParent)
+        if not parents:
+            self.logger.warning("Parent category '{}' not found in {}".format(termParent, termTaxonomy))
+            return str(termParent), ''
+        return parents[0], os.path.join(*parents[1:]) if len(parents) > 1 else ''
+
     def createShortcuts(self, customPath=None, overwriteLinks=False):
         shortcutsDir = self.config['options']['default_shortcuts_dir']
         self.db.open()
@@ -950,8 +1153,8 @@ class Filecatman:
             shortcutsDir = customPath
         elif self.config['options']['purge_shortcuts_folder']: self.purgeShortcutsFolder()
         dataDir = self.config['options']['default_data_dir']
-        sqlItems = "SELECT i.item_id, i.item_name, i.type_id, i.item_source, " \
-                   "i.item_time, i.item_ext FROM items AS i"
+        sqlItems = "SELECT i.item_id, i.item_name, ty.noun_name, i.item_source, " \
+                   "{} AS item_time, i.item_ext FROM {}".format(self.db.itemDateTime.format("i.item_time"), self.db.itemTables)
         queryItems = self.db.cur.execute(sqlItems).fetchall()
         lenQueryItems = len(queryItems)
         lenItemsCounter = 0
@@ -959,9 +1162,9 @@ class Filecatman:
             return False
         for item in queryItems:
             itemIden = item[0]
-            itemName = unquote(item[1])
+            itemName = item[1]
             itemType = item[2]
-            itemSource = unquote(item[3])
+            itemSource = item[3]
             itemTime = item[4]
             itemExt = item[5]
             typeDir = self.config['itemTypes'].dirFromNoun(itemType)
@@ -997,13 +1200,9 @@ class Filecatman:
                         raise
                 pass
 
-            sqlRelations = "SELECT t.term_name, t.term_parent, t.term_taxonomy " \
-                           "FROM term_relationships AS tr " \
-                           "INNER JOIN terms AS t ON (t.term_id = tr.term_id) " \
-                           "WHERE (tr.item_id = '{}')".format(itemIden)
-            queryRelations = self.db.cur.execute(sqlRelations).fetchall()
+            queryRelations = self.db.selectRelatedCategories(itemIden)
             for relation in queryRelations:
-                termName = unquote(relation[0])
+                termName = relation[0]
                 termParent = relation[1]
                 termTaxonomy = relation[2]
                 taxonomyDir = self.config['taxonomies'].dirFromTable(termTaxonomy)
@@ -1044,7 +1243,7 @@ class Filecatman:
 
     def searchTaxonomies(self, data):
         from filecatman.core.printcolours import bcolours
-        if not data.get('keepDatabaseOpen'): self.db.open()
+        self.db.open()
 
         taxonomyResults =  self.config['taxonomies']
         if data.get('searchterms'): taxonomyResults = [a for a in taxonomyResults if data['searchterms'] in a.tableName]
@@ -1099,7 +1298,7 @@ class Filecatman:
                 print(color + itemRow + bcolours.ENDC)
             else:
                 print(itemRow)
-        if not data.get('keepDatabaseOpen'): self.db.close()
+        self.db.close()
 
 
 
@@ -1109,18 +1308,17 @@ class Filecatman:
         if data.get('hidecol'): withoutColumns = data['hidecol']
 
         self.db.open()
-        where = ["( t.term_id is not null )", ]
+        where, params = ["( t.term_id is not null )", ], list()
         itemKeywordsOp = ""
-        tableColumns = (('Name', 'term_name', quote),
-                        ('Description', 'term_description', quote))
+        tableColumns = (('Name', 'term_name'),
+                        ('Description', 'term_description'))
         itemKeywords = data.get('searchterms')
         self.logger.debug(itemKeywords)
         if itemKeywords:
             fieldsWhere = list()
-            for nounName, col, wordFunction in tableColumns:
-                keywordsWhere = "({0} LIKE '%{1}%'".format(col, wordFunction(itemKeywords))
-                keywordsWhere += ") \n"
-                fieldsWhere.append(keywordsWhere)
+            for nounName, col in tableColumns:
+                fieldsWhere.append("({0} LIKE ?) \n".format(col))
+                params.append("%{}%".format(itemKeywords))
             SQLName = "(" + " OR ".join(fieldsWhere) + ")"
             where.append("{}".format(itemKeywordsOp) + SQLName)
             self.logger.debug(where)
@@ -1131,7 +1329,8 @@ class Filecatman:
                 taxonomy = None
                 taxListResult = self.config['taxonomies'].get(tax.capitalize())
                 if taxListResult: taxonomy = taxListResult.tableName
-                fieldsWhere.append("( t.term_taxonomy = '{}' )".format(taxonomy))
+                fieldsWhere.append("( t.term_taxonomy = ? )")
+                params.append(taxonomy)
             if len(fieldsWhere) > 0:
                 SQLName = "(" + " OR ".join(fieldsWhere) + ")"
                 where.append(SQLName)
@@ -1141,7 +1340,8 @@ class Filecatman:
                 taxListResult = self.config['taxonomies'].get(tax.capitalize())
                 if taxListResult:
                     taxonomy = taxListResult.tableName
-                    fieldsWhere.append("( t.term_taxonomy <> '{}' )".format(taxonomy))
+                    fieldsWhere.append("( t.term_taxonomy <> ? )")
+                    params.append(taxonomy)
             if len(fieldsWhere) > 0:
                 SQLName = "(" + " AND ".join(fieldsWhere) + ")"
                 where.append(SQLName)
@@ -1153,7 +1353,8 @@ class Filecatman:
         if data.get("countlessthan"): _itemcounts.append((data['countlessthan'], "<"))
         if len(_itemcounts) > 0:
             for itemcount, operator in _itemcounts:
-                where.append("( t.term_count {} '{}' )".format(operator, itemcount))
+                where.append("( t.term_count {} ? )".format(operator))
+                params.append(itemcount)
 
         _items = list()
         if data.get("withitems"): _items.append((data['withitems'], "IN"))
@@ -1168,8 +1369,9 @@ class Filecatman:
                     SQLItem = "SELECT tr.term_id \n" \
                               "FROM term_relationships AS tr \n" \
                               "INNER JOIN terms AS t ON (t.term_id = tr.term_id) \n" \
-                              "WHERE ( tr.item_id = '{}' )".format(itemIden)
+                              "WHERE ( tr.item_id = ? )"
                     where.append("( t.term_id {0} (\n{1}\n) )".format(operator, SQLItem))
+                    params.append(itemIden)
 
         if data.get("withduplicate"):
             duplicateCol = data.get("withduplicate").lower()
@@ -1190,7 +1392,7 @@ class Filecatman:
 
         if data.get('sortby'):
             sortBy = data['sortby'].lower()
-            keys = {"iden": "t.term_id", "name": "t.term_name", "taxonomy": "t.term_taxonomy", "items":"t.term_count"}
+            keys = {"iden": "t.term_id", "name": "t.term_name COLLATE NOCASE", "taxonomy": "t.term_taxonomy", "items":"t.term_count"}
             if sortBy in keys:
                 directionOrder = "ASC"
                 if data.get("desc"): directionOrder = "DESC"
@@ -1200,7 +1402,7 @@ class Filecatman:
         else:
             sql += "ORDER BY t.term_count ASC"
 
-        categoriesQuery = self.db.cur.execute(sql).fetchall()
+        categoriesQuery = self.db.cur.execute(sql, params).fetchall()
         if len(categoriesQuery) < 1:
             if data.get('count'): print(0)
             return
@@ -1245,19 +1447,20 @@ class Filecatman:
             if len(categoriesQuery) > 0:
                 print('{')
                 i = 1
-                for cat in categoriesQuery:
-                    print('"' + str(cat[FCM.ItemCol['Iden']]) + '": ')
-                    self.inspectCategory({"category": str(cat[FCM.ItemCol['Iden']])})
-                    if i < len(categoriesQuery):
-                        print(',')
-                    i += 1
+                with self.session(transaction=False):
+                    for cat in categoriesQuery:
+                        print('"' + str(cat[FCM.ItemCol['Iden']]) + '": ')
+                        self.inspectCategory({"category": str(cat[FCM.ItemCol['Iden']])})
+                        if i < len(categoriesQuery):
+                            print(',')
+                        i += 1
                 print('}')
         else:
             colData = []
             if not "iden" in withoutColumns: colData.append(
                 {'minlength': 5, 'name': "Iden", 'index': 0, 'functions': (str,), 'maxlength':50})
             if not "name" in withoutColumns: colData.append(
-                {'minlength': 5, 'name': "Name", 'index': 1, 'functions': (unquote, ), 'maxlength':25})
+                {'minlength': 5, 'name': "Name", 'index': 1, 'functions': (), 'maxlength':25})
             if not "taxonomy" in withoutColumns: colData.append(
                 {'minlength': 5, 'name': "Taxonomy", 'index': 2, 'functions': (), 'maxlength':50})
             if not "items" in withoutColumns: colData.append(
@@ -1301,437 +1504,430 @@ class Filecatman:
         self.db.close()
 
 
-    def searchItems(self, data):
-        if data.get('timer'):
-            import time
-            timerStart = time.perf_counter()
-        additionalColumns, withoutColumns = [], []
-        if data.get('col'): additionalColumns = data['col']
-        if data.get('hidecol'): withoutColumns = data['hidecol']
-        sizeIndex, fileDateIndex = None, None
-        if not data.get('keepDatabaseOpen'): self.db.open()
-        itemKeywordsOp = ""
-        tableColumns = (('Name', 'item_name', quote),
-                        ('Source', 'item_source', quote),
-                        ('Description', 'item_description', quote))
-        SQLWhere = []
-        keywordsWhere = ''
-        itemKeywordsType = "Phrase"
+    def planItemSearch(self, data):
+        ## Compiles the filters of an item search into a SearchPlan. Every filter the database can decide
+        ## becomes a predicate with bound parameters, so one statement returns, counts or limits the matches.
+        plan = SearchPlan(self.db)
+        textColumns = ('item_name', 'item_source', 'item_description')
+        ## MATCH expressions of the included keywords, combined to rank results for --sortby relevance.
+        fullTextMatches = list()
+        SQLFullText = "( i.item_id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ?) )"
         itemKeywords = data.get('searchterms')
         self.logger.debug(itemKeywords)
-        if itemKeywords:
-            fieldsWhere = list()
-            for nounName, col, wordFunction in tableColumns:
-                if itemKeywordsType == "Keywords":
-                    i = 0
-                    for word in itemKeywords.split():
-                        i += 1
-                        if i == 1:
-                            keywordsWhere = "({0} LIKE '%{1}%'".format(col, wordFunction(word))
-                        else:
-                            keywordsWhere += " AND {0} LIKE '%{1}%'".format(col, wordFunction(word))
-                elif itemKeywordsType == "Phrase":
-                    keywordsWhere = "({0} LIKE '%{1}%'".format(col, wordFunction(itemKeywords))
-                keywordsWhere += ") \n"
-                fieldsWhere.append(keywordsWhere)
-            SQLName = "(" + " OR ".join(fieldsWhere) + ")"
-            SQLWhere.append("{}".format(itemKeywordsOp) + SQLName)
-            self.logger.debug(SQLWhere)
-
-        _colsearches = list()
-        if data.get("name"): _colsearches.append((data['name'], "", "item_name"))
-        if data.get("source"): _colsearches.append((data['source'], "", "item_source"))
-        if data.get("description"): _colsearches.append((data['description'], "", "item_description"))
-        if data.get("withoutname"): _colsearches.append((data['withoutname'], "NOT ", "item_name"))
-        if data.get("withoutsource"): _colsearches.append((data['withoutsource'], "NOT ", "item_source"))
-        if data.get("withoutdescription"): _colsearches.append((data['withoutdescription'], "NOT ", "item_description"))
-        if len(_colsearches) > 0:
-            for colSearchPhrase, operator, column in _colsearches:
-                fieldsWhere = list()
-                keywordsWhere = "({0} LIKE '%{1}%'".format(column, quote(colSearchPhrase))
-                keywordsWhere += ") \n"
-                fieldsWhere.append(keywordsWhere)
-                SQLName = "(" + " OR ".join(fieldsWhere) + ")"
-                SQLWhere.append("{}".format(operator) + SQLName)
-                self.logger.debug(SQLWhere)
+        matchQuery = None
+        if itemKeywords and self.db.fullTextSearch:
+            matchQuery = self.db.fullTextQuery(itemKeywords.split(), phrase=True)
+        if matchQuery:
+            plan.filter(SQLFullText, matchQuery)
+            fullTextMatches.append(matchQuery)
+        elif itemKeywords:
+            plan.filter("( " + " OR ".join("( i.{} LIKE ? )".format(col) for col in textColumns) + " )",
+                        *["%{}%".format(itemKeywords)] * len(textColumns))
+
+        if data.get('sizemorethan'): plan.minSize = unformatBytes(data['sizemorethan'])
+        if data.get('sizelessthan'): plan.maxSize = unformatBytes(data['sizelessthan'])
+        ## File sizes and dates come from file_state unless --verify-stat asks for the files themselves.
+        plan.fileState = not data.get('verifystat')
+        if data.get('query'):
+            compiler = QueryCompiler(self.db, self.config['taxonomies'], self.config['itemTypes'],
+                                     includeDescendants=data.get('includedescendants'), fileState=plan.fileState)
+            predicate, params, (minSize, maxSize) = compiler.compile(data['query'])
+            if predicate: plan.filter(predicate, *params)
+            if compiler.usesFileState: plan.usesFileState = True
+            fullTextMatches.extend(compiler.fullTextMatches)
+            if minSize is not None: plan.minSize = max(minSize, plan.minSize or 0)
+            if maxSize is not None: plan.maxSize = maxSize if plan.maxSize is None else min(maxSize, plan.maxSize)
+        if plan.fileState: plan.filterFileSize()
+
+        _colsearches = (("name", "", "item_name"), ("source", "", "item_source"),
+                        ("description", "", "item_description"), ("withoutname", "NOT ", "item_name"),
+                        ("withoutsource", "NOT ", "item_source"), ("withoutdescription", "NOT ", "item_description"))
+        for key, operator, column in _colsearches:
+            if data.get(key): plan.filter("{}( i.{} LIKE ? )".format(operator, column), "%{}%".format(data[key]))
 
         _keywords = list()
         if data.get("withkeywords"): _keywords.append((data['withkeywords'],""))
         if data.get("withoutkeywords"): _keywords.append((data['withoutkeywords'], "NOT "))
-        if len(_keywords) > 0:
-            for keyWords, operator in _keywords:
-                fieldsWhere = list()
-                for nounName, col, wordFunction in tableColumns:
-                    i = 0
-                    for word in keyWords:
-                        i += 1
-                        if i == 1:
-                            keywordsWhere = "({0} LIKE '%{1}%'".format(col, wordFunction(word))
-                        else:
-                            keywordsWhere += " AND {0} LIKE '%{1}%'".format(col, wordFunction(word))
-                    keywordsWhere += ") \n"
-                    fieldsWhere.append(keywordsWhere)
-                SQLName = "(" + " OR ".join(fieldsWhere) + ")"
-                SQLWhere.append("{}".format(operator) + SQLName)
-                self.logger.debug(SQLWhere)
-
-        if data.get('nullcol'):
-            tableNames = dict(name="name", description="description", source="source", md5="md5")
-            for nullcol in data['nullcol']:
-                if not nullcol in tableNames: continue
-                nullSQL = "( i.item_{0} IS NULL) OR (i.item_{0} IS '' )".format(tableNames[nullcol])
-                SQLWhere.append(nullSQL)
-        if data.get('withoutnullcol'):
-            tableNames = dict(name="name", description="description", source="source", md5="md5")
-            for nullcol in data['withoutnullcol']:
-                if not nullcol in tableNames: continue
-                nullSQL = "( (i.item_{0} IS NOT NULL) AND (i.item_{0} IS NOT '') )".format(tableNames[nullcol])
-                SQLWhere.append(nullSQL)
-
-        if data.get("withitemtype"):
-            itemTypes = list()
-            for itemtype in data['withitemtype']:
-                typeListResult = self.config['itemTypes'].get(itemtype.capitalize())
-                if typeListResult: itemTypes.append(typeListResult.nounName)
-            sqlAnyTypesWhere = "( i.type_id = '{0}' )".format(itemTypes.pop(0))
-            for itemType in itemTypes: sqlAnyTypesWhere += " OR ( i.type_id = '{0}' )".format(itemType)
-            SQLWhere.append("( {} )".format(sqlAnyTypesWhere))
-
-        if data.get("withoutitemtype"):
-            for itemtype in data['withoutitemtype']:
-                typeListResult = self.config['itemTypes'].get(itemtype.capitalize())
-                if typeListResult: itemtype = typeListResult.nounName
-                SQLWhere.append("( i.type_id {0} '{1}' )".format("<>", itemtype))
-        if data.get("withfileext"):
-            for fileext in data['withfileext']:
-                SQLWhere.append("( i.item_ext {0} '{1}' )".format("=", fileext))
-        if data.get("withoutfileext"):
-            for fileext in data['withoutfileext']:
-                SQLWhere.append("( i.item_ext {0} '{1}' )".format("<>", fileext))
-        if data.get("md5"): SQLWhere.append("( i.item_md5 GLOB '{}*' )".format(str(data['md5'])))
-        if data.get("md5file"): SQLWhere.append("( i.item_md5 GLOB '{}*' )".format(getMD5FromPath(data['md5file'])))
-
-        if data.get("withprimarycategory"):
-            catResults = self.getCategoryFromInput(data["withprimarycategory"])
-            if catResults:
-                SQLWhere.append("( i.item_primary_category {0} '{1}' )".format("=", catResults[0][FCM.CatCol['Iden']]))
-        if data.get("withoutprimarycategory"):
-            catResults = self.getCategoryFromInput(data["withoutprimarycategory"])
-            if catResults:
-                SQLWhere.append("( i.item_primary_category {0} '{1}' )".format("<>", catResults[0][FCM.CatCol['Iden']]))
-
-        _withdaterange = list()
-        if data.get("withdaterange") and (len(data.get('withdaterange')) == 2):
-            _withdaterange.append((data['withdaterange'][0],  data['withdaterange'][1], "BETWEEN"))
-        if data.get("withoutdaterange") and (len(data.get('withoutdaterange')) == 2):
-            _withdaterange.append((data['withoutdaterange'][0], data['withoutdaterange'][1], "NOT BETWEEN"))
-        if len(_withdaterange) > 0:
-            import dateutil.parser
-            for itemDateFrom, itemDateTo, operator in _withdaterange:
-                SQLWhere.append("( item_time {0} '{1}' AND '{2}' )".format(operator, itemDateFrom, itemDateTo))
-        if data.get('withdategreaterthan'):
-            import dateutil.parser
-            itemDateFrom = dateutil.parser.parse(data['withdategreaterthan'])
-            SQLWhere.append("( item_time {0} '{1}' )".format(">", itemDateFrom))
-        if data.get('withdatelessthan'):
-            import dateutil.parser
-            itemDateFrom = dateutil.parser.parse(data['withdatelessthan'])
-            SQLWhere.append("( item_time {0} '{1}' )".format("<", itemDateFrom))
-
-        ## creation date
-        _withcdaterange = list()
-        if data.get("withcdaterange") and (len(data.get('withcdaterange')) == 2):
-            _withcdaterange.append((data['withcdaterange'][0], data['withcdaterange'][1], "BETWEEN"))
-        if data.get("withoutcdaterange") and (len(data.get('withoutcdaterange')) == 2):
-            _withcdaterange.append((data['withoutcdaterange'][0], data['withoutcdaterange'][1], "NOT BETWEEN"))
-        if len(_withcdaterange) > 0:
-            import dateutil.parser
-            for itemDateFrom, itemDateTo, operator in _withdaterange:
-                SQLWhere.append("( item_creation_time {0} '{1}' AND '{2}' )".format(operator, itemDateFrom, itemDateTo))
-        if data.get('withcdategreaterthan'):
-            import dateutil.parser
-            itemDateFrom = dateutil.parser.parse(data['withcdategreaterthan'])
-            SQLWhere.append("( item_creation_time {0} '{1}' )".format(">", itemDateFrom))
-        if data.get('withcdatelessthan'):
-            import dateutil.parser
-            itemDateFrom = dateutil.parser.parse(data['withcdatelessthan'])
-            SQLWhere.append("( item_creation_time {0} '{1}' )".format("<", itemDateFrom))
-
-        if data.get('withidgreaterthan'): SQLWhere.append("( item_id {0} '{1}' )".format(">", data['withidgreaterthan']))
-        if data.get('withidlessthan'): SQLWhere.append("( item_id {0} '{1}' )".format("<", data['withidlessthan']))
+        for keyWords, operator in _keywords:
+            matchQuery = self.db.fullTextQuery(keyWords) if self.db.fullTextSearch else None
+            if matchQuery:
+                plan.filter("{}".format(operator) + SQLFullText, matchQuery)
+                if not operator: fullTextMatches.append(matchQuery)
+                continue
+            fieldsWhere = ["( " + " AND ".join("i.{} LIKE ?".format(col) for word in keyWords) + " )"
+                           for col in textColumns]
+            plan.filter("{}( ".format(operator) + " OR ".join(fieldsWhere) + " )",
+                        *["%{}%".format(word) for col in textColumns for word in keyWords])
+
+        nullColumns = dict(name="item_name", description="item_description", source="item_source", md5="item_md5")
+        for nullcol in data.get('nullcol') or ():
+            if nullcol in nullColumns:
+                plan.filter("( (i.{0} IS NULL) OR (i.{0} IS '') )".format(nullColumns[nullcol]))
+        for nullcol in data.get('withoutnullcol') or ():
+            if nullcol in nullColumns:
+                plan.filter("( (i.{0} IS NOT NULL) AND (i.{0} IS NOT '') )".format(nullColumns[nullcol]))
+
+        if data.get("withitemtype") or data.get("withoutitemtype"):
+            typeIdens = self.db.selectItemTypeIdens()
+            for itemTypes, operator in ((data.get("withitemtype"), "IN"), (data.get("withoutitemtype"), "NOT IN")):
+                if not itemTypes: continue
+                idens = list()
+                for itemtype in itemTypes:
+                    typeListResult = self.config['itemTypes'].get(itemtype.capitalize())
+                    if typeListResult and typeListResult.nounName in typeIdens:
+                        idens.append(typeIdens[typeListResult.nounName])
+                if idens:
+                    plan.filter("( i.type_id {} ({}) )".format(operator, ", ".join("?" * len(idens))), *idens)
+                elif operator == "IN": plan.filterNothing()
+        for fileext in data.get("withfileext") or ():
+            plan.filter("( i.item_ext = ? )", fileext)
+        for fileext in data.get("withoutfileext") or ():
+            plan.filter("( i.item_ext <> ? )", fileext)
+        if data.get("md5"):
+            ## One prefix per digest tag, each searching the item_md5 index. In a subquery, as the ORDER BY on
+            ## item_id would otherwise have SQLite scan the items instead.
+            patterns = [taggedDigest(algorithm, str(data['md5']))+"*" for algorithm in hashAlgorithms]
+            plan.filter("( i.item_id IN (SELECT md.item_id FROM items AS md WHERE {}) )".format(
+                " OR ".join("md.item_md5 GLOB ?" for pattern in patterns)), *patterns)
+        if data.get("md5file"):
+            md5File = data['md5file']
+            if isURL(md5File):
+                md5File = getTmpPath()
+                if not downloadFile(data['md5file'], md5File): md5File = None
+            if md5File and os.path.isfile(md5File):
+                digests = FileHasher.hashFileMulti(md5File, self.db.selectDigestAlgorithms())
+                if digests: plan.filter("( i.item_md5 IN ({}) )".format(", ".join("?" * len(digests))), *digests)
+                else: plan.filterNothing()
+            else: plan.filterNothing()
+
+        for key, operator in (("withprimarycategory", "="), ("withoutprimarycategory", "<>")):
+            if data.get(key):
+                category, taxonomy = self.getCategoryFromInput(data[key])
+                if category: plan.filter("( i.item_primary_category {} ? )".format(operator), category[FCM.CatCol['Iden']])
+
+        ## Item times are stored as epochs, so the dates are parsed and compared against the time indexes.
+        for column, prefix in (("i.item_time", "with{}date"), ("i.item_creation_time", "with{}cdate")):
+            _dateranges = list()
+            if data.get(prefix.format("")+"range") and len(data[prefix.format("")+"range"]) == 2:
+                _dateranges.append((data[prefix.format("")+"range"], "BETWEEN"))
+            if data.get(prefix.format("out")+"range") and len(data[prefix.format("out")+"range"]) == 2:
+                _dateranges.append((data[prefix.format("out")+"range"], "NOT BETWEEN"))
+            for key, operator in ((prefix.format("")+"greaterthan", ">"), (prefix.format("")+"lessthan", "<")):
+                if data.get(key): _dateranges.append(((data[key],), operator))
+            if _dateranges:
+                import dateutil.parser
+            for dates, operator in _dateranges:
+                epochs = [self.db.toEpoch(dateutil.parser.parse(date)) for date in dates]
+                plan.filter("( {} {} {} )".format(column, operator, " AND ".join("?" * len(epochs))), *epochs)
+
+        if data.get('withidgreaterthan'): plan.filter("( i.item_id > ? )", int(data['withidgreaterthan']))
+        if data.get('withidlessthan'): plan.filter("( i.item_id < ? )", int(data['withidlessthan']))
 
         _taxonomies = list()
         if data.get("withtaxonomies"): _taxonomies.append((data['withtaxonomies'], "IN"))
         if data.get("withouttaxonomies"): _taxonomies.append((data['withouttaxonomies'], "NOT IN"))
-        if len(_taxonomies) > 0:
-            for taxonomies, operator in _taxonomies:
-                for taxonomy in taxonomies:
-                    tax = None
-                    self.logger.debug(taxonomy)
-                    taxListResult = self.config['taxonomies'].get(taxonomy.capitalize())
-                    if taxListResult: tax = taxListResult.tableName
-                    SQLTaxonomy = "SELECT tr.item_id \n" \
-                                  "FROM term_relationships AS tr \n" \
-                                  "INNER JOIN terms AS t ON (t.term_id = tr.term_id) \n" \
-                                  "WHERE ( t.term_taxonomy = '{}' )".format(tax)
-                    SQLWhere.append("( i.item_id {0} (\n{1}\n) )".format(operator, SQLTaxonomy))
+        for taxonomies, operator in _taxonomies:
+            for taxonomy in taxonomies:
+                tax = None
+                taxListResult = self.config['taxonomies'].get(taxonomy.capitalize())
+                if taxListResult: tax = taxListResult.tableName
+                plan.filter("( i.item_id {} (SELECT tr.item_id FROM term_relationships AS tr "
+                            "INNER JOIN terms AS t ON (t.term_id = tr.term_id) "
+                            "WHERE ( t.term_taxonomy = ? )) )".format(operator), tax)
+
+        if data.get('includedescendants'):
+            SQLCategories = "SELECT tr.item_id FROM term_closure AS c " \
+                            "INNER JOIN term_relationships AS tr ON (tr.term_id = c.descendant_id) " \
+                            "WHERE ( c.ancestor_id IN ({}) )"
+        else:
+            SQLCategories = "SELECT tr.item_id FROM term_relationships AS tr WHERE ( tr.term_id IN ({}) )"
+        ## With the category_bitmaps option the category filters are combined as bitmaps into one id list.
+        useBitmaps = self.config['options'].get('category_bitmaps')
+        bitmapGroup = lambda catID: self.db.selectCategoryDescendants(catID) if data.get('includedescendants') \
+            else [catID]
+        bitmapGroups = {"IN": list(), "NOT IN": list()}
         _categories = list()
         if data.get("withcategories"): _categories.append((data['withcategories'], "IN"))
         if data.get("withoutcategories"): _categories.append((data['withoutcategories'], "NOT IN"))
-        if len(_categories) > 0:
-            for categories, operator in _categories:
-                for cat in categories:
-                    self.logger.debug(cat)
-                    catResults, taxonomy = self.getCategoryFromInput(cat)
-                    self.logger.debug(catResults)
-                    categoryIden = -9999
-                    if catResults: categoryIden = catResults[0]
-                    else:  self.logger.warning("Category not found")
-                    SQLTaxonomy = "SELECT tr.item_id \n" \
-                                  "FROM term_relationships AS tr \n" \
-                                  "INNER JOIN terms AS t ON (t.term_id = tr.term_id) \n" \
-                                  "WHERE ( t.term_taxonomy = '{}' )".format(taxonomy)
-                    SQLTaxonomy += " AND ( tr.term_id = '{0}' )".format(categoryIden)
-                    SQLWhere.append("( i.item_id {0} (\n{1}\n) )".format(operator, SQLTaxonomy))
-
-        _anytax = list()
-        if data.get("anytax"): _anytax.append((data['anytax'], "IN"))
-        if len(_anytax) > 0:
-            for categories, operator in _anytax:
-                __catIdens = list()
-                for cat in categories:
-                    for tax in self.config['taxonomies']:
-                        tax = tax.tableName
-                        catResults, taxonomy = self.getCategoryFromInput(tax+":"+cat)
-                        if catResults: __catIdens.append(catResults[0])
-                if len(__catIdens) > 0:
-                    if not data.get("withanycategories"):
-                        data['withanycategories'] = __catIdens
-                    else:
-                        for _iden in __catIdens: data['withanycategories'].append(_iden)
-
-        _catsearch = list()
-        if data.get("catsearch"): _catsearch.append((data['catsearch'], "IN"))
-        if len(_catsearch) > 0:
-            print(_catsearch)
-            for categories, operator in _catsearch:
-                __catIdens = list()
-                for cat in categories:
-                    catResults = self.searchCategories({"importedmode":1, "searchterms":cat})
-                    if catResults:
-                        for _catresult in catResults:
-                            __catIdens.append(_catresult[0])
-                if len(__catIdens) > 0:
-                    print(__catIdens)
-                    if not data.get("withanycategories"):
-                        data['withanycategories'] = __catIdens
-                    else:
-                        for _iden in __catIdens: data['withanycategories'].append(_iden)
-
-
-        _categories = list()
-        if data.get("withanycategories"): _categories.append((data['withanycategories'], "IN"))
-        if len(_categories) > 0:
-            for categories, operator in _categories:
-                __catIdens = list()
-                for cat in categories:
-                    self.logger.debug(cat)
-                    catResults, taxonomy = self.getCategoryFromInput(cat)
-                    self.logger.debug(catResults)
-                    if catResults: __catIdens.append(catResults[0])
-                    else: self.logger.warning("Category not found")
-                if len(__catIdens) > 0:
-                    sqlAnyCatsWhere = "WHERE ( tr.term_id = '{0}' )".format(__catIdens.pop(0))
-                    for cat in __catIdens: sqlAnyCatsWhere += " OR ( tr.term_id = '{0}' )".format(cat)
-                    SQLAnyCats = "SELECT tr.item_id \n" \
-                                  "FROM term_relationships AS tr \n" \
-                                  "INNER JOIN terms AS t ON (t.term_id = tr.term_id) \n"
-                    SQLAnyCats += sqlAnyCatsWhere
-                    SQLWhere.append("( i.item_id {0} (\n{1}\n) )".format(operator, SQLAnyCats))
-                else: SQLWhere.append("( i.item_id == '-999999' )")
-
-
-
+        for categories, operator in _categories:
+            for cat in categories:
+                self.logger.debug(cat)
+                category, taxonomy = self.getCategoryFromInput(cat)
+                if category and useBitmaps:
+                    bitmapGroups[operator].append(bitmapGroup(category[FCM.CatCol['Iden']]))
+                elif category:
+                    plan.filter("( i.item_id {} ({}) )".format(operator, SQLCategories.format("?")),
+                                category[FCM.CatCol['Iden']])
+                else:
+                    self.logger.warning("Category not found")
+                    if operator == "IN": plan.filterNothing()
+
+        anyCategories = list()
+        for cat in data.get("anytax") or ():
+            for tax in self.config['taxonomies']:
+                category, taxonomy = self.getCategoryFromInput(tax.tableName+":"+cat)
+                if category: anyCategories.append(category[FCM.CatCol['Iden']])
+        for cat in data.get("catsearch") or ():
+            catResults = self.searchCategories({"importedmode":1, "searchterms":cat})
+            if catResults: anyCategories.extend(catResult[FCM.CatCol['Iden']] for catResult in catResults)
+        for cat in data.get("withanycategories") or ():
+            self.logger.debug(cat)
+            category, taxonomy = self.getCategoryFromInput(cat)
+            if category: anyCategories.append(category[FCM.CatCol['Iden']])
+            else: self.logger.warning("Category not found")
+        anyGroups = [bitmapGroup(catID) for catID in anyCategories] if useBitmaps else ()
+        if anyCategories and not useBitmaps:
+            plan.filter("( i.item_id IN ({}) )".format(SQLCategories.format(", ".join("?" * len(anyCategories)))),
+                        *anyCategories)
+        elif not anyCategories and (data.get("withanycategories") or data.get("anytax") or data.get("catsearch")):
+            plan.filterNothing()
+        if bitmapGroups["IN"] or bitmapGroups["NOT IN"] or anyGroups:
+            import json
+            bitmap, negative = self.categoryBitmaps.evaluate(bitmapGroups["IN"], anyGroups, bitmapGroups["NOT IN"])
+            plan.filter("( i.item_id {} (SELECT value FROM json_each(?)) )".format("NOT IN" if negative else "IN"),
+                        json.dumps(list(CategoryBitmaps.idens(bitmap))))
 
         _items = list()
         if data.get("withitems"): _items.append((data['withitems'], "IN"))
         if data.get("withoutitems"): _items.append((data['withoutitems'], "NOT IN"))
-        if len(_items) > 0:
-            for itemPaths, operator in _items:
-                __itemIdens = list()
-                for itemPath in itemPaths:
-                    self.logger.debug(itemPath)
-                    item = self.getItemFromPath(itemPath)
-                    if item: __itemIdens.append(item[0])
-                    else: self.logger.warning("Item not found")
-                if len(__itemIdens) > 0:
-                    sqlAnyItemsWhere = "WHERE ( i.item_id = '{0}' )".format(__itemIdens.pop(0))
-                    for itemId in __itemIdens: sqlAnyItemsWhere += " OR ( i.item_id = '{0}' )".format(itemId)
-                    SQLAnyItems = "SELECT i.item_id \n" \
-                                 "FROM items AS i \n"
-                    SQLAnyItems += sqlAnyItemsWhere
-                    SQLWhere.append("( i.item_id {0} (\n{1}\n) )".format(operator, SQLAnyItems))
+        for itemPaths, operator in _items:
+            itemIdens = list()
+            for itemPath in itemPaths:
+                self.logger.debug(itemPath)
+                item = self.getItemFromPath(itemPath)
+                if item: itemIdens.append(item[FCM.ItemCol['Iden']])
+                else: self.logger.warning("Item not found")
+            if itemIdens:
+                plan.filter("( i.item_id {} ({}) )".format(operator, ", ".join("?" * len(itemIdens))), *itemIdens)
+            elif operator == "IN": plan.filterNothing()
+
+        _sets = list()
+        if data.get("inset"): _sets.append((data['inset'], "IN"))
+        if data.get("notinset"): _sets.append((data['notinset'], "NOT IN"))
+        for setNames, operator in _sets:
+            for setName in setNames:
+                resultSet = self.db.selectResultSet(setName)
+                if resultSet:
+                    plan.filter("( i.item_id {} (SELECT rs.item_id FROM result_set_items AS rs WHERE rs.set_id = ?) )"
+                                .format(operator), resultSet[0])
                 else:
-                    SQLWhere.append("( i.item_id == '-999999' )")
+                    self.logger.warning("Result set not found: "+setName)
+                    if operator == "IN": plan.filterNothing()
 
         if data.get("withduplicate"):
-            duplicateCol = data.get("withduplicate").lower()
-            SQLDuplicate = '''
-            SELECT a.item_id
-            FROM items as a
-            JOIN (SELECT item_{0}, COUNT(*)
-            FROM items 
-            GROUP BY item_{0}
-            HAVING count(*) > 1 ) as b
-            ON a.item_{0} = b.item_{0}
-            '''.format(duplicateCol)
-            SQLWhere.append("( i.item_id {0} (\n{1}\n) )".format("IN", SQLDuplicate))
-        if len(SQLWhere) > 0:
-            whereJoined = "\nWHERE "+" AND \n".join(SQLWhere)
-        else:
-            whereJoined = ''
-        SQL = "SELECT DISTINCT i.item_id AS 'ID', item_name AS 'Name', \n" \
-              "type_id AS 'Type', item_time AS 'Time', item_source AS 'Source', item_ext AS 'ext',  \n" \
-              "( SELECT COUNT(*) FROM term_relationships WHERE term_relationships.item_id = i.item_id ) AS 'Relations', \n" \
-              "item_creation_time as 'CreationTime', item_description as 'Description', \n" \
-              "item_md5 as 'Md5' \n" \
-              "FROM items AS i {} \n".format(whereJoined)
+            duplicateColumns = dict(name="item_name", md5="item_md5", source="item_source", ext="item_ext",
+                                    description="item_description", type="type_id")
+            duplicateCol = duplicateColumns.get(data["withduplicate"].lower())
+            if duplicateCol:
+                plan.filter("( i.{0} IN (SELECT {0} FROM items GROUP BY {0} HAVING COUNT(*) > 1) )".format(duplicateCol))
+            else: self.logger.error("Unknown duplicate column: {}".format(data["withduplicate"]))
+
+        _itemcounts = (("withcategorycount", "="), ("withoutcategorycount", "<>"),
+                       ("countmorethan", ">"), ("countlessthan", "<"))
+        for key, operator in _itemcounts:
+            if data.get(key): plan.filter("( {} {} ? )".format(plan.relationCount, operator), int(data[key]))
+
         if data.get('sortby'):
             sortBy = data['sortby'].lower()
-            keys = {"iden": "i.item_id", "name": "i.item_name", "type": "i.type_id", "date": "i.item_time",
-                    "source": "i.item_source", "ext": "i.item_ext", "categories":"Relations",
-                    "md5": "i.item_md5", "creationdate": "i.item_creation_time"}
-            if sortBy in keys:
-                directionOrder = "ASC"
-                if data.get("desc"): directionOrder = "DESC"
-                SQL += "ORDER BY {} {}".format(keys[sortBy],directionOrder)
-            else: SQL += "ORDER BY i.item_id ASC"
-        else: SQL += "ORDER BY i.item_id ASC"
-        self.logger.debug(SQL)
-        query = self.db.cur.execute(SQL)
-        searchResults = query.fetchall()
+            keys = {"iden": "i.item_id", "name": "i.item_name COLLATE NOCASE", "type": "ty.noun_name",
+                    "date": "i.item_time", "source": "i.item_source", "ext": "i.item_ext",
+                    "categories": plan.relationCount, "md5": "i.item_md5", "creationdate": "i.item_creation_time"}
+            if plan.fileState: keys.update(size=plan.fileSize, filedate=plan.fileModified)
+            if sortBy == "relevance" and fullTextMatches:
+                ## bm25 scores are negative, lower is more relevant. Name matches weigh most, then description.
+                plan.join("LEFT JOIN (SELECT rowid, bm25(items_fts, 10.0, 1.0, 2.0) AS rank \n"
+                          "FROM items_fts WHERE items_fts MATCH ?) AS fts ON (fts.rowid = i.item_id)",
+                          " AND ".join("({})".format(match) for match in fullTextMatches))
+                keys['relevance'] = "fts.rank"
+            if sortBy in keys: plan.sortBy(keys[sortBy], "DESC" if data.get("desc") else "ASC")
+        return plan
+
+    def searchFacets(self, data):
+        ## Counts the categories of each taxonomy named in data['facets'], and the item types and extensions
+        ## for "type" and "ext", among every item the search filters match. Paging, --first, --last and
+        ## file checks don't apply to the counts.
+        facetNames = data['facets'] if isinstance(data['facets'], list) else data['facets'].split(",")
+        taxonomies, columns, facets = list(), list(), dict()
+        for facetName in (name.strip().lower() for name in facetNames if name.strip()):
+            if facetName in SearchPlan.facetColumns: columns.append(facetName)
+            else:
+                taxListResult = self.config['taxonomies'].get(facetName.capitalize())
+                if not taxListResult:
+                    self.logger.warning("Unknown facet: "+facetName)
+                    continue
+                facetName = taxListResult.tableName
+                taxonomies.append(facetName)
+            facets[facetName] = list()
+        with self.session(transaction=False):
+            plan = self.planItemSearch(data)
+            for facet, value, count in plan.facets(taxonomies, columns, abs(int(data.get('facetlimit') or 10))):
+                facets[facet].append((value, count))
+        if self.importedMode or data.get('importedmode'): return facets
+        for facet, values in facets.items():
+            print(facet+":")
+            for value, count in values: print("    {} ({})".format(value if value else "-", count))
+
+    def explainItemSearch(self, plan, data):
+        ## Prints the statement a search runs, its parameters, the checks made on the files of the rows it
+        ## returns and SQLite's query plan.
+        sql, params, queryPlan = plan.explain()
+        print(sql)
+        print("\nParameters: "+", ".join(repr(param) for param in params))
+        fileChecks = list()
+        if plan.minSize is not None and not plan.fileState: fileChecks.append("size >= {} bytes".format(plan.minSize))
+        if plan.maxSize is not None and not plan.fileState: fileChecks.append("size <= {} bytes".format(plan.maxSize))
+        if data.get('withmissingfile'): fileChecks.append("missing file")
+        if data.get('withduplicatefile'): fileChecks.append("duplicate file")
+        if data.get('md5changed'): fileChecks.append("md5 changed")
+        if fileChecks: print("File checks: "+", ".join(fileChecks))
+        print("\nQuery plan:")
+        depths = dict()
+        for iden, parent, detail in queryPlan:
+            depths[iden] = depths.get(parent, -1) + 1
+            print("  " * depths[iden] + "|-- " + detail)
+
+    def searchItems(self, data):
+        if data.get('facets'): return self.searchFacets(data)
+        if data.get('timer'):
+            import time
+            timerStart = time.perf_counter()
+        additionalColumns, withoutColumns = [], []
+        if data.get('col'): additionalColumns = data['col']
+        if data.get('hidecol'): withoutColumns = data['hidecol']
+        sizeIndex, fileDateIndex, duplicateIndex = None, None, None
+        dataDir = self.config['options']['default_data_dir']
+        itemFilePath = lambda item: os.path.join(dataDir, self.config['itemTypes'].dirFromNoun(item[2]),
+                                                 str(item[0]) + '.' + item[5])
+        addFileDate = data.get('sortby') == "filedate" or 'filedate' in additionalColumns
+        pagedInSQL = False
+        with self.session(transaction=False):
+            plan = self.planItemSearch(data)
+            reordered = data.get('randomorder') or (data.get('sortby') == "size" and not plan.fileState)
+            if data.get('cursor') and reordered:
+                raise Exception("--cursor follows the SQL sort order, it can't be used with --random "
+                                "or --sortby size --verify-stat")
+            sizeFiltered = plan.minSize is not None or plan.maxSize is not None
+            sizeChecked = sizeFiltered and not plan.fileState
+            addSize = data.get('sortby') == "size" or sizeFiltered or "size" in additionalColumns \
+                or data.get('size') or data.get('sizenice')
+            if plan.fileState:
+                if addSize:
+                    sizeIndex = plan.columnCount + len(plan.extraColumns)
+                    plan.addColumn(plan.fileSize, 'Size')
+                if addFileDate:
+                    fileDateIndex = plan.columnCount + len(plan.extraColumns)
+                    plan.addColumn(plan.fileModified, 'FileDate')
+            ## Items added before file_state, or by an older version, are statted once before it's read.
+            if plan.usesFileState: self.fillFileStates()
+            fileFilters = data.get('withmissingfile') or sizeChecked or data.get('withduplicatefile')
+            ## Filtered searches read their ids from the search cache; an unfiltered one is as cheap to run again.
+            if (plan.where or plan.joins) and not (data.get('nocache') or data.get('cursor')):
+                plan.cache = self.searchCache
+            if data.get('cursor'): plan.seek(data['cursor'])
+            ## Files are only statted or hashed for the rows the SQL filters let through. --first, --last and
+            ## pages become a LIMIT unless a file check or a reordering has to see every row first;
+            ## --md5changed always hashes just the first or last rows.
+            if data.get('md5changed') or not (fileFilters or reordered):
+                if data.get('last'): plan.limit, plan.reverse = abs(int(data['last'])), True
+                elif data.get('first'): plan.limit = abs(int(data['first']))
+            ## Results the SQL alone decides are saved with one INSERT ... SELECT, the rest once they are read.
+            savedInSQL = False
+            if data.get('saveas') and not (fileFilters or data.get('md5changed') or data.get('randomorder')
+                                           or data.get('explain')):
+                self.saveResultSet(data['saveas'], *plan.statement(columns="i.item_id"))
+                savedInSQL = True
+            if data.get('itemsperpage') and not (data.get('first') or data.get('last') or fileFilters or reordered
+                                                 or data.get('md5changed')):
+                itemsPerPage = abs(int(data['itemsperpage']))
+                if data.get('cursor'): self.logger.debug("Paging from cursor")
+                elif data.get('page'): plan.offset = (max(int(data['page']), 1) - 1) * itemsPerPage
+                elif data.get('lastpage'): plan.offset = max(plan.count() - 1, 0) // itemsPerPage * itemsPerPage
+                plan.limit = itemsPerPage
+                pagedInSQL = True
+            if data.get('explain'):
+                self.explainItemSearch(plan, data)
+                return
+            if data.get('count') and not (fileFilters or data.get('md5changed')
+                                          or (reordered and (data.get('first') or data.get('last')))
+                                          or (data.get('itemsperpage') and not pagedInSQL)
+                                          or self.importedMode or data.get('importedmode') or data.get('launch')
+                                          or data.get('openinmanager') or data.get('printresultsdir')
+                                          or data.get('listnamedpaths') or data.get('listids')
+                                          or data.get('listpaths')):
+                print(plan.count())
+                return
+            sampleSize, sampler = data.get('first') or data.get('last'), None
+            if data.get('randomorder'):
+                import random
+                sampler = random.Random(data.get('seed'))
+            ## A random --first/--last is a sample drawn while streaming, before any files are read when
+            ## no file check has to see every row.
+            if sampler and sampleSize and not (fileFilters or data.get('md5changed') or data.get('sortby') == "size"):
+                searchResults = plan.sample(abs(int(sampleSize)), sampler)
+                sampler = None
+            else: searchResults = plan.rows()
+
+            if data.get("md5changed"):
+                searchResults = (item for item, fileMd5 in self.hashCache.digestFiles(
+                                    ((item, itemFilePath(item)) for item in searchResults),
+                                    self.itemDigestAlgorithm, jobs=self.hashJobs)
+                                 if fileMd5 != item[FCM.ItemCol['Md5']])
+            if data.get("withmissingfile"):
+                searchResults = (item for item in searchResults if not os.path.exists(itemFilePath(item)))
+            if (addSize or addFileDate) and not plan.fileState:
+                if addSize: sizeIndex = plan.columnCount
+                if addFileDate: fileDateIndex = plan.columnCount + (1 if addSize else 0)
+
+                def withFileStats(items):
+                    for item in items:
+                        file_stats = os.stat(itemFilePath(item))
+                        if plan.minSize is not None and file_stats.st_size < plan.minSize: continue
+                        if plan.maxSize is not None and file_stats.st_size > plan.maxSize: continue
+                        newCols = []
+                        if addSize: newCols.append(file_stats.st_size)
+                        if addFileDate: newCols.append(file_stats.st_mtime)
+                        yield [*item, *newCols]
+                searchResults = withFileStats(searchResults)
+            if data.get('sortby') == "size" and not plan.fileState:
+                searchResults = sorted(searchResults, key=lambda a: a[sizeIndex], reverse=bool(data.get("desc")))
+
+            if data.get("withduplicatefile"):
+                ## Items whose files have the same content as another result's, listed set by set; each row
+                ## ends with the number of its set.
+                searchResults = list(searchResults)
+                itemFiles = ((index, itemFilePath(item)) for index, item in enumerate(searchResults)
+                             if not self.config['itemTypes'].get(item[2]).isWeblinks)
+                duplicates = DuplicateFinder(self.hashCache, self.hashJobs).clusters(itemFiles)
+                searchResults = [[*searchResults[index], duplicateSet]
+                                 for duplicateSet, (digest, indexes) in enumerate(duplicates, 1) for index in indexes]
+                if searchResults: duplicateIndex = len(searchResults[0]) - 1
+
+            if sampler and sampleSize:
+                searchResults = reservoirSample(searchResults, abs(int(sampleSize)), sampler)
+            elif sampler:
+                searchResults = list(searchResults)
+                sampler.shuffle(searchResults)
+            if data.get('last'): searchResults = list(searchResults)[-abs(int(data['last'])):]
+            elif data.get('first'):
+                import itertools
+                searchResults = itertools.islice(searchResults, abs(int(data['first'])))
+            searchResults = list(searchResults)
+            if data.get('md5changed') or data.get('withduplicatefile'): self.db.commit()
+            if data.get('saveas') and not savedInSQL:
+                self.saveResultSet(data['saveas'], idens=[item[FCM.ItemCol['Iden']] for item in searchResults])
+            ## A full page may have more after it; the cursor continues from its last row.
+            if (data.get('itemsperpage') or data.get('cursor')) and plan.limit and not plan.reverse \
+                    and len(searchResults) == plan.limit:
+                self.searchCursor = plan.cursorAfter(searchResults[-1][FCM.ItemCol['Iden']])
+            else: self.searchCursor = None
         self.logger.debug(searchResults)
-        if not data.get('keepDatabaseOpen'): self.db.close()
+        if self.searchCursor and not (self.importedMode or data.get('importedmode')):
+            print("Next cursor: "+self.searchCursor, file=sys.stderr)
         if len(searchResults) < 1:
             if data.get('count'): print(0)
             return
-        # if sortBy:
-        #     sortBy = sortBy.lower()
-        #     keys = {"iden":0,"name":1,"type":2,"date":3,"source":4,"ext":5}
-        #     if sortBy in keys:
-        #         if not data.get("desc"): data['desc'] = False
-        #         print(keys[sortBy])
-        #         searchResults.sort(key=lambda a: a[keys[sortBy]], reverse = data.get("desc"))
-        #         print(searchResults)
-
-        if data.get("withcategorycount"): searchResults = [i for i in searchResults if i[6] == int(data['withcategorycount'])]
-        if data.get("withoutcategorycount"): searchResults = [i for i in searchResults if not i[6] == int(data['withoutcategorycount'])]
-        if data.get("countmorethan"): searchResults = [i for i in searchResults if i[6] > int(data['countmorethan'])]
-        if data.get("countlessthan"): searchResults = [i for i in searchResults if i[6] < int(data['countlessthan'])]
-
-        # if data.get("md5"):
-        #     newSearchResults = list()
-        #     for index, item in enumerate(searchResults):
-        #         print(item[0])
-        #         filepath = os.path.join(self.config['options']['default_data_dir'],
-        #                                 self.config['itemTypes'].dirFromNoun(item[2]),
-        #                                 str(item[0]) + '.' + item[5])
-        #         if getMD5FromFile(filepath).startswith(data['md5']):
-        #             newSearchResults.append(item)
-        #     searchResults = newSearchResults
-
-
-
-        if data.get("md5changed"):
-            if data.get('last'):
-                searchResults = searchResults[-abs(int(data['last'])):]
-            elif data.get('first'):
-                searchResults = searchResults[:abs(int(data['first']))]
-            newSearchResults = list()
-            for index, item in enumerate(searchResults):
-                filepath = os.path.join(self.config['options']['default_data_dir'],
-                                        self.config['itemTypes'].dirFromNoun(item[2]),
-                                        str(item[0]) + '.' + item[5])
-                fileMD5 = getMD5FromFile(filepath)
-                itemMD5 = item[FCM.ItemCol['Md5']]
-                if fileMD5 != itemMD5: newSearchResults.append(item)
-            searchResults = newSearchResults
 
-
-        if data.get("withmissingfile"):
-            newSearchResults = list()
-            for index, item in enumerate(searchResults):
-                filepath = os.path.join(self.config['options']['default_data_dir'],
-                                        self.config['itemTypes'].dirFromNoun(item[2]),
-                                        str(item[0]) + '.' + item[5])
-                if not os.path.exists(filepath):
-                    newSearchResults.append(item)
-            searchResults = newSearchResults
-        if data.get('sortby') == "size" or data.get('sizemorethan') or data.get('sizelessthan') \
-                or "size" in additionalColumns or 'filedate' in additionalColumns or data.get('size') or data.get('sizenice'):
-            newSearchResults = list()
-            for index, item in enumerate(searchResults):
-                filepath = os.path.join(self.config['options']['default_data_dir'],
-                                        self.config['itemTypes'].dirFromNoun(item[2]),
-                                        str(item[0]) + '.' + item[5])
-                file_stats = os.stat(filepath)
-                if data.get('sizemorethan'):
-                    sizeMoreThan = unformatBytes(data.get('sizemorethan'))
-                    if file_stats.st_size < sizeMoreThan: continue
-                if data.get('sizelessthan'):
-                    sizeLessThan = unformatBytes(data.get('sizelessthan'))
-                    if file_stats.st_size > sizeLessThan: continue
-                newCols = []
-                itemIndexLength = len(item) - 1
-                if data.get('sortby') == "size" or data.get('sizemorethan') or data.get('sizelessthan') \
-                        or "size" in additionalColumns or data.get('size') or data.get('sizenice'):
-                    newCols.append(file_stats.st_size)
-                    itemIndexLength += 1
-                    sizeIndex = itemIndexLength
-                if data.get('sortby') == "filedate" or 'filedate' in additionalColumns:
-                    newCols.append(file_stats.st_mtime)
-                    itemIndexLength += 1
-                    fileDateIndex = itemIndexLength
-                newItem = [*item, *newCols]
-                newSearchResults.append(newItem)
-            if data.get('sortby') == "size":
-                if not data.get("desc"): data['desc'] = False
-                newSearchResults.sort(key=lambda a: a[sizeIndex], reverse = data.get("desc"))
-            searchResults = newSearchResults
-
-
-        if data.get("withduplicatefile"):
-            from filecmp import cmp
-            newSearchResults = list()
-            for index, item in enumerate(searchResults):
-                print(item)
-                if self.config['itemTypes'].get(item[2]).isWeblinks: continue
-                filepath = os.path.join(self.config['options']['default_data_dir'],
-                                        self.config['itemTypes'].dirFromNoun(item[2]),
-                                        str(item[0]) + '.' + item[5])
-                if not os.path.exists(filepath): continue
-                for index2, item2 in enumerate(searchResults):
-                    if self.config['itemTypes'].get(item2[2]).isWeblinks: continue
-                    filepath2 = os.path.join(self.config['options']['default_data_dir'],
-                                            self.config['itemTypes'].dirFromNoun(item2[2]),
-                                            str(item2[0]) + '.' + item2[5])
-                    if not os.path.exists(filepath2): continue
-                    if item == item2: continue
-                    if_dupl = cmp(
-                        filepath,
-                        filepath2,
-                        shallow=False
-                    )
-                    if if_dupl:
-                        newSearchResults.append(item)
-                        break
-            searchResults = newSearchResults
-
-        import random
-        if data.get('randomorder'): random.shuffle(searchResults)
-        if data.get('last'): searchResults = searchResults[-abs(int(data['last'])):]
-        elif data.get('first'): searchResults = searchResults[:abs(int(data['first']))]
-        if data.get('itemsperpage'):
+        if data.get('itemsperpage') and not pagedInSQL:
             itemPages = chunks(searchResults,abs(int(data['itemsperpage'])))
             if data.get('page'):
                 if int(data['page'])< 1: data['page'] = 1
@@ -1749,7 +1945,7 @@ class Filecatman:
             linksDir = os.path.join(searchResultsDir, dateTime)
             self.logger.debug(linksDir)
             for result in searchResults:
-                itemName = unquote(result[1])
+                itemName = result[1]
                 itemtype = result[2]
                 itemIden = result[0]
                 itemExt =  result[5]
@@ -1801,7 +1997,7 @@ class Filecatman:
         elif data.get('size') or data.get('sizenice'):
             totalSize = 0
             for searchItem in searchResults:
-                totalSize += searchItem[sizeIndex]
+                totalSize += searchItem[sizeIndex] or 0
             if data.get('sizenice'):
                 print(formatBytes(totalSize))
             else:
@@ -1815,31 +2011,31 @@ class Filecatman:
             if len(searchResults) > 0:
                 print('{')
                 i = 1
-                for item in searchResults:
-                    print('"'+str(item[FCM.ItemCol['Iden']])+'": ')
-                    self.inspectItem({"filepath": str(item[FCM.ItemCol['Iden']])})
-                    if i < len(searchResults):
-                        print(',')
-                    i+=1
+                with self.session(transaction=False):
+                    for item in searchResults:
+                        print('"'+str(item[FCM.ItemCol['Iden']])+'": ')
+                        self.inspectItem({"filepath": str(item[FCM.ItemCol['Iden']])})
+                        if i < len(searchResults):
+                            print(',')
+                        i+=1
                 print('}')
         elif data.get('export'):
-            if not data.get('keepDatabaseOpen'): self.db.open()
-            exportItems = list()
-            exportCategories = list()
-            for item in searchResults:
-                exportItems.append(self.db.selectItem(itemID=item[FCM.ItemCol['Iden']]))
-                relations = self.db.selectRelations(itemID=item[FCM.ItemCol['Iden']])
-                for rel in relations:
-                    category = self.db.selectCategory(catID=rel[0])
-                    exportCategories.append(category)
-            exportCategories = [*set(exportCategories)]
-            self.exportProject({'filepath': data['export'], 'exportresults': (exportCategories, exportItems)})
-            if not data.get('keepDatabaseOpen'): self.db.close()
+            with self.session(transaction=False):
+                exportItems = list()
+                exportCategories = list()
+                for item in searchResults:
+                    exportItems.append(self.db.selectItem(itemID=item[FCM.ItemCol['Iden']]))
+                    relations = self.db.selectRelations(itemID=item[FCM.ItemCol['Iden']])
+                    for rel in relations:
+                        category = self.db.selectCategory(catID=rel[0])
+                        exportCategories.append(category)
+                exportCategories = [*set(exportCategories)]
+                self.exportProject({'filepath': data['export'], 'exportresults': (exportCategories, exportItems)})
         else:
             colData =  []
             if not "iden" in withoutColumns: colData.append({'minlength':5, 'name':"Iden", 'index':0, 'functions':(str,), 'maxlength':50})
             if not "name" in withoutColumns:
-                nameFuncs = [unquote,]
+                nameFuncs = []
                 if data.get('noemoji'):
                     import cleantext
                     nameFuncs.append(cleantext.remove_emoji)
@@ -1849,21 +2045,24 @@ class Filecatman:
                 colData.append({'minlength':10, 'name':"Date", 'index':3, 'functions':(), 'maxlength':50})
             if not "cats" in withoutColumns: colData.append( {'minlength':5, 'name':"Cats", 'index':6, 'functions':(str,), 'maxlength':50})
             if data.get('sortby') == "source" or "source" in additionalColumns:
-                colData.append({'minlength': 10, 'name': "Source", 'index': 4, 'functions': (unquote,), 'maxlength':50})
+                colData.append({'minlength': 10, 'name': "Source", 'index': 4, 'functions': (), 'maxlength':50})
             if data.get('sortby') == "description" or "description" in additionalColumns:
-                colData.append({'minlength': 10, 'name': "Description", 'index': 8, 'functions': (unquote,), 'maxlength':50})
+                colData.append({'minlength': 10, 'name': "Description", 'index': 8, 'functions': (), 'maxlength':50})
             if not "md5" in withoutColumns:
                 colData.append({'minlength': 10, 'name': "Md5", 'index': 9, 'functions': (lambda a:a[:12]+"..",), 'maxlength':14})
             if data.get('sortby') == "creationdate" or data.get('withcdaterange') \
                     or data.get('withoutcdaterange') or data.get('withcdategreaterthan') or \
                     data.get('withcdatelessthan') or "creationdate" in additionalColumns:
                 colData.append({'minlength': 10, 'name': "Creation Date", 'index': 7, 'functions': (), 'maxlength':50})
-            if data.get('sortby') == "size" or data.get('sizemorethan') or data.get('sizelessthan') or "size" in additionalColumns:
-                colData.append({'minlength': 10, 'name': "Size", 'index': sizeIndex, 'functions': (formatBytes,), 'maxlength':50})
+            ## A missing file has no recorded size or date.
+            if data.get('sortby') == "size" or sizeFiltered or "size" in additionalColumns:
+                colData.append({'minlength': 10, 'name': "Size", 'index': sizeIndex, 'functions': (lambda a: "-" if a is None else formatBytes(a),), 'maxlength':50})
             if data.get('sortby') == "filedate" or "filedate" in additionalColumns:
-                colData.append({'minlength': 10, 'name': "File Modification Date", 'index': fileDateIndex, 'functions': (timeStampToString,), 'maxlength':50})
+                colData.append({'minlength': 10, 'name': "File Modification Date", 'index': fileDateIndex, 'functions': (lambda a: "-" if a is None else timeStampToString(a),), 'maxlength':50})
             if data.get('sortby') == "ext" or "ext" in additionalColumns:
                 colData.append({'minlength': 3, 'name': "Ext", 'index': 5, 'functions': (), 'maxlength':12})
+            if data.get('withduplicatefile'):
+                colData.append({'minlength': 5, 'name': "Duplicates", 'index': duplicateIndex, 'functions': (str,), 'maxlength':12})
 
             for index, col in enumerate(colData):
                 biggestLength = col['minlength']
@@ -1898,7 +2097,7 @@ class Filecatman:
             import subprocess, platform
             dataDir = self.config['options']['default_data_dir']
             for result in searchResults:
-                itemName = unquote(result[1])
+                itemName = result[1]
                 itemtype = result[2]
                 itemIden = result[0]
                 itemExt =  result[5]
@@ -1916,7 +2115,7 @@ class Filecatman:
 
 
     def createCategory(self, data):
-        if not data.get('keepDatabaseOpen'): self.db.open()
+        self.db.open()
         catResults, taxonomy = self.getCategoryFromInput(data['category'])
         self.logger.debug(catResults)
         if not catResults:
@@ -1926,12 +2125,12 @@ class Filecatman:
             else:
                 term = data['category']
             self.createTaxonomyIfNotExisting(taxonomy)
-            self.db.newCategory({"name": quote(term), "taxonomy": taxonomy})
+            self.db.newCategory({"name": term, "taxonomy": taxonomy})
             catID = self.db.lastInsertId
         else: self.logger.warning("Category already exists")
 
-        if not data.get('keepDatabaseOpen'): self.db.commit()
-        if not data.get('keepDatabaseOpen'): self.db.close()
+        self.db.commit()
+        self.db.close()
 
 
     def downloadItem(self, _data):
@@ -1948,164 +2147,151 @@ class Filecatman:
     def uploadItem(self, _data):
         import copy
         data = copy.deepcopy(_data)
-        keepDatabaseOpen = data.get('keepDatabaseOpen')
-        if not keepDatabaseOpen: self.db.open()
-        isWeblink = False
-        fileType, fileExtension = None, None
-        if os.path.exists(data['filepath']):
-            pass
-        elif isURL(data['filepath']):
-            isWeblink = True
-            fileExtension = desktopFileExt()
-            fileType = "Weblink"
-            data['source'] = data['filepath']
-
-        if data.get('datetime'):
-            import dateutil.parser
-            try:
-                data['datetime'] = dateutil.parser.parse(data['datetime']).strftime("%Y-%m-%d %H:%M:%S")
-            except dateutil.parser.ParserError:
-                data.pop("datetime")
-        else:
+        with self.session():
+            isWeblink = False
+            fileType, fileExtension = None, None
+            if os.path.exists(data['filepath']):
+                pass
+            elif isURL(data['filepath']):
+                isWeblink = True
+                fileExtension = desktopFileExt()
+                fileType = "Weblink"
+                data['source'] = data['filepath']
+
+            if data.get('datetime'):
+                import dateutil.parser
+                try:
+                    data['datetime'] = dateutil.parser.parse(data['datetime']).strftime("%Y-%m-%d %H:%M:%S")
+                except dateutil.parser.ParserError:
+                    data.pop("datetime")
+            else:
+                if not isWeblink:
+                    self.logger.debug(os.path.getmtime(data['filepath']))
+                    dt = datetime.datetime.fromtimestamp(os.path.getmtime(data['filepath']))
+                    self.logger.debug(dt.strftime("%Y-%m-%d %H:%M:%S"))
+                    data['datetime'] = dt.strftime("%Y-%m-%d %H:%M:%S")
+            if not data.get('creationtime'):
+                data['creationtime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+            if not data.get('name'):
+                if not isWeblink: data['name'] = os.path.basename(data['filepath'])
+                else: data['name'] = "Weblink"
             if not isWeblink:
-                self.logger.debug(os.path.getmtime(data['filepath']))
-                dt = datetime.datetime.fromtimestamp(os.path.getmtime(data['filepath']))
-                self.logger.debug(dt.strftime("%Y-%m-%d %H:%M:%S"))
-                data['datetime'] = dt.strftime("%Y-%m-%d %H:%M:%S")
-        if not data.get('creationtime'):
-            data['creationtime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        if not data.get('name'):
-            if not isWeblink: data['name'] = quote(os.path.basename(data['filepath']))
-            else: data['name'] = "Weblink"
-        else:  data['name'] = quote(data['name'])
-        if not isWeblink:
-            fileExtension = os.path.splitext(data['filepath'])[1][1:].lower().strip()
-            fileType = self.config['itemTypes'].nounFromExtension(fileExtension)
-        if not fileType:
-            import magic
-            magicFileType = magic.from_file(data['filepath'], mime=True)
-            self.logger.debug(magicFileType)
-            magicFileExtension = magicFileType.split("/")[1]
-            if magicFileExtension == "jpeg": magicFileExtension = "jpg"
-            if not fileExtension: fileExtension = magicFileExtension
-
-            fileType = self.config['itemTypes'].nounFromExtension(fileExtension)
-            if not fileType:
-                fileType = self.config['itemTypes'].nounFromExtension(magicFileExtension)
+                fileExtension = os.path.splitext(data['filepath'])[1][1:].lower().strip()
+                fileType = self.config['itemTypes'].nounFromExtension(fileExtension)
             if not fileType:
-                magicTypeName = magicFileType.split("/")[0]
-                self.logger.debug(magicTypeName)
-                # tableName = self.config['itemTypes'].tableFromNoun(magicTypeName)
-                if magicTypeName in self.config['itemTypes'].tableNames():
-                    fileTypeObj = self.config['itemTypes'][magicTypeName]
-                    fileTypeObj .addExtension(fileExtension)
-                    fileType = fileTypeObj.nounName
-                else:
-                    newItemTypeObj = ItemType()
-                    newItemTypeObj.setNounName(str(magicTypeName).capitalize())
-                    newItemTypeObj.setPluralName(pluralize(str(magicTypeName).capitalize()))
-                    newItemTypeObj.setDirName(pluralize(str(magicTypeName).capitalize()))
-                    newItemTypeObj.setTableName(str(magicTypeName))
-                    newItemTypeObj.setEnabled(True)
-                    if fileExtension:
-                        newItemTypeObj.addExtension(fileExtension)
-                    elif magicFileExtension:
-                        newItemTypeObj.addExtension(magicFileExtension)
-                    self.config['itemTypes'].append(newItemTypeObj)
-                    fileType = newItemTypeObj.nounName
-        if fileType:
-            if not data.get('type'): data['type'] = fileType
-            if not data.get('ext'): data['ext'] = fileExtension
-        else:
-            raise Exception("File type not recognised")
-        self.logger.debug(data)
-
-        if data.get('updateifduplicate') and not isWeblink:
-            existingItems = self.db.selectItems({"item_md5": getMD5FromFile(data['filepath'])})
-            if len(existingItems) > 0:
-                updateData = dict()
-                updateData['filepath'] = str(existingItems[0][0])
-                if data.get('categories'): updateData['addcategories'] = data['categories']
-                if data.get('source'): updateData['setsource'] = data['source']
-                if data.get('description'): updateData['setdescription'] = data['description']
-                if data.get('primarycategory'): updateData['setprimarycategory'] = data['primarycategory']
-                if data.get('datetime'): updateData['setdatetime'] = data['datetime']
-                if data.get('name'): updateData['setname'] = data['name']
-                return self.updateItem(updateData)
-
-        self.db.newItem(data)
-        fileID = self.db.lastInsertId
-        if fileID:
-            if data.get('primarycategory'):
-                if data.get('categories'):
-                    data['categories'].insert(0, data['primarycategory'])
-                else:
-                    data['categories'] = [data['primarycategory'], ]
-            if data.get('categories'):
-                primaryCategoryCreated = False
-                for cat in data['categories']:
-                    self.logger.debug(cat)
-                    catResults, taxonomy = self.getCategoryFromInput(cat)
-                    self.logger.debug(catResults)
-                    if not catResults:
-                        if ":" in cat:
-                            term = cat.split(":",1)[1]
-                            if len(term) == 0: return False
-                        else:
-                            term = cat
-                        self.createTaxonomyIfNotExisting(taxonomy)
-                        self.db.newCategory({"name": quote(term), "taxonomy": taxonomy})
-                        catID = self.db.lastInsertId
-                        self.db.newRelation({'item': fileID, 'term': catID})
+                import magic
+                magicFileType = magic.from_file(data['filepath'], mime=True)
+                self.logger.debug(magicFileType)
+                magicFileExtension = magicFileType.split("/")[1]
+                if magicFileExtension == "jpeg": magicFileExtension = "jpg"
+                if not fileExtension: fileExtension = magicFileExtension
+
+                fileType = self.config['itemTypes'].nounFromExtension(fileExtension)
+                if not fileType:
+                    fileType = self.config['itemTypes'].nounFromExtension(magicFileExtension)
+                if not fileType:
+                    magicTypeName = magicFileType.split("/")[0]
+                    self.logger.debug(magicTypeName)
+                    # tableName = self.config['itemTypes'].tableFromNoun(magicTypeName)
+                    if magicTypeName in self.config['itemTypes'].tableNames():
+                        fileTypeObj = self.config['itemTypes'][magicTypeName]
+                        fileTypeObj .addExtension(fileExtension)
+                        fileType = fileTypeObj.nounName
                     else:
-                        catID = catResults[0]
-                        relationExists = self.db.checkRelation(itemID=fileID, termID=catID).fetchall()
-                        if len(relationExists) == 0:
-                            self.db.newRelation({'item': fileID, 'term': catID})
-                        else:
-                            self.logger.info("Item already has relation for '" + taxonomy + ":" + catResults[
-                                FCM.CatCol['Name']] + "'")
-                    if not primaryCategoryCreated:
-                        self.db.updatePrimaryCategory(itemID=fileID, newPrimaryCategory=catID)
-                        primaryCategoryCreated = True
-        else:
-            self.logger.error("Unable to insert item.")
-            self.db.rollback()
-            raise Exception("Unable to insert item.")
+                        newItemTypeObj = ItemType()
+                        newItemTypeObj.setNounName(str(magicTypeName).capitalize())
+                        newItemTypeObj.setPluralName(pluralize(str(magicTypeName).capitalize()))
+                        newItemTypeObj.setDirName(pluralize(str(magicTypeName).capitalize()))
+                        newItemTypeObj.setTableName(str(magicTypeName))
+                        newItemTypeObj.setEnabled(True)
+                        if fileExtension:
+                            newItemTypeObj.addExtension(fileExtension)
+                        elif magicFileExtension:
+                            newItemTypeObj.addExtension(magicFileExtension)
+                        self.config['itemTypes'].append(newItemTypeObj)
+                        fileType = newItemTypeObj.nounName
+            if fileType:
+                if not data.get('type'): data['type'] = fileType
+                if not data.get('ext'): data['ext'] = fileExtension
+            else:
+                raise Exception("File type not recognised")
+            self.logger.debug(data)
+
+            if data.get('updateifduplicate') and not isWeblink:
+                existingItems = self.selectItemsWithFile(data['filepath'])
+                if len(existingItems) > 0:
+                    updateData = dict()
+                    updateData['filepath'] = str(existingItems[0][0])
+                    if data.get('categories'): updateData['addcategories'] = data['categories']
+                    if data.get('source'): updateData['setsource'] = data['source']
+                    if data.get('description'): updateData['setdescription'] = data['description']
+                    if data.get('primarycategory'): updateData['setprimarycategory'] = data['primarycategory']
+                    if data.get('datetime'): updateData['setdatetime'] = data['datetime']
+                    if data.get('name'): updateData['setname'] = data['name']
+                    return self.updateItem(updateData)
+
+            self.db.newItem(data)
+            fileID = self.db.lastInsertId
+            if fileID:
+                if data.get('primarycategory'):
+                    if data.get('categories'):
+                        data['categories'].insert(0, data['primarycategory'])
+                    else:
+                        data['categories'] = [data['primarycategory'], ]
+                if data.get('categories'):
+                    categoryIdens = [catID for catID in self.getCategoryIdensFromInput(data['categories']) if catID]
+                    if categoryIdens:
+                        self.db.newRelations((fileID, catID) for catID in categoryIdens)
+                        self.db.updatePrimaryCategory(itemID=fileID, newPrimaryCategory=categoryIdens[0])
+            else:
+                self.logger.error("Unable to insert item.")
+                self.db.rollback()
+                raise Exception("Unable to insert item.")
+            fileDestination = self.storeItemFile(fileID, {
+                'filepath': data['filepath'],
+                'type': data['type'],
+                'ext': fileExtension,
+                'name': data['name'],
+                'source': data['source'] if isWeblink else None
+            }, isWeblink)
+            if fileDestination and not isWeblink:
+                self.db.updateMD5(itemID=fileID, newMD5=self.hashCache.digest(fileDestination))
+            if self.importedMode: itemCreated = self.getItemFromPath(str(fileID))
+        if self.importedMode: return itemCreated
+
+    def storeItemFile(self, fileID, data, isWeblink):
         dataDir = self.config['options']['default_data_dir']
         dirType = self.config['itemTypes'].dirFromNoun(data['type'])
         if not isWeblink:
-            newFileName = str(fileID)+'.'+fileExtension
-            fileDestination = getDataFilePath(dataDir, dirType, newFileName)
-            if not os.path.exists(getDataFilePath(dataDir, dirType, newFileName)):
-                if uploadFile(self.config, data['filepath'], fileDestination, data['type']):
-                    self.db.updateMD5(itemID=fileID, newMD5=getMD5FromFile(fileDestination))
-                else:
-                    self.logger.error("Error Uploading File")
+            fileDestination = getDataFilePath(dataDir, dirType, str(fileID)+'.'+data['ext'])
+            ## Another item's file, which the new row mustn't take over.
+            if os.path.exists(fileDestination): raise Exception("File with ID already exists: "+fileDestination)
+            self.db.onRollback(partial(deleteFile, self, fileDestination,
+                                       os.path.join(os.path.dirname(fileDestination), str(fileID)+"_files")))
+            if uploadFile(self.config, data['filepath'], fileDestination, data['type']):
+                self.recordFileStates(((fileID, fileDestination),))
+                return fileDestination
             else:
-                self.logger.error("File with ID already exists")
+                self.logger.error("Error Uploading File")
         else:
-            dataDir = self.config['options']['default_data_dir']
-            dirType = self.config['itemTypes'].dirFromNoun(data['type'])
             filePath = os.path.join(dataDir, dirType, str(fileID)+"."+desktopFileExt())
-            if not createDesktopFile(filePath, unquote(data['name']), unquote(data['source'])):
+            self.db.onRollback(partial(deleteFile, self, filePath))
+            if createDesktopFile(filePath, data['name'], data['source']):
+                self.recordFileStates(((fileID, filePath),))
+                return filePath
+            else:
                 self.logger.error("Unable to create desktop file")
-        if self.importedMode: itemCreated = self.getItemFromPath(str(fileID))
-        if not keepDatabaseOpen:
-            self.db.commit()
-            self.db.close()
-        if self.importedMode: return itemCreated
+        return None
 
     def inspectCategory(self, data):
         catData = dict()
         if not data.get('category'): return False
-        if not data.get('keepDatabaseOpen'): self.db.open()
+        self.db.open()
         category, taxonomy = self.getCategoryFromInput(data.get("category"))
         if not category: raise Exception("Category not found")
         for colName in ('Iden','Name', 'Taxonomy', 'Description', 'Parent', 'Count'):
             catData[colName] = category[FCM.CatCol[colName]]
-        if catData.get('Name'): catData['Name'] = unquote(catData['Name'])
         if not data.get('skiprelations'):
             relations = self.db.selectCategoryRelations(termID=catData['Iden'])
             catData['Relations'] = list()
@@ -2113,13 +2299,26 @@ class Filecatman:
                 item = self.db.selectItem(rel[0])
                 catData['Relations'].append(item)
 
-        if not data.get('keepDatabaseOpen'):
-            self.db.commit()
-            self.db.close()
+        self.db.commit()
+        self.db.close()
         if self.importedMode or data.get('importedmode'): return catData
         import json
         print(json.dumps(catData, indent=4))
 
+    def printCategoryTree(self, data):
+        taxonomy = self.config['options']['default_taxonomy']
+        if data.get('taxonomy'):
+            taxListResult = self.config['taxonomies'].get(data['taxonomy'].capitalize())
+            if taxListResult: taxonomy = taxListResult.tableName
+            else: raise Exception("Taxonomy not found")
+        self.db.open()
+        categories = self.db.selectCategoriesAsTree(
+            {"taxonomy": taxonomy, "complete": True})
+        self.db.close()
+        if self.importedMode or data.get('importedmode'): return categories
+        for cat in categories:
+            print("{}{} ({})".format("    " * cat['level'], cat['name'], cat['count']))
+
     def deleteTaxonomy(self, _data):
         if not _data.get('taxonomy'): return False
         import copy
@@ -2141,14 +2340,12 @@ class Filecatman:
         if not _data.get('category'): return False
         import copy
         data = copy.deepcopy(_data)
-        keepDatabaseOpen = data.get('keepDatabaseOpen')
-        if not keepDatabaseOpen: self.db.open()
+        self.db.open()
         category, taxonomy = self.getCategoryFromInput(data.get("category"))
         if not category: raise Exception("Category not found")
         self.db.deleteCategory(category[FCM.CatCol['Iden']])
-        if not keepDatabaseOpen:
-            self.db.commit()
-            self.db.close()
+        self.db.commit()
+        self.db.close()
 
     def deleteItemRelations(self, data):
         if not data.get("filepath"): return False
@@ -2161,19 +2358,18 @@ class Filecatman:
 
     def deleteCategoryRelations(self, data):
         if not data.get("category"): return False
-        if not data.get('keepDatabaseOpen'): self.db.open()
+        self.db.open()
         category, taxonomy = self.getCategoryFromInput(data.get("category"))
         if not category: raise Exception("Category not found")
         self.db.deleteRelations(iden=category[FCM.ItemCol['Iden']], col="term_id")
-        if not data.get('keepDatabaseOpen'):
-            self.db.commit()
-            self.db.close()
+        self.db.commit()
+        self.db.close()
 
     def deleteItem(self, _data):
         import copy
         data = copy.deepcopy(_data)
 
-        if not data.get('keepDatabaseOpen'): self.db.open()
+        self.db.open()
         item = self.getItemFromPath(data['filepath'])
         if not item:
             self.logger.error("Item not found")
@@ -2183,10 +2379,9 @@ class Filecatman:
                                 str(item[FCM.ItemCol['Iden']]) + '.' + item[FCM.ItemCol['Ext']])
         fileID = item[FCM.ItemCol['Iden']]
         if self.db.deleteItem(fileID):
-            if os.path.exists(filepath): deleteFile(self, filepath)
-        if not data.get('keepDatabaseOpen'):
-            self.db.commit()
-            self.db.close()
+            self.db.onCommit(partial(deleteFile, self, filepath))
+        self.db.commit()
+        self.db.close()
         if self.importedMode: return True
 
     def getCategoryFromInput(self, _categoryInput):
@@ -2204,7 +2399,7 @@ class Filecatman:
             taxonomy = self.config['options']['default_taxonomy']
 
         catResults = self.db.selectCategories(
-            {"term_name": quote(term), "term_taxonomy": taxonomy}).fetchall()
+            {"term_name": term, "term_taxonomy": taxonomy}).fetchall()
         self.logger.debug(catResults)
         if len(catResults) > 0:
             if len(catResults) > 1:
@@ -2218,11 +2413,35 @@ class Filecatman:
         return category, taxonomy
 
 
+    def getCategoryIdensFromInput(self, categoryInputs):
+        ## Resolves each input to a term id, in order, creating the missing categories with one batch
+        ## insert. Inputs that cannot name a category resolve to None.
+        categoryIdens, missing = list(), list()
+        for categoryInput in categoryInputs:
+            category, taxonomy = self.getCategoryFromInput(categoryInput)
+            if category:
+                categoryIdens.append(category[FCM.CatCol['Iden']])
+                continue
+            term = str(categoryInput).split(":", 1)[1] if ":" in str(categoryInput) else str(categoryInput)
+            if len(term) == 0:
+                self.logger.warning("No category name given in '{}'".format(categoryInput))
+                categoryIdens.append(None)
+                continue
+            self.createTaxonomyIfNotExisting(taxonomy)
+            newCategory = (term, taxonomy)
+            if newCategory not in missing: missing.append(newCategory)
+            categoryIdens.append(newCategory)
+        if missing:
+            newIdens = self.db.newCategories({"name": name, "taxonomy": taxonomy} for name, taxonomy in missing)
+            newIdens = dict(zip(missing, newIdens))
+            categoryIdens = [newIdens[iden] if isinstance(iden, tuple) else iden for iden in categoryIdens]
+        return categoryIdens
+
     def renameCategory(self, data):
         self.db.open()
         category, taxonomy = self.getCategoryFromInput(data.get("category"))
         if not category: raise Exception("Category not found")
-        self.db.renameCategory(category[FCM.CatCol['Iden']], quote(data['newname']))
+        self.db.renameCategory(category[FCM.CatCol['Iden']], data['newname'])
         self.db.commit()
         self.db.close()
 
@@ -2230,7 +2449,7 @@ class Filecatman:
         self.db.open()
         item = self.getItemFromPath(data['filepath'])
         if not item: raise Exception("Item not found")
-        self.db.renameItem(item[FCM.ItemCol['Iden']], quote(data['newname']))
+        self.db.renameItem(item[FCM.ItemCol['Iden']], data['newname'])
         self.db.commit()
         self.db.close()
 
@@ -2264,82 +2483,55 @@ class Filecatman:
         parentTaxListResult = self.config['taxonomies'].get(taxInput.capitalize())
         if parentTaxListResult: taxParent = parentTaxListResult.tableName
         else: raise Exception("Taxonomy not found")
-        self.db.open()
-        if data.get('with'):
-            for taxToMerge in data['with']:
-                childTaxListResult = self.config['taxonomies'].get(taxToMerge.capitalize())
-                if not childTaxListResult: continue
-                if childTaxListResult == parentTaxListResult: continue
-                taxChild = childTaxListResult.tableName
-                childCatResults = self.db.selectCategories(
-                    {"term_taxonomy": taxChild}).fetchall()
-                print(childCatResults)
-                for childCat in childCatResults:
-                    parentCat = self.db.selectCategories(
-                        {"term_name": childCat[FCM.CatCol['Name']],
-                         "term_taxonomy": taxParent}).fetchone()
-                    if parentCat:
-                        self.logger.debug("term already exists for")
-                        self.mergeCategories(
-                            {"category": parentCat[FCM.CatCol['Iden']], "with": [childCat[FCM.CatCol['Iden']],],
-                             'keepDatabaseOpen': True})
-                    else:
-                        self.logger.debug("term not existing for")
-                        self.db.newCategory({"name": childCat[FCM.CatCol['Name']], "taxonomy": taxParent})
-                        catID = self.db.lastInsertId
-                        self.mergeCategories(
-                            {"category": catID, "with": [childCat[FCM.CatCol['Iden']], ],
-                             'keepDatabaseOpen': True})
-                self.config['taxonomies'].remove(childTaxListResult)
-        self.db.commit()
-        self.db.close()
+        with self.session():
+            if data.get('with'):
+                for taxToMerge in data['with']:
+                    childTaxListResult = self.config['taxonomies'].get(taxToMerge.capitalize())
+                    if not childTaxListResult: continue
+                    if childTaxListResult == parentTaxListResult: continue
+                    taxChild = childTaxListResult.tableName
+                    childCatResults = self.db.selectCategories(
+                        {"term_taxonomy": taxChild}).fetchall()
+                    print(childCatResults)
+                    for childCat in childCatResults:
+                        parentCat = self.db.selectCategories(
+                            {"term_name": childCat[FCM.CatCol['Name']],
+                             "term_taxonomy": taxParent}).fetchone()
+                        if parentCat:
+                            self.logger.debug("term already exists for")
+                            self.mergeCategories(
+                                {"category": parentCat[FCM.CatCol['Iden']], "with": [childCat[FCM.CatCol['Iden']],]})
+                        else:
+                            self.logger.debug("term not existing for")
+                            self.db.newCategory({"name": childCat[FCM.CatCol['Name']], "taxonomy": taxParent})
+                            catID = self.db.lastInsertId
+                            self.mergeCategories(
+                                {"category": catID, "with": [childCat[FCM.CatCol['Iden']], ]})
+                    self.config['taxonomies'].remove(childTaxListResult)
 
     def mergeDuplicateItems(self, data):
-        self.db.open()
-        searchResults = self.searchItems({
-            "keepDatabaseOpen": True,
-            "withduplicate": "md5",
-            "importedmode": True,
-            "sortby": "md5"
-        })
-        if not searchResults: return
-        duplicatesList = dict()
-        for item in searchResults:
-            filepath = os.path.join(self.config['options']['default_data_dir'],
-                                    self.config['itemTypes'].dirFromNoun(item[2]),
-                                    str(item[0]) + '.' + item[5])
-            fileMd5 = getMD5FromFile(filepath)
-            itemMd5 = item[9]
-            if not fileMd5 == itemMd5:
-                self.db.updateMD5(item[0], fileMd5)
-                itemMd5 = fileMd5
-            if itemMd5 not in duplicatesList:
-                duplicatesList[itemMd5] = list()
-                duplicatesList[itemMd5].append(item)
-            else: duplicatesList[itemMd5].append(item)
-        _duplicatesList = dict()
-        for key, dupList in duplicatesList.items():
-            if len(dupList) > 1:
-                _duplicatesList[key] = dupList
-        duplicatesList = _duplicatesList
-        for md5Key, dupeList in duplicatesList.items():
-            parentIndex = 0
-            if data.get("intolastitem"): parentIndex = len(dupeList)-1
-            parentItem = dupeList.pop(parentIndex)
-            mergeWith = list()
-            for index, item in enumerate(dupeList):
-                mergeWith.append(str(item[0]))
-            self.mergeItems({
-                "keepDatabaseOpen": True,
-                "filepath": str(parentItem[0]),
-                "with": mergeWith
-            })
-        self.db.commit()
-        self.db.close()
+        with self.session():
+            ## Every item file is compared by content, whatever digest or algorithm the items have recorded.
+            searchResults = self.searchItems({"importedmode": True})
+            if not searchResults: return
+            itemFiles = ((item, os.path.join(self.config['options']['default_data_dir'],
+                                             self.config['itemTypes'].dirFromNoun(item[2]),
+                                             str(item[0]) + '.' + item[5])) for item in searchResults)
+            for digest, dupeList in DuplicateFinder(self.hashCache, self.hashJobs).clusters(itemFiles):
+                parentIndex = 0
+                if data.get("intolastitem"): parentIndex = len(dupeList)-1
+                parentItem = dupeList.pop(parentIndex)
+                if parentItem[9] != digest: self.db.updateMD5(parentItem[0], digest)
+                mergeWith = list()
+                for index, item in enumerate(dupeList):
+                    mergeWith.append(str(item[0]))
+                self.mergeItems({
+                    "filepath": str(parentItem[0]),
+                    "with": mergeWith
+                })
 
     def copyCategoryRelations(self, data):
-        keepDatabaseOpen = data.get('keepDatabaseOpen')
-        if not keepDatabaseOpen: self.db.open()
+        self.db.open()
         if not data.get('from'): Exception("No categories specified")
         category, taxonomy = self.getCategoryFromInput(data.get("category"))
         if not category:
@@ -2349,7 +2541,7 @@ class Filecatman:
             else:
                 term = data.get("category")
             self.createTaxonomyIfNotExisting(taxonomy)
-            self.db.newCategory({"name": quote(term), "taxonomy": taxonomy})
+            self.db.newCategory({"name": term, "taxonomy": taxonomy})
             catID = self.db.lastInsertId
             category, taxonomy = self.getCategoryFromInput(str(catID))
             if not category: raise Exception("Category not found")
@@ -2375,12 +2567,12 @@ class Filecatman:
                     self.db.newRelation({'item': itemIden, 'term': category[FCM.CatCol['Iden']]})
                 else:
                     self.logger.info("Category already has relation for Item: " + itemIden)
-        if not keepDatabaseOpen: self.db.commit()
-        if not keepDatabaseOpen: self.db.close()
+        self.db.commit()
+        self.db.close()
 
     def copyItemRelations(self, data):
         if not data.get('from'): Exception("No items specified")
-        if not data.get('keepDatabaseOpen'): self.db.open()
+        self.db.open()
         item = self.getItemFromPath(data['filepath'])
         if not item: raise Exception("Item not found")
         existingIdensList = list()
@@ -2417,13 +2609,11 @@ class Filecatman:
                 self.db.newRelation({'item': item[FCM.ItemCol['Iden']], 'term': catIden})
             else:
                 self.logger.info("Item already has relation for category: " + catIden)
-        if not data.get('keepDatabaseOpen'):
-            self.db.commit()
-            self.db.close()
+        self.db.commit()
+        self.db.close()
 
     def mergeItems(self, data):
-        keepDatabaseOpen = data.get('keepDatabaseOpen')
-        if not keepDatabaseOpen: self.db.open()
+        self.db.open()
         if not data.get('with'): Exception("No items specified")
         item = self.getItemFromPath(data['filepath'])
         if not item: raise Exception("Item not found")
@@ -2445,7 +2635,7 @@ class Filecatman:
                             self.config['itemTypes'].dirFromNoun(item2[FCM.ItemCol['Type']]),
                             str(item2[FCM.ItemCol['Iden']]) + '.' + item2[FCM.ItemCol['Ext']])
             if self.db.deleteItem(item2[FCM.ItemCol['Iden']]):
-                if os.path.exists(filepath2): deleteFile(self, filepath2)
+                self.db.onCommit(partial(deleteFile, self, filepath2))
             if parentSource in ("", None) and not item2[FCM.ItemCol['Source']] in ("", None):
                 newParentSource = item2[FCM.ItemCol['Source']]
             if parentDesc in ("", None) and not item2[FCM.ItemCol['Description']] in ("", None):
@@ -2461,13 +2651,11 @@ class Filecatman:
                 self.logger.info("Item already has relation for category: " + catIden)
         if newParentSource: self.db.updateItemSource(item[FCM.ItemCol['Iden']], newParentSource)
         if newParentDesc: self.db.updateItemDescription(item[FCM.ItemCol['Iden']], newParentDesc)
-        if not keepDatabaseOpen:
-            self.db.commit()
-            self.db.close()
+        self.db.commit()
+        self.db.close()
 
     def synchCategories(self, data):
-        keepDatabaseOpen = data.get('keepDatabaseOpen')
-        if not keepDatabaseOpen: self.db.open()
+        self.db.open()
         if not data.get('categories'): raise Exception('No categories inputted')
         itemIdensList = list()
         catsList = list()
@@ -2481,7 +2669,7 @@ class Filecatman:
                 else:
                     term = cat
                 self.createTaxonomyIfNotExisting(taxonomy)
-                self.db.newCategory({"name": quote(term), "taxonomy": taxonomy})
+                self.db.newCategory({"name": term, "taxonomy": taxonomy})
                 catID = self.db.lastInsertId
                 category, taxonomy = self.getCategoryFromInput(str(catID))
                 if not category: continue
@@ -2497,12 +2685,11 @@ class Filecatman:
                 if len(relationExists) == 0:
                     self.db.newRelation({'item': itemIden, 'term': cat[FCM.CatCol['Iden']]})
 
-        if not keepDatabaseOpen: self.db.commit()
-        if not keepDatabaseOpen: self.db.close()
+        self.db.commit()
+        self.db.close()
 
     def mergeCategories(self, data):
-        keepDatabaseOpen = data.get('keepDatabaseOpen')
-        if not keepDatabaseOpen: self.db.open()
+        self.db.open()
         category, taxonomy = self.getCategoryFromInput(data.get("category"))
         if not category:
             if ":" in data.get("category"):
@@ -2511,7 +2698,7 @@ class Filecatman:
             else:
                 term = data.get("category")
             self.createTaxonomyIfNotExisting(taxonomy)
-            self.db.newCategory({"name": quote(term), "taxonomy": taxonomy})
+            self.db.newCategory({"name": term, "taxonomy": taxonomy})
             catID = self.db.lastInsertId
             category, taxonomy = self.getCategoryFromInput(str(catID))
             if not category:
@@ -2538,26 +2725,40 @@ class Filecatman:
                     self.db.newRelation({'item': itemIden, 'term': category[FCM.CatCol['Iden']]})
                 else:
                     self.logger.info("Category already has relation for Item: " + itemIden)
-        if not keepDatabaseOpen: self.db.commit()
-        if not keepDatabaseOpen: self.db.close()
+        self.db.commit()
+        self.db.close()
 
     def updateCategory(self, data, category=None):
-        if not data.get('keepDatabaseOpen'): self.db.open()
+        self.db.open()
         if not category:
             category, taxonomy = self.getCategoryFromInput(data.get("category"))
         if not category: raise Exception("Category not found")
 
+        if data.get('parent') is not None:
+            parentIden = None
+            if str(data['parent']).lower() not in ('', '0', 'none'):
+                parentInput = str(data['parent'])
+                if ":" not in parentInput and not parentInput.isnumeric():
+                    parentInput = category[FCM.CatCol['Taxonomy']]+":"+parentInput
+                parent, parentTaxonomy = self.getCategoryFromInput(parentInput)
+                if not parent: raise Exception("Parent category not found")
+                if parent[FCM.CatCol['Taxonomy']] != category[FCM.CatCol['Taxonomy']]:
+                    raise Exception("Parent category must be in the same taxonomy")
+                taxonomy = self.config['taxonomies'].get(category[FCM.CatCol['Taxonomy']])
+                if taxonomy and not taxonomy.hasChildren:
+                    raise Exception("Taxonomy '{}' does not have child categories".format(taxonomy.tableName))
+                parentIden = parent[FCM.CatCol['Iden']]
+            self.db.updateCategoryParent(category[FCM.CatCol['Iden']], parentIden)
+
         if data.get('additems'):
+            relations = list()
             for itemInput in data['additems']:
                 self.logger.debug(itemInput)
                 item = self.getItemFromPath(itemInput)
-                if item:
-                    relationExists = self.db.checkRelation(
-                        itemID=item[FCM.ItemCol['Iden']], termID=category[FCM.CatCol['Iden']]).fetchall()
-                    if len(relationExists) == 0:
-                        self.db.newRelation({'item': item[FCM.ItemCol['Iden']], 'term': category[FCM.CatCol['Iden']]})
-                    else:
-                        self.logger.info("Category already has relation for Item: "+str(item[FCM.ItemCol['Iden']]))
+                if item: relations.append((item[FCM.ItemCol['Iden']], category[FCM.CatCol['Iden']]))
+            inserted = self.db.newRelations(relations)
+            if inserted < len(relations):
+                self.logger.info("Category already had relations for {} items".format(len(relations) - inserted))
 
         if data.get('removeitems'):
             for itemInput in data['removeitems']:
@@ -2573,50 +2774,44 @@ class Filecatman:
                         self.db.deleteRelation(itemid=item[FCM.ItemCol['Iden']], termid=category[FCM.CatCol['Iden']])
                         self.logger.debug("Relation deleted")
 
-        if not data.get('keepDatabaseOpen'):
-            self.db.commit()
-            self.db.close()
+        self.db.commit()
+        self.db.close()
 
     def cloneItem(self, _data):
         import copy
         data = copy.deepcopy(_data)
-        if not data.get('keepDatabaseOpen'): self.db.open()
-        item = self.getItemFromPath(data['filepath'])
-        if not item:
-            self.logger.error("Item not found")
-            return False
-        isWeblink = self.config['itemTypes'].get(item[FCM.ItemCol['Type']]).isWeblinks
-        if not isWeblink:
-            filepath = os.path.join(self.config['options']['default_data_dir'],
-                                    self.config['itemTypes'].dirFromNoun(item[FCM.ItemCol['Type']]),
-                                    str(item[FCM.ItemCol['Iden']]) + '.' + item[FCM.ItemCol['Ext']])
-            if not os.path.exists(filepath): self.logger.error("File not found")
-        else: filepath = unquote(item[FCM.ItemCol['Source']])
-        relations = self.db.selectRelations(itemID=item[FCM.ItemCol['Iden']])
-        categories = list()
-        for rel in relations: categories .append(str(rel[0]))
-        self.uploadItem({
-            "filepath": filepath,
-            "name": unquote(item[FCM.ItemCol['Name']]),
-            "type": item[FCM.ItemCol['Type']],
-            "ext": item[FCM.ItemCol['Ext']],
-            "description": unquote(item[FCM.ItemCol['Description']]),
-            "source": unquote(item[FCM.ItemCol['Source']]),
-            "datetime": item[FCM.ItemCol["ModificationTime"]],
-            "creationtime": item[FCM.ItemCol["CreationTime"]],
-            "primarycategory": item[FCM.ItemCol["PrimaryCategory"]],
-            "categories": categories,
-            "keepDatabaseOpen": True
-        })
-        if not data.get('keepDatabaseOpen'):
-            self.db.commit()
-            self.db.close()
+        with self.session():
+            item = self.getItemFromPath(data['filepath'])
+            if not item:
+                self.logger.error("Item not found")
+                return False
+            isWeblink = self.config['itemTypes'].get(item[FCM.ItemCol['Type']]).isWeblinks
+            if not isWeblink:
+                filepath = os.path.join(self.config['options']['default_data_dir'],
+                                        self.config['itemTypes'].dirFromNoun(item[FCM.ItemCol['Type']]),
+                                        str(item[FCM.ItemCol['Iden']]) + '.' + item[FCM.ItemCol['Ext']])
+                if not os.path.exists(filepath): self.logger.error("File not found")
+            else: filepath = item[FCM.ItemCol['Source']]
+            relations = self.db.selectRelations(itemID=item[FCM.ItemCol['Iden']])
+            categories = list()
+            for rel in relations: categories .append(str(rel[0]))
+            self.uploadItem({
+                "filepath": filepath,
+                "name": item[FCM.ItemCol['Name']],
+                "type": item[FCM.ItemCol['Type']],
+                "ext": item[FCM.ItemCol['Ext']],
+                "description": item[FCM.ItemCol['Description']],
+                "source": item[FCM.ItemCol['Source']],
+                "datetime": item[FCM.ItemCol["ModificationTime"]],
+                "creationtime": item[FCM.ItemCol["CreationTime"]],
+                "primarycategory": item[FCM.ItemCol["PrimaryCategory"]],
+                "categories": categories
+            })
 
     def updateItem(self, _data, item=None):
         import copy
         data = copy.deepcopy(_data)
-        keepDatabaseOpen =  data.get('keepDatabaseOpen')
-        if not keepDatabaseOpen: self.db.open()
+        self.db.open()
         if not item: item = self.getItemFromPath(data['filepath'])
         if not item:
             self.logger.error("Item not found")
@@ -2635,8 +2830,8 @@ class Filecatman:
             self.logger.debug(dt.strftime("%Y-%m-%d %H:%M:%S"))
             data['setdatetime'] = dt.strftime("%Y-%m-%d %H:%M:%S")
         if data.get('synchmd5withfile') and not isWeblink:
+            ## The digest itself is refreshed with every update below, in the item's own algorithm.
             print(fileID)
-            self.db.updateMD5(itemID=fileID, newMD5=getMD5FromFile(filepath))
 
         if data.get('setdatetime'):
             import dateutil.parser
@@ -2669,7 +2864,7 @@ class Filecatman:
                     else:
                         term = cat
                     self.createTaxonomyIfNotExisting(taxonomy)
-                    self.db.newCategory({"name": quote(term), "taxonomy": taxonomy})
+                    self.db.newCategory({"name": term, "taxonomy": taxonomy})
                     catID = self.db.lastInsertId
                     self.db.newRelation({'item': fileID, 'term': catID})
                 else:
@@ -2695,7 +2890,7 @@ class Filecatman:
                         self.logger.debug("Relation deleted for '" + taxonomy + ":" + catResults[FCM.CatCol['Name']] + "'")
                 else:
                     self.logger.warning("Category '" + catResults[FCM.CatCol['Name']] + "' with taxonomy '" + taxonomy + "' not found")
-        updateData['md5'] = getMD5FromFile(filepath)
+        updateData['md5'] = self.hashCache.digest(filepath, self.itemDigestAlgorithm(item))
         if len(updateData) > 0:
             updateData['id'] = fileID
             if self.db.updateItem(updateData):
@@ -2704,17 +2899,21 @@ class Filecatman:
                                           self.config['itemTypes'].dirFromNoun(item[FCM.ItemCol['Type']]),
                                           str(item[FCM.ItemCol['Iden']]) + '.' + updateData['ext'])
                     os.rename(oldExtFilepath, newExtFilepath)
+                    self.db.onRollback(partial(os.rename, newExtFilepath, oldExtFilepath))
                 if isWeblink:
-                    item = self.getItemFromPath(str(item[FCM.ItemCol['Iden']]))
+                    oldItem, item = item, self.getItemFromPath(str(item[FCM.ItemCol['Iden']]))
                     dataDir = self.config['options']['default_data_dir']
                     dirType = self.config['itemTypes'].dirFromNoun(item[FCM.ItemCol['Type']])
                     filePath = os.path.join(dataDir, dirType, str(item[FCM.ItemCol['Iden']]) + "."+desktopFileExt())
-                    if not createDesktopFile(filePath, unquote(item[FCM.ItemCol['Name']]), unquote(item[FCM.ItemCol['Source']])):
+                    self.db.onRollback(partial(createDesktopFile, filePath, oldItem[FCM.ItemCol['Name']],
+                                               oldItem[FCM.ItemCol['Source']]))
+                    if not createDesktopFile(filePath, item[FCM.ItemCol['Name']], item[FCM.ItemCol['Source']]):
                         self.logger.error("Unable to create desktop file")
+                self.recordFileStates(self.itemFileStates(((fileID, item[FCM.ItemCol['Type']],
+                                                            updateData.get('ext') or item[FCM.ItemCol['Ext']]),)))
         if self.importedMode: itemUpdated = self.getItemFromPath(str(item[FCM.ItemCol['Iden']]))
-        if not keepDatabaseOpen:
-            self.db.commit()
-            self.db.close()
+        self.db.commit()
+        self.db.close()
         if self.importedMode: return itemUpdated
 
     def getSystemSpecifics(self):
@@ -2728,10 +2927,15 @@ class Filecatman:
             self.systemName = sys.platform
 
     def confirmConnection(self):
-        db = Database(self.config['db'])
+        dbConfig = dict(self.config['db'])
+        if self.noMigrate: dbConfig['migrate'] = False
+        db = Database(dbConfig)
         db.close()
         if not db: logger.error('Database Connection not Successful.')
         self.db = db
+        self.searchCache = SearchCache(db)
+        self.categoryBitmaps = CategoryBitmaps(db)
+        self.hashCache = HashCache(db)
 
     def readDatabaseOptions(self):
         self.db.open()
@@ -2754,6 +2958,9 @@ class Filecatman:
                 self.config['options']['coloured_taxonomies'] = False
                 self.config['options']['purge_shortcuts_folder'] = False
                 self.config['options']['progress_bar'] = True
+                self.config['options']['performance_profile'] = Database.defaultPerformanceProfile
+                self.config['options']['category_bitmaps'] = False
+                self.config['options']['hash_algorithm'] = defaultHashAlgorithm
                 self.config['options']['default_shortcuts_dir'] = os.path.join(os.path.dirname(
                     self.config['db']['db']),"Shortcuts")
                 self.config['options']['default_integration_dir'] = os.path.join(os.path.dirname(
@@ -2761,6 +2968,7 @@ class Filecatman:
                 self.config['options']['default_results_dir'] = os.path.join(os.path.dirname(
                     self.config['db']['db']), "SearchResults")
             for option in options:
+                if option[0] in (Migrator.versionOption, Migrator.stateOption): continue
                 self.config['options'][option[0]] = unquote(option[1])
             try:
                 self.config['options']['cat_lvls'] = int(self.config['options']['cat_lvls'])
@@ -2808,6 +3016,12 @@ class Filecatman:
         if self.config['options'].get('progress_bar'):
             self.config['options']['progress_bar'] = convToBool(
                 self.config['options']['progress_bar'], True)
+        self.config['options']['category_bitmaps'] = convToBool(
+            self.config['options'].get('category_bitmaps'), False)
+        self.config['options']['performance_profile'] = self.db.setPerformanceProfile(
+            self.config['options'].get('performance_profile'))
+        self.config['options']['hash_algorithm'] = self.hashCache.setAlgorithm(
+            self.config['options'].get('hash_algorithm'))
 
 
     def readItemTypesAndTaxonomies(self):
@@ -2834,8 +3048,10 @@ class Filecatman:
                 else:
                     itemType.isWeblinks = True
             self.config['itemTypes'].append(itemType)
+        defaultItemTypes = False
         if not self.config.get('itemTypes') or len(self.config['itemTypes']) == 0:
             self.config['itemTypes'] = self.createDefaultItemTypes()
+            defaultItemTypes = True
 
         if self.config.get('taxonomies'):
                 self.config['taxonomies'].clear()
@@ -2856,6 +3072,8 @@ class Filecatman:
         if not self.config.get('taxonomies') or len(self.config['taxonomies']) == 0:
             self.config['taxonomies'] = self.createDefaultTaxonomies()
         self.db.close()
+        ## Items reference item_types by id, so a new database stores its default types before any upload.
+        if defaultItemTypes: self.writeItemTypesAndTaxonomies()
 
     def createDefaultItemTypes(self):
         itemTypes = ItemTypeList()
@@ -2888,22 +3106,20 @@ class Filecatman:
 
     def writeDatabaseOptions(self):
         if self.db:
-            self.writeItemTypesAndTaxonomies()
-            self.db.open()
-            if self.config['options']['relative_data_dir']:
-                full_path = self.config['options']['default_data_dir']
-                relative_path = os.path.dirname(self.db.config['db'])
-                self.config['options']['default_data_dir'] = os.path.relpath(full_path, relative_path)
-            for option, value in self.config['options'].items():
-                    self.db.insertOption(option, quote(str(value)))
-            self.db.commit()
-            self.db.close()
+            with self.session():
+                self.writeItemTypesAndTaxonomies()
+                if self.config['options']['relative_data_dir']:
+                    full_path = self.config['options']['default_data_dir']
+                    relative_path = os.path.dirname(self.db.config['db'])
+                    self.config['options']['default_data_dir'] = os.path.relpath(full_path, relative_path)
+                for option, value in self.config['options'].items():
+                        self.db.insertOption(option, quote(str(value)))
             if self.db.error is None:
                 self.logger.debug('Database options written.')
 
     def writeItemTypesAndTaxonomies(self):
         self.db.open()
-        self.db.deleteItemTypes()
+        self.db.deleteItemTypes(keep=[itemType.nounName for itemType in self.config['itemTypes']])
         self.db.deleteTaxonomies()
         for taxonomy in self.config['taxonomies']:
             data = dict()
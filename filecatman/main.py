@@ -36,6 +36,8 @@ class main():
     parser.add_argument("--closedb", help="Close database if auto load enabled", action="store_true", dest="closedb")
     parser.add_argument("--noshortcuts", help="Disable shortcut creation", action="store_true", dest="noshortcuts")
     parser.add_argument("--nointegration", help="Disable integration", action="store_true", dest="nointegration")
+    parser.add_argument("-j", "--jobs", help="Number of files hashed at once, default one per CPU core", action="store",
+                             dest="jobs")
     parser.add_argument("--defaulttaxonomy", help="Set default taxonomy", action="store", dest="defaulttaxonomy")
     parser.add_argument("--shortcutsdir", help="Set default shortcuts dir", action="store", dest="shortcutsdir")
     parser.add_argument("--integrationdir", help="Set default integration dir", action="store", dest="integrationdir")
@@ -43,6 +45,7 @@ class main():
 
     ## Command Options
     parser.add_argument("--withcategories", help=argparse.SUPPRESS, nargs="+", action="append", dest="withcategories")
+    parser.add_argument("--include-descendants", help=argparse.SUPPRESS, action="store_true", dest="includedescendants")
     parser.add_argument("--withoutcategories", help=argparse.SUPPRESS, nargs="+", action="append", dest="withoutcategories")
     parser.add_argument("--anytax", help=argparse.SUPPRESS, nargs="+", action="append", dest="anytax")
     parser.add_argument("--catsearch", help=argparse.SUPPRESS, nargs="+", action="append", dest="catsearch")
@@ -105,7 +108,12 @@ class main():
     parser.add_argument("--removeitems", help=argparse.SUPPRESS, nargs="+", action="append", dest="removeitems")
     parser.add_argument("--withitems", help=argparse.SUPPRESS, nargs="+", action="append", dest="withitems")
     parser.add_argument("--withoutitems", help=argparse.SUPPRESS, nargs="+", action="append", dest="withoutitems")
+    parser.add_argument("--in-set", help=argparse.SUPPRESS, nargs="+", action="append", dest="inset")
+    parser.add_argument("--not-in-set", help=argparse.SUPPRESS, nargs="+", action="append", dest="notinset")
+    parser.add_argument("--save-as", help=argparse.SUPPRESS, action="store", dest="saveas")
+    parser.add_argument("--as", help=argparse.SUPPRESS, action="store", dest="argas")
     parser.add_argument("--withanyitems", help=argparse.SUPPRESS, nargs="+", action="append", dest="withanyitems")
+    parser.add_argument("--parent", help=argparse.SUPPRESS, action="store", dest="parent")
     parser.add_argument("--with", help=argparse.SUPPRESS, nargs="+", action="append", dest="argwith")
     parser.add_argument("--withany", help=argparse.SUPPRESS, nargs="+", action="append", dest="argwithany")
     parser.add_argument("--from", help=argparse.SUPPRESS, nargs="+", action="append", dest="argfrom")
@@ -125,6 +133,13 @@ class main():
     parser.add_argument("--itemsperpage", help=argparse.SUPPRESS, action="store", dest="itemsperpage")
     parser.add_argument("--page", help=argparse.SUPPRESS, action="store", dest="page")
     parser.add_argument("--lastpage", help=argparse.SUPPRESS, action="store_true", dest="lastpage")
+    parser.add_argument("--cursor", help=argparse.SUPPRESS, action="store", dest="cursor")
+    parser.add_argument("--query", help=argparse.SUPPRESS, action="store", dest="query")
+    parser.add_argument("--explain", help=argparse.SUPPRESS, action="store_true", dest="explain")
+    parser.add_argument("--nocache", help=argparse.SUPPRESS, action="store_true", dest="nocache")
+    parser.add_argument("--verify-stat", help=argparse.SUPPRESS, action="store_true", dest="verifystat")
+    parser.add_argument("--facets", help=argparse.SUPPRESS, action="store", dest="facets")
+    parser.add_argument("--facetlimit", help=argparse.SUPPRESS, action="store", dest="facetlimit")
     parser.add_argument("--intofirstitem", help=argparse.SUPPRESS, action="store_true", dest="intofirstitem")
     parser.add_argument("--intolastitem", help=argparse.SUPPRESS, action="store_true", dest="intolastitem")
 
@@ -143,11 +158,13 @@ class main():
     parser.add_argument("--first", help=argparse.SUPPRESS, action="store", dest="first")
     parser.add_argument("--export", help=argparse.SUPPRESS, action="store", dest="export")
     parser.add_argument("--random", help=argparse.SUPPRESS, action="store_true", dest="random")
+    parser.add_argument("--seed", help=argparse.SUPPRESS, action="store", dest="seed")
     parser.add_argument("--manager", help=argparse.SUPPRESS, action="store_true", dest="manager")
     parser.add_argument("--multiple", help=argparse.SUPPRESS, nargs="+", action="append", dest="multiple")
     parser.add_argument("--launch", help=argparse.SUPPRESS, action="store_true", dest="launch")
     parser.add_argument("--inspect", help=argparse.SUPPRESS, action="store_true", dest="inspect")
     parser.add_argument("--updateifduplicate", help=argparse.SUPPRESS, action="store_true", dest="updateifduplicate")
+    parser.add_argument("--dryrun", help=argparse.SUPPRESS, action="store_true", dest="dryrun")
 
     ## Commands
     for x in range(1, len(sys.argv)+3):
@@ -207,6 +224,22 @@ class main():
                             self.printHelp("database vacuum")
                             quit()
                         self.filecatmanActions['database']['vacuum'] = True
+                    case "recount":
+                        if self.args.help:
+                            self.printHelp("database recount")
+                            quit()
+                        self.filecatmanActions['database']['recount'] = True
+                    case "refreshstat":
+                        if self.args.help:
+                            self.printHelp("database refreshstat")
+                            quit()
+                        self.filecatmanActions['database']['refreshstat'] = True
+                    case "migrate":
+                        if self.args.help:
+                            self.printHelp("database migrate")
+                            quit()
+                        if self.args.dryrun: const.LOGGERLEVEL = "none"
+                        self.filecatmanActions['database']['migrate'] = {'dryrun': self.args.dryrun}
                     case "setoption":
                         if self.args.help:
                             self.printHelp("database setoption")
@@ -385,6 +418,13 @@ class main():
                             quit()
                     case "update":
                         self.commandCategoryUpdate(3, self.args.command1+" "+self.args.command2)
+                    case "tree":
+                        if self.args.help:
+                            self.printHelp(self.args.command1+" tree")
+                            quit()
+                        const.LOGGERLEVEL = "none"
+                        self.filecatmanActions['category']['tree'] = dict()
+                        if self.args.command3: self.filecatmanActions['category']['tree']['taxonomy'] = self.args.command3
                     case "delete":
                         self.commandCategoryDelete(3, self.args.command1+" "+self.args.command2)
                     case "delrel":
@@ -409,6 +449,8 @@ class main():
                         if self.args.command3:
                             self.filecatmanActions['category']['view'] = {"category": self.args.command3}
                             if self.args.manager: self.filecatmanActions['category']['view']['openinmanager'] = True
+                            if self.args.includedescendants:
+                                self.filecatmanActions['category']['view']['includedescendants'] = True
                         else:
                             self.printHelp(self.args.command1+" view")
                             quit()
@@ -490,6 +532,37 @@ class main():
                     case _:
                         const.LOGGERLEVEL = "none"
                         self.printHelp()
+            case "resultset" | "resultsets":
+                self.filecatmanActions['resultset'] = dict()
+                setNames = [getattr(self.args, "command"+str(x)) for x in range(3, len(sys.argv)+3)
+                            if getattr(self.args, "command"+str(x))]
+                match self.args.command2:
+                    case "list" | "ls":
+                        const.LOGGERLEVEL = "none"
+                        self.filecatmanActions['resultset']['list'] = {}
+                    case "union" | "intersect" | "except":
+                        if self.args.help:
+                            self.printHelp("resultset "+self.args.command2)
+                            quit()
+                        if len(setNames) >= 2 and self.args.argas:
+                            self.filecatmanActions['resultset']['combine'] = {
+                                "operator": self.args.command2, "sets": setNames, "as": self.args.argas}
+                        else:
+                            self.printHelp("resultset "+self.args.command2)
+                            quit()
+                    case "delete":
+                        if self.args.help:
+                            self.printHelp("resultset delete")
+                            quit()
+                        if setNames:
+                            self.filecatmanActions['resultset']['delete'] = {"sets": setNames}
+                        else:
+                            self.printHelp("resultset delete")
+                            quit()
+                    case _:
+                        const.LOGGERLEVEL = "none"
+                        self.printHelp("resultset")
+                        quit()
             case "upload":
                 self.commandItemUpload(2, "upload")
             case "update":
@@ -515,6 +588,7 @@ class main():
         filecatmanConfig = dict()
         if self.args.noshortcuts: filecatmanConfig['noshortcuts'] = True
         if self.args.nointegration: filecatmanConfig['nointegration'] = True
+        if self.args.jobs: filecatmanConfig['jobs'] = self.args.jobs
         filecatmanConfig['actions'] = self.filecatmanActions
         filecatmanConfig['changes'] = self.filecatmanChanges
 
@@ -524,6 +598,7 @@ class main():
             'noImportedMode': True
         }
         if self.args.closedb: filecatArgs['closeAutoLoadDatabase'] = True
+        if self.filecatmanActions.get('database', {}).get('migrate'): filecatArgs['noMigrate'] = True
         try:
             app = Filecatman(filecatArgs)
         except Exceptions.FCM_NoDatabaseFile as e:
@@ -531,7 +606,12 @@ class main():
             quit()
 
         log.initializeLogger(const.LOGGERLEVEL)
-        app.executeActions(filecatmanConfig)
+        try:
+            app.executeActions(filecatmanConfig)
+        except Exceptions.FCM_QuerySyntaxError as e:
+            print("Query error: {}".format(e))
+            app.close()
+            quit()
         if len(filecatmanConfig['actions']) == 0 and len(filecatmanConfig['changes']) == 0 :
             app.inspectDatabaseInfo(simple=True)
 
@@ -811,6 +891,7 @@ class main():
             self.filecatmanActions['category']['update'] = {"category": categories}
             if self.args.additems: self.filecatmanActions['category']['update']['additems'] = self.args.additems[0]
             if self.args.removeitems: self.filecatmanActions['category']['update']['removeitems'] = self.args.removeitems[0]
+            if self.args.parent is not None: self.filecatmanActions['category']['update']['parent'] = self.args.parent
         else:
             self.printHelp(command)
             quit()
@@ -884,7 +965,11 @@ class main():
         if self.args.argwith:  self.filecatmanActions['search']['withcategories'] = self.args.argwith[0]
         if self.args.withitems: self.filecatmanActions['search']['withitems'] = self.args.withitems[0]
         if self.args.withoutitems:  self.filecatmanActions['search']['withoutitems'] = self.args.withoutitems[0]
+        if self.args.inset: self.filecatmanActions['search']['inset'] = self.args.inset[0]
+        if self.args.notinset: self.filecatmanActions['search']['notinset'] = self.args.notinset[0]
+        if self.args.saveas: self.filecatmanActions['search']['saveas'] = self.args.saveas
         if self.args.withcategories: self.filecatmanActions['search']['withcategories'] = self.args.withcategories[0]
+        if self.args.includedescendants: self.filecatmanActions['search']['includedescendants'] = True
         if self.args.anytax: self.filecatmanActions['search']['anytax'] = self.args.anytax[0]
         if self.args.catsearch: self.filecatmanActions['search']['catsearch'] = self.args.catsearch[0]
         if self.args.argwithout: self.filecatmanActions['search']['withoutcategories'] = self.args.argwithout[0]
@@ -920,6 +1005,7 @@ class main():
         if self.args.withprimarycategory: self.filecatmanActions['search']['withprimarycategory'] = self.args.withprimarycategory
         if self.args.withoutprimarycategory: self.filecatmanActions['search']['withoutprimarycategory'] = self.args.withoutprimarycategory
         if self.args.random: self.filecatmanActions['search']['randomorder'] = True
+        if self.args.seed is not None: self.filecatmanActions['search']['seed'] = self.args.seed
         if self.args.manager: self.filecatmanActions['search']['openinmanager'] = True
         if self.args.launch: self.filecatmanActions['search']['launch'] = True
         if self.args.inspect: self.filecatmanActions['search']['inspectitems'] = True
@@ -935,6 +1021,13 @@ class main():
         if self.args.itemsperpage: self.filecatmanActions['search']['itemsperpage'] = self.args.itemsperpage
         if self.args.page: self.filecatmanActions['search']['page'] = self.args.page
         if self.args.lastpage: self.filecatmanActions['search']['lastpage'] = True
+        if self.args.cursor: self.filecatmanActions['search']['cursor'] = self.args.cursor
+        if self.args.query: self.filecatmanActions['search']['query'] = self.args.query
+        if self.args.explain: self.filecatmanActions['search']['explain'] = True
+        if self.args.nocache: self.filecatmanActions['search']['nocache'] = True
+        if self.args.verifystat: self.filecatmanActions['search']['verifystat'] = True
+        if self.args.facets: self.filecatmanActions['search']['facets'] = self.args.facets
+        if self.args.facetlimit: self.filecatmanActions['search']['facetlimit'] = self.args.facetlimit
         if self.args.col: self.filecatmanActions['search']['col'] = self.args.col[0]
         if self.args.hidecol: self.filecatmanActions['search']['hidecol'] = self.args.hidecol[0]
         if self.args.nullcol: self.filecatmanActions['search']['nullcol'] = self.args.nullcol[0]
@@ -1042,6 +1135,7 @@ Options:
 --closedb                Close database if auto load enabled
 --noshortcuts            Disable shortcut creation
 --nointegration          Disable integration
+-j, --jobs N             Number of files hashed at once, default one per CPU core
 --defaulttaxonomy TAX    Set default taxonomy
 --shortcutsdir DIR       Set default shortcuts dir
 --integrationdir DIR     Set default integration dir
@@ -1051,6 +1145,7 @@ item        Manage items
 category    Manage categories
 database    Manage database
 taxonomy    Manage taxonomies
+resultset   Combine saved search results
 
 Commands:
 version     Show program's version number and exit
@@ -1072,6 +1167,9 @@ Run 'filecatman [options] COMMAND --help' for more information on a command.''')
                 case "database":
                     print('''\nCommands for filecatman database:
 vacuum          Vacuum database
+recount         Rebuild category item counts and item relation counts
+refreshstat     Record the size and modification time of every item file
+migrate         Upgrade the database schema
 setoption       Set database option
 options         View all options
 itemtypes       View all itemtypes
@@ -1080,6 +1178,23 @@ checkfiles      Check files have items in database
 info            View database info
 
 Run 'filecatman [options] database COMMAND --help' for more information on a command.''')
+                case "resultset" | "resultsets":
+                    print('''\nCommands for filecatman resultset:
+list        List saved result sets and their sizes
+union       Save the items in any of the sets as a new set
+intersect   Save the items in every one of the sets as a new set
+except      Save the items of the first set that are in none of the others as a new set
+delete      Delete result sets
+
+Save search results with 'filecatman search ... --save-as NAME' and filter searches with --in-set NAME.
+Run 'filecatman [options] resultset COMMAND --help' for more information on a command.''')
+                case "resultset union" | "resultset intersect" | "resultset except":
+                    print('''\nUsage for filecatman {0}:
+filecatman [options] {0} [set name] [set name] ... --as [new set name]
+\nA set saved under an existing name replaces it, so a set can be combined into itself.'''.format(command))
+                case "resultset delete":
+                    print('''\nUsage for filecatman {0}:
+filecatman [options] {0} [set name] ...'''.format(command))
                 case "item":
                     print('''\nCommands for filecatman item:
 inspect     Inspect an item
@@ -1109,6 +1224,7 @@ create      Create a category
 inspect     Inspect a category
 rename      Rename a category
 update      Update a category
+tree        Print the category hierarchy of a taxonomy
 launch      Launch a category
 delete      Delete a category
 view        View a category's items
@@ -1177,6 +1293,8 @@ filecatman [options] {0} [item id / filepath] ... [{0} options]
                 case "search" | "items" | "item search" | "item list" | "item ls":
                      print('''\nUsage for filecatman {0}:
 filecatman [options] {0} [phrase] [{0} options]
+ \nWith the full-text index, the phrase and keywords match the starts of words, so "breed" finds "Breeds"
+but not "inbreeding"; without it they match anywhere in the name, source and description.
  \nOptions for filecatman {0}:
 --listpaths    Return list of file paths to search result items
 --listnamedpaths    Return list of file paths to search result items
@@ -1189,11 +1307,19 @@ filecatman [options] {0} [phrase] [{0} options]
 --withoutdescription     Exclude description column with phrase
 --withcategories, --with [category id / taxonomy:name] ...  Include items with all these categories
 --withany [category id / taxonomy:name] ...  Include items with any of these categories
+--include-descendants  Category filters also match items in their subcategories
+--query [expression]   Search with AND, OR, NOT and brackets, e.g. 'tag:cats AND (type:image OR ext:gif) AND NOT tag:nsfw AND size>1MB'
+                       Fields: name: source: description: ext: type: md5: set: id cats date cdate size [= != > >= < <=], [taxonomy]:[category / *]
+                       Bare words and "phrases" search the item text, with --verify-stat size can only be ANDed at the top level
+--explain   Print the SQL, its parameters and the SQLite query plan instead of the results
 --anytax [name] ...  Include items with any of these categories, searches all taxonomies
 --catsearch [phrase] ...  Include items with category name similar to this phrase
 --withoutcategories, --without [category id / taxonomy:name] ...  Exclude categories
 --withitems [item id / filepath] ...   Results must include these items
 --withoutitems [item id / filepath] ...    Results must exclude these items
+--in-set [set name] ...   Results must be in all these saved result sets
+--not-in-set [set name] ...   Results must be in none of these saved result sets
+--save-as [set name]   Save the ids of all results, before paging, as a result set
 --withkeywords  ...  Include keywords
 --withoutkeywords ...  Exclude keywords
 --taxonomies, --tax ...   Include taxonomies
@@ -1218,7 +1344,8 @@ filecatman [options] {0} [phrase] [{0} options]
 --withoutfileext ...     Exclude file extension
 --first [#]             First number of items to return
 --last [#]             Last number of items to return
---random            Randomize results
+--random            Randomize results, with --first or --last a random sample of that many
+--seed [seed]       Seed for --random, the same seed returns the same results
 --manager          Show results in file manager
 --launch                 launch in default program
 --inspect                 Return JSON of item data
@@ -1226,15 +1353,20 @@ filecatman [options] {0} [phrase] [{0} options]
 --withprimarycategory   Include primary category
 --withoutprimarycategory   Exclude primary category
 --withmissingfile   Include items with missing files
---sortby    Sort items by column name
+--sortby    Sort items by column name, or by relevance to the search keywords
 --asc Sort ascending
 --desc Sort descending
 --withduplicate [column name]     Include items where column values appears multiple times
---withduplicatefile     Include items where files appear multiple times
+--withduplicatefile     Items whose file content matches another result, listed in numbered sets
 --count         Count number of results
+--facets [taxonomy,type,ext]   Print the most common categories, item types or extensions among the results
+--facetlimit [number]   Number of values shown per facet, 10 by default
 --itemsperpage      Paginate results with number of items per page
 --page                  Page of results to return
 --lastpage              Last page of results
+--cursor [token]        Continue from the "Next cursor" printed after a full page, keeping the sort options
+--nocache               Run the search query even if its results are cached from an earlier call
+--verify-stat           Read file sizes and dates from the files instead of the recorded ones
 --sizemorethan    With file size more than
 --sizelessthan    With file size less than
 --col [creationdate/filedate/size/source/md5]   Show column
@@ -1273,6 +1405,8 @@ filecatman [options] {0} [phrase] [{0} options]
 --desc          Sort descending
 --withduplicate [column name]          Include where column values appears multiple times
 --count         Count number of results
+--facets [taxonomy,type,ext]   Print the most common categories, item types or extensions among the results
+--facetlimit [number]   Number of values shown per facet, 10 by default
 --col [col]   Show additional column 
 --hidecol [col]   Hide column
 --nocolour  Temporarily disable print colours
@@ -1296,6 +1430,7 @@ filecatman [options] {0} [category id / taxonomy:name] ... [{0} options]
 \nOptions for filecatman {0}:
 --additems             Add items to the categories
 --removeitems             Remove items from the categories
+--parent [category id / name]             Move the categories under a parent, 0 moves them to the top level
                 '''.format(command))
                 case "taxonomy merge":
                     print('''\nUsage for filecatman {0}:
@@ -1344,7 +1479,14 @@ filecatman [options] {0} [category id / taxonomy:name] ... [{0} options]'''.form
 filecatman [options] {0} [category id / taxonomy:name] [category id / taxonomy:name] ...'''.format(command))
                 case "category view" | "cat view":
                     print('''\nUsage for filecatman {0}:
-filecatman [options] {0} [category id / taxonomy:name] [{0} options]'''.format(command))
+filecatman [options] {0} [category id / taxonomy:name] [{0} options]
+\nOptions for filecatman {0}:
+--include-descendants             Also view the items of the subcategories'''.format(command))
+                case "category tree" | "cat tree":
+                    print('''\nUsage for filecatman {0}:
+filecatman [options] {0} [taxonomy]
+\nPrint the categories of a taxonomy as an indented tree with their item counts.
+The default taxonomy is used when none is given.'''.format(command))
                 case "item rename":
                     print('''\nUsage for filecatman {0}:
 filecatman [options] {0} [item id / filepath] [new name] [{0} options]
@@ -1390,9 +1532,38 @@ filecatman [options] {0} [category id / taxonomy:name] [new name] [{0} options]
 filecatman [options] {0}
 
 Execute SQLite vacuum command on database.'''.format(command))
+                case "database recount":
+                    print('''\nUsage for filecatman {0}:
+filecatman [options] {0}
+
+Rebuild the item count of every category and the relation count of every item from the relations.'''.format(command))
+                case "database refreshstat":
+                    print('''\nUsage for filecatman {0}:
+filecatman [options] {0}
+
+Stat every item file and record its size and modification time, which searches sort and filter on.
+Run it after item files are changed outside filecatman.'''.format(command))
+                case "database migrate":
+                    print('''\nUsage for filecatman {0}:
+filecatman [options] {0} [migrate options]
+
+Apply pending schema migrations. Migrations also run automatically when a database is opened.
+
+Options for filecatman {0}:
+--dryrun          List pending migrations and the rows each step would touch'''.format(command))
                 case "database setoption":
                     print('''\nUsage for filecatman {0}:
-filecatman [options] {0} [database option] [new value]'''.format(command))
+filecatman [options] {0} [database option] [new value]
+
+Performance profiles (option performance_profile):
+safe            Rollback journal, full fsync on every commit
+balanced        Write-ahead log, larger page cache and memory map (default)
+bulk            As balanced without fsync, used while importing and integrating
+
+category_bitmaps  True to combine --with, --without and --withany categories as cached item-id bitmaps
+                  instead of one subquery per category
+hash_algorithm    md5 (default), sha256 or blake2b, the digest new and synchronized items get. Items keep
+                  their digest's algorithm until 'item synchmd5' rehashes them'''.format(command))
                 case "taxonomy setcolour":
                     print('''
 Usage for filecatman {0}: